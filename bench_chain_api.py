@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+# Load test for a nodeos chain API built on the same get_info request as
+# check_eos_bp.check_api. Sends a weighted mix of chain API calls with a fixed
+# concurrency (closed loop) or at a fixed request rate (open loop) and reports
+# throughput, error rate and latency percentiles per call. Latencies go into
+# streaming histograms, so memory stays flat however long the run is.
+#
+# In rate mode latency is measured from the time a request was scheduled, not
+# from when a worker picked it up, so a slow server can not hide its queueing
+# delay (coordinated omission). At most --concurrency requests run and
+# --backlog wait; a request due while both are full is dropped and counted,
+# so a rate the server can not keep up with shows as drops instead of an
+# ever growing queue.
+
+import argparse
+import sys
+import json
+import time
+import random
+import threading
+import concurrent.futures
+import eoshttp
+import check_eos_bp
+from histogram import LatencyHistogram
+
+CALLS = ['get_info', 'get_block', 'get_table_rows', 'get_account']
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        call, weight = item.split('=')
+        if not call in CALLS:
+            raise ValueError('Unknown call {}. Choices: {}'.format(call, ','.join(CALLS)))
+        weights[call] = float(weight)
+    return weights
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.histograms = {call: LatencyHistogram() for call in CALLS}
+        self.errors = {call: 0 for call in CALLS}
+        self.dropped = {call: 0 for call in CALLS}
+        self.weights = parse_mix(args.mix)
+        self.calls = list(self.weights)
+        self.head_block_num = int(check_eos_bp.request_info(args.host, args.port, args.ssl, args.timeout)[0]['head_block_num'])
+        code, scope, table = args.table.split(':')
+        self.table = {'code': code, 'scope': scope, 'table': table, 'json': True, 'limit': 10}
+
+    def chain_url(self, call):
+        return eoshttp.url(self.args.host, self.args.port, self.args.ssl, '/v1/chain/{}'.format(call))
+
+    def request(self, call):
+        if call == 'get_info':
+            return check_eos_bp.request_info(self.args.host, self.args.port, self.args.ssl, self.args.timeout)
+        if call == 'get_block':
+            data = {'block_num_or_id': self.head_block_num - random.randint(0, self.args.block_range)}
+        elif call == 'get_table_rows':
+            data = self.table
+        else:
+            data = {'account_name': self.args.account}
+        return eoshttp.fetch('POST', self.chain_url(call), json_data=data, timeout=self.args.timeout)
+
+    def run_one(self, call, scheduled = None):
+        start = scheduled if scheduled != None else time.perf_counter()
+        try:
+            self.request(call)
+            ok = True
+        except Exception:
+            ok = False
+        latency = time.perf_counter() - start
+        with self.lock:
+            if ok:
+                self.histograms[call].record(latency)
+            else:
+                self.errors[call] += 1
+
+    def pick(self):
+        return random.choices(self.calls, weights=[self.weights[c] for c in self.calls])[0]
+
+    def closed_loop(self, deadline):
+        def worker():
+            while time.perf_counter() < deadline:
+                self.run_one(self.pick())
+        threads = [threading.Thread(target=worker) for _ in range(self.args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def open_loop(self, deadline):
+        interval = 1.0 / self.args.rate
+        slots = threading.BoundedSemaphore(self.args.concurrency + self.args.backlog)
+        def run(call, scheduled):
+            try:
+                self.run_one(call, scheduled)
+            finally:
+                slots.release()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            scheduled = time.perf_counter()
+            while scheduled < deadline:
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                call = self.pick()
+                if slots.acquire(blocking=False):
+                    executor.submit(run, call, scheduled)
+                else:
+                    with self.lock:
+                        self.dropped[call] += 1
+                scheduled += interval
+
+    def run(self):
+        start = time.perf_counter()
+        deadline = start + self.args.duration
+        if self.args.rate:
+            self.open_loop(deadline)
+        else:
+            self.closed_loop(deadline)
+        return time.perf_counter() - start
+
+def results(bench, elapsed):
+    total = LatencyHistogram()
+    calls = {}
+    for call in bench.calls:
+        total.merge(bench.histograms[call])
+        calls[call] = {'errors': bench.errors[call], 'dropped': bench.dropped[call], 'histogram': bench.histograms[call].to_dict()}
+    return {
+        'elapsed': elapsed,
+        'mode': 'rate {}/s'.format(bench.args.rate) if bench.args.rate else 'concurrency {}'.format(bench.args.concurrency),
+        'mix': bench.args.mix,
+        'calls': calls,
+        'total': {'errors': sum(bench.errors.values()), 'dropped': sum(bench.dropped.values()), 'histogram': total.to_dict()}
+    }
+
+def print_results(result, baseline = None):
+    print('{} for {:.1f}s, mix {}'.format(result['mode'], result['elapsed'], result['mix']))
+    print('{:<16} {:>8} {:>8} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10}'.format('call', 'count', 'err %', 'dropped', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms',
+                                                                              'p99 vs base'))
+    rows = [(call, result['calls'][call]) for call in result['calls']] + [('total', result['total'])]
+    for name, row in rows:
+        h = LatencyHistogram.from_dict(row['histogram'])
+        requests = h.count + row['errors']
+        s = h.summary()
+        ms = lambda v: '{:.2f}'.format(v * 1000) if v != None else '-'
+        compare = ''
+        if baseline:
+            base_row = baseline['total'] if name == 'total' else baseline['calls'].get(name)
+            if base_row and base_row['histogram']['count']:
+                base_p99 = LatencyHistogram.from_dict(base_row['histogram']).percentile(99)
+                if s['p99'] != None:
+                    compare = '{:+.0%}'.format(s['p99'] / base_p99 - 1)
+        print('{:<16} {:>8} {:>8.2f} {:>8} {:>9.1f} {:>9} {:>9} {:>9} {:>9} {:>10}'.format(
+            name, requests, 100.0 * row['errors'] / requests if requests else 0, row.get('dropped', 0), requests / result['elapsed'],
+            ms(s['p50']), ms(s['p95']), ms(s['p99']), ms(s['max']), compare))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark a nodeos chain API')
+    parser.add_argument('-H', '--host', default='localhost', help='IP or hostname to check. default = localhost')
+    parser.add_argument('-p', '--port', type=int, default=8888, help='Port number. default = 8888')
+    parser.add_argument('-s', '--ssl', action='store_true', default=False, help='Use ssl to connect to the api endpoint')
+    parser.add_argument('-t', '--timeout', type=int, default=3, help='Timeout in seconds')
+    parser.add_argument('-m', '--mix', default='get_info=40,get_block=30,get_table_rows=15,get_account=15',
+                        help='Weighted mix of calls. default = get_info=40,get_block=30,get_table_rows=15,get_account=15')
+    parser.add_argument('-c', '--concurrency', type=int, default=10,
+                        help='Requests in flight. In rate mode, maximum requests in flight. default = 10')
+    parser.add_argument('-r', '--rate', type=float, help='Requests per second. If not set, runs as fast as the concurrency allows')
+    parser.add_argument('-b', '--backlog', type=int, default=100,
+                        help='Rate mode: requests waiting for a free slot before new ones are dropped. default = 100')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='Seconds to run. default = 30')
+    parser.add_argument('--account', default='eosio', help='Account for get_account. default = eosio')
+    parser.add_argument('--table', default='eosio:eosio:global', help='code:scope:table for get_table_rows. default = eosio:eosio:global')
+    parser.add_argument('--block_range', type=int, default=1000, help='get_block asks for one of the last N blocks. default = 1000')
+    parser.add_argument('--save', help='Write the results to this json file')
+    parser.add_argument('--baseline', help='json file from a previous --save to compare with')
+    args = parser.parse_args()
+
+    try:
+        bench = Bench(args)
+    except Exception as e:
+        print('Error getting info from {}:{}: {}'.format(args.host, args.port, e))
+        sys.exit(1)
+    result = results(bench, bench.run())
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(result, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Compares the legacy <network>.lpb.json file with the lpbstore format.
+# A writer thread updates one producer per block like eoslpb.py does, while
+# reader threads look up a single account like check_eos_bp.py -c lpb does.
+
+import argparse
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import threading
+import mpu.io
+import lpbstore
+
+BLOCK_TIME = '2026-01-01T00:00:00.000'
+
+def producer_names(count):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return ['producer' + letters[i // 676 % 26] + letters[i // 26 % 26] + letters[i % 26] for i in range(count)]
+
+def json_writer(path, producers):
+    data = {'producers': producers[:21]}
+    for p in producers:
+        data[p] = {'last_block_produced_time': BLOCK_TIME, 'last_block_produced': 1}
+    def write(block_num):
+        p = producers[block_num % len(producers)]
+        data[p]['last_block_produced'] = block_num
+        data[p]['last_block_produced_time'] = lpbstore.ms_to_time(block_num * 500)
+        data['last_block_num'] = block_num
+        mpu.io.write(path, data)
+    return write
+
+def json_reader(path):
+    def read(account):
+        lpb = mpu.io.read(path)
+        return lpb[account] if account in lpb['producers'] else None
+    return read
+
+def store_writer(path, producers):
+    store = lpbstore.LpbStore(path)
+    for p in producers:
+        store.update(p, BLOCK_TIME, 1)
+    store.set_producers(producers[:21])
+    store.flush()
+    def write(block_num):
+        p = producers[block_num % len(producers)]
+        store.update(p, lpbstore.ms_to_time(block_num * 500), block_num)
+        store.set_last_block(block_num, lpbstore.ms_to_time(block_num * 500))
+        store.flush()
+    return write
+
+def store_reader(path):
+    def read(account):
+        return lpbstore.read_producer(path, account)[1]
+    return read
+
+def time_calls(fn, args):
+    start = time.perf_counter()
+    for a in args:
+        fn(a)
+    return (time.perf_counter() - start) / len(args)
+
+def run_concurrent(write, read, producers, duration, readers, rate):
+    stop = threading.Event()
+    errors = [0]
+    reads = [0]
+    lock = threading.Lock()
+
+    def writer():
+        block_num = 2
+        while not stop.is_set():
+            write(block_num)
+            block_num += 1
+            time.sleep(0.0005)
+
+    def reader():
+        interval = readers / float(rate)
+        while not stop.is_set():
+            try:
+                read(random.choice(producers[:21]))
+                ok = True
+            except Exception:
+                ok = False
+            with lock:
+                reads[0] += 1
+                if not ok:
+                    errors[0] += 1
+            time.sleep(interval)
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    return reads[0], errors[0]
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark lpb json file vs lpb store')
+    parser.add_argument('-n', '--producers', type=int, default=300, help='Number of producers. default = 300')
+    parser.add_argument('-i', '--iterations', type=int, default=500, help='Sequential writes/reads to time. default = 500')
+    parser.add_argument('-r', '--rate', type=int, default=50, help='Checker calls per second in the concurrent run. default = 50')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Reader threads in the concurrent run. default = 4')
+    parser.add_argument('-d', '--duration', type=int, default=5, help='Seconds of the concurrent run. default = 5')
+    args = parser.parse_args()
+
+    producers = producer_names(args.producers)
+    accounts = [random.choice(producers[:21]) for _ in range(args.iterations)]
+    tmpdir = tempfile.mkdtemp()
+
+    print('{} producers, {} iterations, {} calls/s over {} readers for {}s'.format(args.producers, args.iterations, args.rate, args.threads, args.duration))
+    print('{:<8} {:>12} {:>12} {:>10} {:>10} {:>10}'.format('format', 'write (us)', 'read (us)', 'size', 'reads', 'errors'))
+    for name, make_writer, make_reader, filename in [
+            ('json', json_writer, json_reader, 'eos.lpb.json'),
+            ('store', store_writer, store_reader, 'eos.lpb')]:
+        path = os.path.join(tmpdir, filename)
+        write = make_writer(path, producers)
+        read = make_reader(path)
+        write(1)
+        write_time = time_calls(write, range(2, args.iterations + 2))
+        read_time = time_calls(read, accounts)
+        reads, errors = run_concurrent(write, read, producers, args.duration, args.threads, args.rate)
+        print('{:<8} {:>12.1f} {:>12.1f} {:>10} {:>10} {:>10}'.format(name, write_time * 1e6, read_time * 1e6, os.path.getsize(path), reads, errors))
+    shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# Cold start wall time and peak RSS of check_eos_bp.py for every check mode,
+# run against a local stand-in nodeos. Save a run with --save and compare
+# later runs with --baseline to catch import cost regressions.
+
+import argparse
+import os
+import sys
+import json
+import time
+import datetime
+import tempfile
+import threading
+import subprocess
+import statistics
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import lpbstore
+import p2p_handshake
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+CHAIN_ID = 'ab' * 32
+
+# Runs the script in the child and writes the child's own peak RSS in bytes to
+# the fd given first. The rusage of a child, and even RUSAGE_SELF, starts from
+# the peak of the process it was forked from, VmHWM is reset by exec
+LAUNCHER = '''
+import os, sys, runpy
+fd = int(sys.argv.pop(1))
+def peak():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+finally:
+    os.write(fd, str(peak()).encode())
+'''
+
+class InfoHandler(BaseHTTPRequestHandler):
+    head_block_num = 1000
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        InfoHandler.head_block_num += 1
+        body = json.dumps({
+            'head_block_num': InfoHandler.head_block_num,
+            'last_irreversible_block_num': InfoHandler.head_block_num - 300,
+            'head_block_time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+            'chain_id': CHAIN_ID
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def modes(port, peer_port, tmpdir):
+    lpb_file = os.path.join(tmpdir, 'eos.lpb')
+    store = lpbstore.LpbStore(lpb_file)
+    store.update('eosproducer1', datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3], 1)
+    store.set_producers(['eosproducer1'])
+    store.close()
+    base = ['-H', '127.0.0.1', '-p', str(port)]
+    return {
+        'http': base + ['-c', 'http'],
+        'head': base + ['-c', 'head', '-i', '0'],
+        'lib': base + ['-c', 'lib', '-i', '0'],
+        'p2p': base + ['-c', 'p2p'],
+        'handshake': ['-H', '127.0.0.1', '-p', str(peer_port), '-c', 'handshake', '--ref_api', 'http://127.0.0.1:{}'.format(port)],
+        'nodeos': ['-c', 'nodeos', '--state_dir', tmpdir],
+        'lpb': ['-c', 'lpb', '-lpb', lpb_file, '-bpa', 'eosproducer1']
+    }
+
+def run_once(argv):
+    read_fd, write_fd = os.pipe()
+    start = time.perf_counter()
+    p = subprocess.Popen([sys.executable, '-c', LAUNCHER, str(write_fd), os.path.join(SCRIPT_PATH, 'check_eos_bp.py')] + argv,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, pass_fds=(write_fd,))
+    os.close(write_fd)
+    status = p.wait()
+    wall = time.perf_counter() - start
+    with os.fdopen(read_fd) as f:
+        rss = int(f.read() or 0)
+    return wall, rss, status
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark check_eos_bp.py cold start per check mode')
+    parser.add_argument('-n', '--runs', type=int, default=10, help='Runs per mode. default = 10')
+    parser.add_argument('-m', '--modes', help='Comma separated list of modes. default = all')
+    parser.add_argument('--save', help='Write the results to this json file')
+    parser.add_argument('--baseline', help='json file from a previous --save to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative increase over the baseline before failing. default = 0.2')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), InfoHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    peer = p2p_handshake.FakePeer(0, CHAIN_ID, 1000).start()
+    tmpdir = tempfile.mkdtemp()
+    all_modes = modes(server.server_address[1], peer.port, tmpdir)
+    selected = args.modes.split(',') if args.modes else list(all_modes)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print('{:<10} {:>10} {:>10} {:>10} {:>6} {:>10}'.format('mode', 'median ms', 'min ms', 'rss MB', 'exit', 'vs base'))
+    for mode in selected:
+        runs = [run_once(all_modes[mode]) for _ in range(args.runs)]
+        walls = [r[0] for r in runs]
+        results[mode] = {
+            'median': statistics.median(walls),
+            'min': min(walls),
+            'rss': max(r[1] for r in runs),
+            'exit': runs[-1][2]
+        }
+        compare = ''
+        if mode in baseline:
+            change = results[mode]['median'] / baseline[mode]['median'] - 1
+            compare = '{:+.0%}'.format(change)
+            if change > args.tolerance or results[mode]['rss'] > baseline[mode]['rss'] * (1 + args.tolerance):
+                regressions.append(mode)
+        print('{:<10} {:>10.1f} {:>10.1f} {:>10.1f} {:>6} {:>10}'.format(mode, results[mode]['median'] * 1000, results[mode]['min'] * 1000,
+                                                                   results[mode]['rss'] / 1048576.0, results[mode]['exit'], compare))
+    server.shutdown()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4)
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
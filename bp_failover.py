@@ -1,131 +1,344 @@
 #!/usr/bin/env python3
 
 import argparse
-import requests
+import eoshttp
 import os
 import sys
+import time
 import mpu
-import subprocess
+import threading
 import logging
 import colorlog
 import inspect
+import check_eos_bp
+import tracing
 
 SCRIPT_PATH = os.path.dirname(os.path.abspath(
     inspect.getfile(inspect.currentframe())))
 
-parser = argparse.ArgumentParser(description='Handle BP failover')
-parser.add_argument("-v", '--verbose', action="store_true",
-                    dest="verbose", help='Print logged info to screen')
-parser.add_argument("-d", '--debug', action="store_true",
-                    dest="debug", help='Print debug info')
-parser.add_argument('-l', '--log_file', default='{}/{}.log'.format(SCRIPT_PATH,
-                                                                   os.path.basename(__file__).split('.')[0]), help='Log file')
-parser.add_argument('-c', '--config_file', default='{}/{}'.format(SCRIPT_PATH, 'failover_config.json'),
-                    help='json file with the check configuration. Defaults to failover_config.json')
-parser.add_argument('-b', '--check_command', default='{}/{}'.format(SCRIPT_PATH, 'check_eos_bp.py'),
-                    help='path of check_eos_bp.py command. Defaults to .')
-
-args = parser.parse_args()
-VERBOSE = args.verbose
-DEBUG = args.debug
-LOG_FILE = args.log_file
-CONFIG_FILE = args.config_file
-CHECK_COMMAND = args.check_command
-
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-formatter = colorlog.ColoredFormatter(
-    '%(log_color)s%(asctime)s - %(levelname)s - %(message)s%(reset)s')
-if DEBUG:
-    logger.setLevel(logging.DEBUG)
-if VERBOSE:
-    ch = logging.StreamHandler()
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-
-fh = logging.FileHandler(LOG_FILE)
-logger.addHandler(fh)
-fh.setFormatter(formatter)
-
-
-def exec_command(command):
-    p = subprocess.Popen(command, stdout=subprocess.PIPE)
-    (output, err) = p.communicate()
-    p_status = p.wait()
-    return (p_status, output)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Handle BP failover')
+    parser.add_argument("-v", '--verbose', action="store_true",
+                        dest="verbose", help='Print logged info to screen')
+    parser.add_argument("-d", '--debug', action="store_true",
+                        dest="debug", help='Print debug info')
+    parser.add_argument('-l', '--log_file', default='{}/{}.log'.format(SCRIPT_PATH,
+                                                                       os.path.basename(__file__).split('.')[0]), help='Log file')
+    parser.add_argument('-c', '--config_file', default='{}/{}'.format(SCRIPT_PATH, 'failover_config.json'),
+                        help='json file with the check configuration. Defaults to failover_config.json')
+    parser.add_argument('-b', '--check_command', default='{}/{}'.format(SCRIPT_PATH, 'check_eos_bp.py'),
+                        help='Deprecated. Endpoints are now probed in-process with check_eos_bp.probe_head')
+    parser.add_argument('-i', '--head_interval', type=int, default=6,
+                        help='Time in seconds to check head. Defaults to 6')
+    parser.add_argument('-t', '--timeout', type=int, default=3,
+                        help='Timeout in seconds for each get_info call. Defaults to 3')
+    parser.add_argument('-D', '--daemon', action='store_true',
+                        help='Keep running, watching every endpoint and failing over as soon as the producing one fails')
+    parser.add_argument('--probe_interval', type=float, default=0.5,
+                        help='Daemon: seconds between get_info calls to each endpoint. Defaults to 0.5')
+    parser.add_argument('--stall', type=float, default=3,
+                        help='Daemon: seconds without a new head block before an endpoint is failing. Defaults to 3')
+    parser.add_argument('--fail_after', type=int, default=2,
+                        help='Daemon: consecutive failing probes before an endpoint is down. Defaults to 2')
+    parser.add_argument('--recover_after', type=int, default=10,
+                        help='Daemon: consecutive good probes before a down endpoint can be used again. Defaults to 10')
+    parser.add_argument('--pause_retries', type=int, default=2,
+                        help='Times a failed pause of a node still producing is retried before giving up on the failover. Defaults to 2')
+    parser.add_argument('--down_timeout', type=float, default=2,
+                        help='Seconds for pausing a node already found failing, read back of its status included. '
+                             'If it does not answer in time it is treated as unreachable. Defaults to 2')
+    parser.add_argument('--verify_interval', type=float, default=30,
+                        help='Daemon: seconds between checks that exactly one endpoint is producing. Defaults to 30')
+    tracing.add_arguments(parser)
+    return parser
+
+def setup_logging(verbose, debug, log_file):
+    logger.setLevel(logging.INFO)
+    formatter = colorlog.ColoredFormatter(
+        '%(log_color)s%(asctime)s - %(levelname)s - %(message)s%(reset)s')
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    if verbose:
+        ch = logging.StreamHandler()
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    fh = logging.FileHandler(log_file)
+    logger.addHandler(fh)
+    fh.setFormatter(formatter)
+
+def describe(endpoint):
+    return '{} ({} in {}). weight: {}'.format(endpoint['host'], endpoint['desc'], endpoint['network'], endpoint['weight'])
+
+def run_all(function, endpoints, *args):
+    # Calls function(endpoint, *args) for every endpoint at the same time
+    results = [None] * len(endpoints)
+    def run(i, endpoint):
+        results[i] = function(endpoint, *args)
+    threads = [threading.Thread(target=run, args=(i, endpoint)) for i, endpoint in enumerate(endpoints)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def probe_endpoints(endpoints, head_interval, timeout):
+    # All endpoints are probed at the same time, so a decision takes about one
+    # head interval no matter how many nodes are configured
+    return run_all(lambda endpoint: check_eos_bp.probe_head(endpoint['host'], endpoint['port'], endpoint.get('https', False),
+                                                            timeout, head_interval), endpoints)
 
 def getProducerEndpoint(endpoint):
-    result = 'https' if endpoint['https'] else 'http'
+    result = 'https' if endpoint.get('https', False) else 'http'
     result = '{}://{}:{}/v1/producer/'.format(result, endpoint['host'], endpoint['port'])
     return result
 
-def enable_endpoint(endpoint):
+def enable_endpoint(endpoint, timeout = 3):
     try:
-        response = requests.post('{}resume'.format(getProducerEndpoint(endpoint)))
+        response = eoshttp.fetch('POST', '{}resume'.format(getProducerEndpoint(endpoint)), timeout=timeout)[0]
     except:
         return False
-    if response.json()['result'] == 'ok':
+    if response['result'] == 'ok':
       return True
-    else: 
+    else:
       return False
 
-def disable_endpoint(endpoint):
+def disable_endpoint(endpoint, timeout = 3):
     try:
-        response = requests.post('{}pause'.format(getProducerEndpoint(endpoint)))
+        response = eoshttp.fetch('POST', '{}pause'.format(getProducerEndpoint(endpoint)), timeout=timeout)[0]
     except:
         return False
-    if response.json()['result'] == 'ok':
+    if response['result'] == 'ok':
       return True
-    else: 
+    else:
       return False
 
-def main():
+def producer_paused(endpoint, timeout = 3):
+    # True or False as reported by /v1/producer/paused, None if it can not be read
     try:
-        config = mpu.io.read(CONFIG_FILE)
-    except Exception as e:
-        logger.critical('Error opening file: {}'.format(e))
-        quit()
+        response = eoshttp.fetch('POST', '{}paused'.format(getProducerEndpoint(endpoint)), timeout=timeout)[0]
+    except:
+        return None
+    return response if isinstance(response, bool) else None
+
+def ensure_paused(endpoint, timeout, retries, down = None, retry_interval = 1):
+    # True once the endpoint is paused or its paused status can not be read
+    # (node down or not answering). A node that fails to pause but still
+    # reports it is producing is retried, then given up on. For a node the
+    # monitor already marked down the pause and the read back share the
+    # `down` budget: a pause that used it up means the node is not answering
+    for attempt in range(retries + 1):
+        start = time.monotonic()
+        if disable_endpoint(endpoint, down or timeout):
+            return True
+        read_timeout = down - (time.monotonic() - start) if down else timeout
+        if read_timeout < 0.1 or producer_paused(endpoint, read_timeout) != False:
+            return True
+        logger.critical('Error disabling endpoint, still producing: {}'.format(describe(endpoint)))
+        if attempt < retries:
+            time.sleep(retry_interval)
+    return False
+
+def activate(candidates, endpoints, timeout, retries = 2, down = (), down_timeout = 2):
+    # Every other endpoint is paused before the chosen one is resumed, so two
+    # nodes never produce at the same time. Nothing is resumed while a node
+    # that could not be paused still reports it is producing. `down` are the
+    # endpoints known to be failing, they get down_timeout seconds to pause.
+    # Returns the producing endpoint
+    others = [e for e in endpoints if not e is candidates[0]]
+    blocked = []
+    pause = lambda endpoint: ensure_paused(endpoint, timeout, retries, down_timeout if any(endpoint is d for d in down) else None)
+    for endpoint, paused in zip(others, run_all(pause, others)):
+        if paused:
+            logger.info('Disabled endpoint: {}'.format(describe(endpoint)))
+        else:
+            blocked.append(endpoint)
+    if blocked:
+        logger.critical('Not resuming {} while {} still producing'.format(describe(candidates[0]), ', '.join(describe(e) for e in blocked)))
+        return None
+
+    for endpoint in candidates:
+        if enable_endpoint(endpoint, timeout):
+            logger.info('Active endpoint: {}'.format(describe(endpoint)))
+            return endpoint
+        logger.critical('Error enabling endpoint: {}'.format(describe(endpoint)))
+        if not ensure_paused(endpoint, timeout, retries):
+            return None
+    return None
+
+def verify(endpoints, timeout):
+    # Reads back the paused status of every endpoint. Returns the endpoints
+    # producing and the ones whose status could not be read
+    statuses = run_all(producer_paused, endpoints, timeout)
+    producing = [e for e, paused in zip(endpoints, statuses) if paused == False]
+    unknown = [e for e, paused in zip(endpoints, statuses) if paused == None]
+    for endpoint in unknown:
+        logger.warning('Could not read paused status of {}'.format(describe(endpoint)))
+    if len(producing) == 1:
+        logger.info('Verified {} is the only producing endpoint'.format(describe(producing[0])))
+    else:
+        logger.critical('{} endpoints producing: {}'.format(len(producing), ', '.join(describe(e) for e in producing)))
+    return producing, unknown
 
-    endpoints = config['endpoints']
+def by_weight(endpoints):
+    return sorted(endpoints, key=lambda k: k['weight'], reverse=True)
+
+class EndpointMonitor:
+    # Polls get_info of one endpoint from its own thread. The endpoint goes
+    # down after fail_after failing probes in a row, or when no probe has been
+    # good for `stall` seconds so a node answering slowly is caught as fast as
+    # a stalled one. It only comes back after recover_after good probes, so a
+    # flapping node does not cause churn. A probe fails if the call fails, the
+    # head has not moved for `stall` seconds or the head block is older than
+    # 30 seconds.
+    def __init__(self, endpoint, changed, timeout, interval, stall, fail_after, recover_after):
+        self.endpoint = endpoint
+        self.changed = changed
+        self.timeout = timeout
+        self.interval = interval
+        self.stall = stall
+        self.fail_after = fail_after
+        self.recover_after = recover_after
+        self.healthy = None
+        self.good = 0
+        self.bad = 0
+        self.head_block_num = None
+        self.head_changed = None
+        self.message = ''
+        self.last_good = time.monotonic()
+
+    def sample(self):
+        import datetime
+        try:
+            j_response, latency, timings = check_eos_bp.request_info(self.endpoint['host'], self.endpoint['port'],
+                                                                     self.endpoint.get('https', False), self.timeout)
+        except Exception as e:
+            return False, eoshttp.nagios_error(e, True)[1]
+        now = time.monotonic()
+        head_block_num = int(j_response['head_block_num'])
+        if self.head_block_num == None or head_block_num > self.head_block_num:
+            self.head_block_num = head_block_num
+            self.head_changed = now
+        if now - self.head_changed > self.stall:
+            return False, 'head not advancing for {:.1f}s. Last block {}'.format(now - self.head_changed, self.head_block_num)
+        head_block_time = datetime.datetime.strptime(j_response['head_block_time'], "%Y-%m-%dT%H:%M:%S.%f")
+        if (datetime.datetime.utcnow() - head_block_time).total_seconds() > 30:
+            return False, 'syncing. Last block time {}'.format(j_response['head_block_time'])
+        return True, 'head {} latency {}s'.format(head_block_num, latency)
+
+    def update(self, ok, message):
+        self.message = message
+        self.good, self.bad = (self.good + 1, 0) if ok else (0, self.bad + 1)
+        if ok:
+            self.last_good = time.monotonic()
+        healthy = self.healthy
+        if self.healthy == None:
+            healthy = ok
+        elif self.healthy and self.bad and (self.bad >= self.fail_after or time.monotonic() - self.last_good > self.stall):
+            healthy = False
+        elif not self.healthy and self.good >= self.recover_after:
+            healthy = True
+        if healthy != self.healthy:
+            level = logging.INFO if healthy else logging.CRITICAL
+            logger.log(level, '{} is {}: {}'.format(describe(self.endpoint), 'up' if healthy else 'down', message))
+            self.healthy = healthy
+            self.changed.set()
+
+    def run(self):
+        # The first verdict waits for the stall window so a stalled node is
+        # not taken for a working one at startup
+        start = time.monotonic()
+        while True:
+            next_probe = time.monotonic() + self.interval
+            ok, message = self.sample()
+            logger.debug('{}:{} {}'.format(self.endpoint['host'], self.endpoint['port'], message))
+            if self.healthy != None or time.monotonic() - start > self.stall:
+                self.update(ok, message)
+            time.sleep(max(next_probe - time.monotonic(), 0))
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+def watch(endpoints, args):
+    changed = threading.Event()
+    monitors = [EndpointMonitor(endpoint, changed, args.timeout, args.probe_interval, args.stall,
+                                args.fail_after, args.recover_after).start() for endpoint in endpoints]
+    while any(m.healthy == None for m in monitors):
+        changed.wait(args.probe_interval)
+        changed.clear()
+
+    # Keeps the endpoint already producing if it is healthy
+    healthy = [m.endpoint for m in monitors if m.healthy]
+    producing, unknown = verify(endpoints, args.timeout)
+    current = by_weight([e for e in producing if e in healthy])
+    active = current[0] if current else None
+    last_verify = time.monotonic()
+    while True:
+        healthy = [m.endpoint for m in monitors if m.healthy]
+        if active != None and not active in healthy:
+            logger.critical('Failing over from {}'.format(describe(active)))
+            active = None
+        if active == None and healthy:
+            with tracing.span('failover', healthy=len(healthy)):
+                active = activate(by_weight(healthy), endpoints, args.timeout, args.pause_retries,
+                                  [e for e in endpoints if not e in healthy], args.down_timeout)
+                producing, unknown = verify(endpoints, args.timeout)
+            last_verify = time.monotonic()
+        elif active == None:
+            logger.critical('No active enpoints found!!!!')
+        elif time.monotonic() - last_verify >= args.verify_interval:
+            with tracing.span('verify'):
+                producing, unknown = verify(endpoints, args.timeout)
+            last_verify = time.monotonic()
+        if active != None and (len(producing) != 1 or not producing[0] is active):
+            # A node was paused or resumed by someone else
+            active = activate([active], endpoints, args.timeout, args.pause_retries)
+            producing, unknown = verify(endpoints, args.timeout)
+        # A failover blocked by a node that could not be paused is retried soon
+        retry = 1 if active == None and healthy else args.verify_interval
+        changed.wait(max(retry - (time.monotonic() - last_verify), 0.1))
+        changed.clear()
+
+def failover_once(endpoints, args):
     working_endpoints = []
-    failing_endpoints = []
-
-    for endpoint in endpoints:
-        command = [CHECK_COMMAND,
-                   '-H', endpoint['host'],
-                   '-p', str(endpoint['port']),
-                   '-c', 'head',
-                   '-i', '6'
-                   ]
-        p_state, output = exec_command(command)
-        if p_state == 0:
-            logger.info('{}:{} ({} in {}) is working fine: {}'.format(endpoint['host'], endpoint['port'], endpoint['desc'], endpoint['network'], output))
+
+    with tracing.span('probe_endpoints', endpoints=len(endpoints)):
+        results = probe_endpoints(endpoints, args.head_interval, args.timeout)
+    for endpoint, result in zip(endpoints, results):
+        if result['status'] == check_eos_bp.SERVICE_STATUS['OK']:
+            logger.info('{}:{} ({} in {}) is working fine: head {} latency {}s: {}'.format(endpoint['host'], endpoint['port'], endpoint['desc'], endpoint['network'], result['head_block_num'], result['latency'], result['message']))
             working_endpoints.append(endpoint)
         else:
-            logger.critical('{}:{} ({} in {}) is not responding: {}'.format(endpoint['host'], endpoint['port'], endpoint['desc'], endpoint['network'], output))
-            failing_endpoints.append(endpoint)
+            logger.critical('{}:{} ({} in {}) is not responding: {}'.format(endpoint['host'], endpoint['port'], endpoint['desc'], endpoint['network'], result['message']))
 
     if len(working_endpoints) == 0:
         logger.critical('No active enpoints found!!!!')
         quit()
 
-    working_endpoints = sorted(
-        working_endpoints, key=lambda k: k['weight'], reverse=True)
-    for endpoint in working_endpoints:
-        if enable_endpoint(endpoint):
-            logger.info('Active endpoint: {} ({} in {}). weight: {}'.format(
-                endpoint['host'], endpoint['desc'], endpoint['network'], endpoint['weight']))
-            working_endpoints.remove(endpoint)
-            break
-
-    for endpoint in working_endpoints + failing_endpoints:
-        if disable_endpoint(endpoint):
-            logger.info('Disabled endpoint: {} ({} in {}). weight: {}'.format(
-                endpoint['host'], endpoint['desc'], endpoint['network'], endpoint['weight']))
-        else:
-            logger.critical('Error disabling endpoint: {} ({} in {}). weight: {}'.format(
-                endpoint['host'], endpoint['desc'], endpoint['network'], endpoint['weight']))
+    with tracing.span('activate'):
+        activate(by_weight(working_endpoints), endpoints, args.timeout, args.pause_retries,
+                 [e for e in endpoints if not e in working_endpoints], args.down_timeout)
+    with tracing.span('verify'):
+        verify(endpoints, args.timeout)
+
+def main(argv):
+    args = build_parser().parse_args()
+    setup_logging(args.verbose, args.debug, args.log_file)
+    tracing.configure_from(args)
+    try:
+        config = mpu.io.read(args.config_file)
+    except Exception as e:
+        logger.critical('Error opening file: {}'.format(e))
+        quit()
+
+    if args.daemon:
+        watch(config['endpoints'], args)
+    else:
+        failover_once(config['endpoints'], args)
 
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv)
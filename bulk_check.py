@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Runs every check of an inventory in one process and prints the results in
+# Nagios passive check format or as json. The inventory lists hosts and the
+# checks of each one (see sample_inventory.json); -H is set to the address of
+# the host, the args of a check can override it.
+#
+# All checks start at once, each after a random delay of up to --jitter
+# seconds, with at most --workers checks running in total and --per_host
+# against the same host. Checks of the same host share one get_info request.
+# head and lib checks of check_eos_bp.py run in stateful mode unless
+# --allow_sleep is given, so a sweep does not wait head_interval.
+
+import argparse
+import sys
+import json
+import time
+import shlex
+import random
+import logging
+import threading
+import collections
+import concurrent.futures
+import check_daemon
+import tracing
+from nagios import SERVICE_STATUS
+
+logger = logging.getLogger(__name__)
+
+def load_inventory(inventory, allow_sleep):
+    # Returns check_daemon checks with the host_name and service of each one
+    entries = []
+    for host in inventory['hosts']:
+        for c in host['checks']:
+            argv = shlex.split(c['args']) if isinstance(c['args'], str) else [str(a) for a in c['args']]
+            entries.append({
+                'name': '{}/{}'.format(host['host_name'], c['service']),
+                'host_name': host['host_name'],
+                'service': c['service'],
+                'script': c['script'],
+                'args': ['-H', host.get('address', host['host_name'])] + argv
+            })
+    checks = check_daemon.load_checks({'checks': entries})
+    for check, entry in zip(checks, entries):
+        check['host_name'], check['service'] = entry['host_name'], entry['service']
+        args = check['args']
+        if not allow_sleep and getattr(args, 'check', None) in ['head', 'lib']:
+            args.stateful = True
+    return checks
+
+def interleave(checks):
+    # One check of every host in turn, so workers waiting for a busy host are rare
+    by_host = collections.OrderedDict()
+    for check in checks:
+        by_host.setdefault(check['args'].host, []).append(check)
+    ordered = []
+    while by_host:
+        for host in list(by_host):
+            ordered.append(by_host[host].pop(0))
+            if not by_host[host]:
+                del by_host[host]
+    return ordered
+
+def sweep(checks, workers, per_host, jitter, share_window):
+    cache = check_daemon.RequestCache(share_window)
+    host_limits = collections.defaultdict(lambda: threading.Semaphore(per_host))
+    limits_lock = threading.Lock()
+
+    def run(check):
+        time.sleep(random.uniform(0, jitter))
+        with limits_lock:
+            limit = host_limits[check['args'].host]
+        with limit:
+            with tracing.span('check', check=check['name']):
+                start = time.perf_counter()
+                status, output = check_daemon.run_check(check, cache)
+        return {
+            'host_name': check['host_name'],
+            'service': check['service'],
+            'status': status,
+            'output': output,
+            'duration': round(time.perf_counter() - start, 6),
+            'timestamp': int(time.time())
+        }
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, interleave(checks)))
+
+def passive_result(result):
+    # External command for the Nagios command file
+    return '[{}] PROCESS_SERVICE_CHECK_RESULT;{};{};{};{}'.format(result['timestamp'], result['host_name'], result['service'],
+                                                                  result['status'], result['output'].replace('\n', '\\n'))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run every check of an inventory concurrently and print the results')
+    parser.add_argument('-i', '--inventory', default='inventory.json', help='json inventory of hosts and checks. default = inventory.json')
+    parser.add_argument('-f', '--format', default='nagios', choices=['nagios', 'json'],
+                        help='nagios: passive check results, one per line. json: a list of results. default = nagios')
+    parser.add_argument('-o', '--output', default='-',
+                        help='File to write the results to, e.g. the Nagios command file. default = stdout')
+    parser.add_argument('-w', '--workers', type=int, default=128, help='Checks running at the same time. default = 128')
+    parser.add_argument('-P', '--per_host', type=int, default=4, help='Checks running at the same time against one host. default = 4')
+    parser.add_argument('-j', '--jitter', type=float, default=0.5, help='Maximum random delay before each check starts. default = 0.5')
+    parser.add_argument('-s', '--share_window', type=float, default=1.0,
+                        help='Seconds during which checks of the same host share a get_info response. default = 1')
+    parser.add_argument('--allow_sleep', action='store_true',
+                        help='Run head and lib checks as configured, sleeping head_interval unless they use -S')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log a summary of the sweep to stderr')
+    tracing.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO if args.verbose else logging.WARNING)
+    tracing.configure_from(args)
+
+    with open(args.inventory) as f:
+        checks = load_inventory(json.load(f), args.allow_sleep)
+    start = time.perf_counter()
+    results = sweep(checks, args.workers, args.per_host, args.jitter, args.share_window)
+    counts = collections.Counter(r['status'] for r in results)
+    logger.info('{} checks in {:.2f}s: {}'.format(len(results), time.perf_counter() - start,
+                                                   ', '.join('{} {}'.format(counts[v], k) for k, v in SERVICE_STATUS.items())))
+
+    if args.format == 'json':
+        text = json.dumps(results, indent=4) + '\n'
+    else:
+        text = ''.join(passive_result(r) + '\n' for r in results)
+    if args.output == '-':
+        sys.stdout.write(text)
+    else:
+        # Passive results are appended to the command file, json replaces the file
+        with open(args.output, 'a' if args.format == 'nagios' else 'w') as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,42 +1,62 @@
 #!/usr/bin/python3
 
 import sys
+import re
 import argparse
-import requests
+import concurrent.futures
+import eoshttp
+import nagios
+import tracing
+from histogram import LatencyHistogram
+from nagios import SERVICE_STATUS
 
-SERVICE_STATUS = {
-    'OK': 0,
-    'WARNING': 1,
-    'CRITICAL': 2,
-    'UNKNOWN': 3
+# Heavy queries run with --collection / --owner. A query runs only when the
+# parameters it needs are given
+QUERIES = {
+    'assets_collection': '/atomicassets/v1/assets?collection_name={collection}&page=1&limit=100&order=desc&sort=asset_id',
+    'assets_owner': '/atomicassets/v1/assets?owner={owner}&page=1&limit=100&order=desc&sort=asset_id',
+    'sales': '/atomicmarket/v1/sales?state=1&collection_name={collection}&page=1&limit=100&order=desc&sort=created',
+    'transfers': '/atomicassets/v1/transfers?collection_name={collection}&page=1&limit=100&order=desc&sort=created'
 }
 
 def get_health(HOST, PORT, SSL, TIMEOUT, VERBOSE):
-    try:
-        response = requests.get('{}://{}:{}/health'.format('http' if not SSL else 'https', HOST, PORT), timeout=TIMEOUT)
-        if response.status_code != 200:
-            print('HTTP CRITICAL: The server couldn\'t fulfill the request. Error code: {}'.format(response.status_code))
-            sys.exit(SERVICE_STATUS['CRITICAL'])
-        j_response = response.json()
-    except requests.exceptions.HTTPError as e:
-        print('HTTP CRITICAL: The server couldn\'t fulfill the request. Error code: {}'.format(e.response.status_code))
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-        print('HTTP CRITICAL: Failed to reach server. Reason: Timeout or Connection Error')
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except requests.exceptions.RequestException as e:
-        print('HTTP CRITICAL: Failed to reach server. Reason: {}'.format(e))
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except Exception as e:
-        print('HTTP CRITICAL: Failed to reach server. Reason: Unknown')
-        if VERBOSE:
-            print(e)
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    performance_data = response.elapsed.total_seconds()
+    j_response, response = eoshttp.checked_fetch('GET', eoshttp.url(HOST, PORT, SSL, '/health'), TIMEOUT, VERBOSE)
+    performance_data = response.elapsed
     return j_response, performance_data
 
+def build_queries(COLLECTION, OWNER, CUSTOM):
+    params = {'collection': COLLECTION, 'owner': OWNER}
+    queries = {}
+    for name, path in QUERIES.items():
+        if all(params[p] for p in re.findall(r'{(\w+)}', path)):
+            queries[name] = path.format(**params)
+    for query in CUSTOM:
+        name, _, path = query.partition('=')
+        queries[name] = path
+    return queries
 
-def main(argv):
+def timed_query(HOST, PORT, SSL, TIMEOUT, path):
+    response = eoshttp.fetch('GET', eoshttp.url(HOST, PORT, SSL, path), timeout=TIMEOUT)[1]
+    return response.elapsed
+
+def run_queries(HOST, PORT, SSL, TIMEOUT, queries, RUNS, CONCURRENCY):
+    # Runs every query RUNS times, CONCURRENCY requests at a time. Returns the
+    # latency histogram of each query and the first error of the failed ones
+    histograms = {name: LatencyHistogram() for name in queries}
+    errors = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        futures = {executor.submit(timed_query, HOST, PORT, SSL, TIMEOUT, path): name
+                   for name, path in queries.items() for _ in range(RUNS)}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                histograms[name].record(future.result())
+            except Exception as e:
+                errors.setdefault(name, e)
+    return histograms, errors
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description='Check BP status')
     parser.add_argument('-v', '--verbose', action='store_true', help = 'Print verbose logging to stdout')
     parser.add_argument('-H', '--host', default='localhost',
@@ -49,33 +69,42 @@ def main(argv):
                         help='warning threshold of head block - last indexed block. default 10')
     parser.add_argument('-c', '--critical', type=int, default='100',
                         help='critical threshold of head block - last indexed block. default 100')
-    
-    args = parser.parse_args()
+    parser.add_argument('-C', '--collection', help='Collection for the heavy queries: assets, sales and transfers of it')
+    parser.add_argument('-O', '--owner', help='Account for the heavy query of the assets it owns')
+    parser.add_argument('-q', '--query', action='append', default=[],
+                        help='Extra heavy query as NAME=PATH, e.g. offers=/atomicmarket/v1/offers?limit=100. Can be repeated')
+    parser.add_argument('-r', '--runs', type=int, default=3, help='Times each heavy query runs. default = 3')
+    parser.add_argument('-P', '--concurrency', type=int, default=4, help='Heavy queries in flight at the same time. default = 4')
+    parser.add_argument('--query_warning', type=float, default=1.0,
+                        help='warning threshold of the p95 latency of the heavy queries in seconds. default 1')
+    parser.add_argument('--query_critical', type=float, default=5.0,
+                        help='critical threshold of the p95 latency of the heavy queries in seconds. default 5')
+    tracing.add_arguments(parser)
+    return parser
+
+def check(args, cache = None):
     HOST = args.host
     TIMEOUT = args.timeout
     PORT = args.port
     SSL = args.ssl
     VERBOSE = args.verbose
-    W_THRESHOLD = args.critical
-    C_THRESHOLD = args.warning
+    W_THRESHOLD = args.warning
+    C_THRESHOLD = args.critical
 
     output_message = ''
     output_status = SERVICE_STATUS['OK']
     response, http_query_time = get_health(HOST, PORT, SSL, TIMEOUT, VERBOSE)
-    
-    #services = response['health']
-    #elastic_service = list(filter(lambda service: service['service'] == 'Elasticsearch', services))[0]
-    #nodeos_service = list(filter(lambda service: service['service'] == 'NodeosRPC', services))[0]
+    performance_data = ['http_query_time={}s'.format(http_query_time)]
+
+    #Check every reader's last indexed block vs head_block
     head_block = response['data']['chain']['head_block']
-    last_indexed_block = int(response['data']['postgres']['readers'][0]['block_num'])
-    
-    #Check last indexed block vs head_block
-    index_gap = abs(head_block - last_indexed_block)
-    if index_gap > W_THRESHOLD:
-        output_message += "{} blocks gap between head and last indexed block. ".format(index_gap)
-        output_status = SERVICE_STATUS['WARNING']
-        if index_gap > C_THRESHOLD:
-            output_status = SERVICE_STATUS['CRITICAL']
+    for i, reader in enumerate(response['data']['postgres']['readers']):
+        name = reader.get('name') or str(i)
+        index_gap = abs(head_block - int(reader['block_num']))
+        performance_data.append("'reader_{}_lag'={};{};{}".format(name, index_gap, W_THRESHOLD, C_THRESHOLD))
+        if index_gap > W_THRESHOLD:
+            output_message += "Reader {}: {} blocks gap between head and last indexed block. ".format(name, index_gap)
+            output_status = max(output_status, SERVICE_STATUS['CRITICAL'] if index_gap > C_THRESHOLD else SERVICE_STATUS['WARNING'])
 
     #Check services status
     services = [response['data']['postgres'], response['data']['redis'], response['data']['chain']]
@@ -84,10 +113,36 @@ def main(argv):
         output_message += "Services not OK: {}. ".format(services_not_ok)
         output_status = SERVICE_STATUS['CRITICAL']
 
+    #Check the latency of the heavy queries
+    queries = build_queries(args.collection, args.owner, args.query)
+    if queries:
+        with tracing.span('heavy_queries', queries=len(queries), runs=args.runs):
+            histograms, errors = run_queries(HOST, PORT, SSL, TIMEOUT, queries, args.runs, args.concurrency)
+        for name, e in sorted(errors.items()):
+            output_message += "Query {} failed: {}. ".format(name, eoshttp.nagios_error(e, VERBOSE)[1].replace('HTTP CRITICAL: ', ''))
+            output_status = SERVICE_STATUS['CRITICAL']
+        combined = LatencyHistogram()
+        for name, histogram in sorted(histograms.items()):
+            combined.merge(histogram)
+            if histogram.count:
+                performance_data.append("'query_{}'={:.6f}s".format(name, histogram.percentile(50)))
+        if combined.count:
+            p95 = combined.percentile(95)
+            performance_data.append('query_p50={:.6f}s query_p95={:.6f}s;{};{} query_p99={:.6f}s'.format(
+                combined.percentile(50), p95, args.query_warning, args.query_critical, combined.percentile(99)))
+            if p95 > args.query_warning:
+                slowest = max((h.percentile(95), name) for name, h in histograms.items() if h.count)[1]
+                output_message += "Heavy queries p95 {:.2f}s, slowest {}. ".format(p95, slowest)
+                output_status = max(output_status, SERVICE_STATUS['CRITICAL'] if p95 > args.query_critical else SERVICE_STATUS['WARNING'])
+
     if not output_message: 
         output_message = 'Everything Ok'
-    print('{} | http_query_time={}s'.format(output_message.rstrip(), http_query_time))
-    sys.exit(output_status)
+    return output_status, '{} | {}'.format(output_message.rstrip(), ' '.join(performance_data))
+
+def main(argv):
+    args = build_parser().parse_args()
+    tracing.configure_from(args)
+    nagios.exit_with(check, args)
 
 if __name__ == "__main__":
     main(sys.argv)
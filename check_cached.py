@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+
+# Thin Nagios client for check_daemon.py. Only uses the standard library so it
+# answers in a few milliseconds with the output and exit code of the check.
+
+import sys
+import os
+import time
+import argparse
+
+SERVICE_STATUS = {
+    'OK': 0,
+    'WARNING': 1,
+    'CRITICAL': 2,
+    'UNKNOWN': 3
+}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Print the cached result of a check run by check_daemon.py')
+    parser.add_argument('-n', '--name', required=True, help='Check name in the check_daemon.py config')
+    parser.add_argument('-d', '--cache_dir', default='/var/tmp/eos-checks',
+                        help='Directory where check_daemon.py stores results. default = /var/tmp/eos-checks')
+    parser.add_argument('-m', '--max_age', type=int, default=300,
+                        help='Results older than this many seconds are UNKNOWN. default = 300')
+    args = parser.parse_args()
+
+    path = os.path.join(args.cache_dir, args.name)
+    try:
+        with open(path) as f:
+            age = time.time() - os.fstat(f.fileno()).st_mtime
+            status = int(f.readline())
+            output = f.read().rstrip('\n')
+    except Exception as e:
+        print('UNKNOWN: No cached result for {}: {}'.format(args.name, e))
+        sys.exit(SERVICE_STATUS['UNKNOWN'])
+
+    if age > args.max_age:
+        print('UNKNOWN: Cached result for {} is {} seconds old'.format(args.name, int(age)))
+        sys.exit(SERVICE_STATUS['UNKNOWN'])
+
+    print(output)
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import time
+import json
+import shlex
+import heapq
+import random
+import logging
+import tempfile
+import threading
+import concurrent.futures
+import nagios
+import check_eos_bp
+import check_hyperion
+import check_atomic
+import check_lightapi
+from nagios import SERVICE_STATUS
+
+SCRIPTS = {
+    'check_eos_bp': check_eos_bp,
+    'check_hyperion': check_hyperion,
+    'check_atomic': check_atomic,
+    'check_lightapi': check_lightapi
+}
+
+logger = logging.getLogger(__name__)
+
+class RequestCache:
+    # Calls made for the same key within max_age seconds share one request.
+    # Concurrent callers wait for the request already in flight instead of
+    # sending their own, and get its result or its exception
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, fetch):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None or (entry['done'].is_set() and time.time() - entry['time'] > self.max_age):
+                entry = {'time': time.time(), 'done': threading.Event(), 'result': None, 'error': None}
+                self.entries[key] = entry
+                owner = True
+            else:
+                owner = False
+        if owner:
+            try:
+                entry['result'] = fetch()
+            except Exception as e:
+                entry['error'] = e
+            entry['time'] = time.time()
+            entry['done'].set()
+        else:
+            entry['done'].wait()
+        if entry['error'] != None:
+            raise entry['error']
+        return entry['result']
+
+def load_checks(config):
+    checks = []
+    for c in config['checks']:
+        if not c['script'] in SCRIPTS:
+            raise ValueError('Unknown script {} in check {}'.format(c['script'], c['name']))
+        module = SCRIPTS[c['script']]
+        argv = shlex.split(c['args']) if isinstance(c['args'], str) else [str(a) for a in c['args']]
+        try:
+            args = module.build_parser().parse_args(argv)
+        except SystemExit:
+            raise ValueError('Invalid arguments for check {}: {}'.format(c['name'], argv))
+        checks.append({
+            'name': c['name'],
+            'module': module,
+            'args': args,
+            'interval': c.get('interval', config.get('interval', 60))
+        })
+    return checks
+
+def run_check(check, cache):
+    try:
+        return nagios.run(check['module'].check, check['args'], cache=cache)
+    except Exception as e:
+        return SERVICE_STATUS['UNKNOWN'], 'UNKNOWN: {} failed: {}'.format(check['name'], e)
+
+def write_result(cache_dir, name, status, output):
+    # Written to a temporary file and renamed, so check_cached.py never reads a
+    # half written result
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.{}.'.format(name))
+    with os.fdopen(fd, 'w') as f:
+        f.write('{}\n{}\n'.format(status, output))
+    os.rename(tmp, os.path.join(cache_dir, name))
+
+def serve(checks, workers, share_window, on_result):
+    # Runs every check on its interval and calls on_result(check, status,
+    # output, duration) with each result
+    cache = RequestCache(share_window)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    running = {}
+    # Spread the first run of every check over its interval
+    queue = [(time.time() + random.uniform(0, min(c['interval'], 5)), i) for i, c in enumerate(checks)]
+    heapq.heapify(queue)
+
+    def run(i):
+        start = time.perf_counter()
+        status, output = run_check(checks[i], cache)
+        return status, output, time.perf_counter() - start
+
+    def done(i, future):
+        status, output, duration = future.result()
+        try:
+            on_result(checks[i], status, output, duration)
+        except Exception as e:
+            logger.error('{}: error handling result: {}'.format(checks[i]['name'], e))
+        logger.debug('{}: {} {}'.format(checks[i]['name'], status, output))
+        running.pop(i, None)
+
+    while True:
+        next_run, i = heapq.heappop(queue)
+        delay = next_run - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if i in running:
+            logger.warning('{} is still running, skipping this round'.format(checks[i]['name']))
+        else:
+            running[i] = executor.submit(run, i)
+            running[i].add_done_callback(lambda future, i=i: done(i, future))
+        heapq.heappush(queue, (next_run + checks[i]['interval'], i))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run checks on a schedule and cache their results for check_cached.py')
+    parser.add_argument('-c', '--config_file', default='check_daemon.json',
+                        help='json file with the checks to run. default = check_daemon.json')
+    parser.add_argument('-d', '--cache_dir', default='/var/tmp/eos-checks',
+                        help='Directory where results are stored. default = /var/tmp/eos-checks')
+    parser.add_argument('-w', '--workers', type=int, default=32,
+                        help='Checks running at the same time. default = 32')
+    parser.add_argument('-s', '--share_window', type=float, default=1.0,
+                        help='Seconds during which checks of the same host share a get_info response. default = 1')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every result')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    with open(args.config_file) as f:
+        checks = load_checks(json.load(f))
+    os.makedirs(args.cache_dir, exist_ok=True)
+    logger.info('Running {} checks'.format(len(checks)))
+    serve(checks, args.workers, args.share_window,
+          lambda check, status, output, duration: write_result(args.cache_dir, check['name'], status, output))
+
+if __name__ == "__main__":
+    main(sys.argv)
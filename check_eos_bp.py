@@ -2,36 +2,76 @@
 
 import sys
 import argparse
-import urllib.request
-from urllib.error import URLError, HTTPError
-import socket
-import psutil
-import re
-import requests
-import threading
-import datetime
-import mpu.io
 import time
+import nagios
+import statestore
+import tracing
+from nagios import SERVICE_STATUS, CheckResult
 
-SERVICE_STATUS = {
-    'OK': 0,
-    'WARNING': 1,
-    'CRITICAL': 2,
-    'UNKNOWN': 3
-}
+# Everything else is imported by the checks that need it. These scripts run
+# thousands of times per hour, so a p2p check should not pay for psutil or
+# the HTTP client. http, head, lib and p2p only use the standard library.
 
-def get_lpb(lpb_file):
+CHECKS = ['http', 'head', 'lib', 'p2p', 'handshake', 'nodeos', 'lpb', 'fork', 'ship', 'missed']
+
+def get_lpb(lpb_file, bp_account):
+    # Returns the store header and the lpb record of a single account. The
+    # record is None if it is not in the current schedule. Legacy .json files
+    # are parsed as a whole and have no header
+    header = None
     try:
-        result = mpu.io.read(lpb_file)
+        if lpb_file.endswith('.json'):
+            import mpu.io
+            lpb = mpu.io.read(lpb_file)
+            if not bp_account in lpb['producers']:
+                return header, None
+            result = lpb.get(bp_account, {'last_block_produced_time': None})
+        else:
+            import lpbstore
+            header, result = lpbstore.read_producer(lpb_file, bp_account)
+            if result == None or not result['scheduled']:
+                return header, None
     except Exception as e:
-        print('ERROR: {}'.format(str(e)))
-        sys.exit(SERVICE_STATUS['CRITICAL'])
+        raise CheckResult(SERVICE_STATUS['CRITICAL'], 'ERROR: {}'.format(str(e)))
 
-    return result
+    return header, result
+
+def turn_status(header, lpb, BPA, MISSED_BLOCKS):
+    # Judges the last full turn of the account from the schedule. Returns None
+    # when the store does not count turns (json or info mode)
+    import lpbstore
+    import producer_schedule
+    if header == None or not header['counts_turns'] or not header['last_block_time'] or not header['schedule_size']:
+        return None
+    slot = producer_schedule.ms_to_slot(lpbstore.time_to_ms(header['last_block_time']))
+    turn = producer_schedule.last_turn(lpb['schedule_position'], header['schedule_size'], slot)
+    next_turn = producer_schedule.next_turn(lpb['schedule_position'], header['schedule_size'], slot)
+    secs_to_next = (next_turn - slot) * producer_schedule.BLOCK_INTERVAL_MS / 1000.0
+    if turn < header['schedule_slot']:
+        return SERVICE_STATUS['OK'], '{} has not had a full turn since schedule version {}. Next turn in {:.1f}s'.format(BPA, header['schedule_version'], secs_to_next)
+    if lpb['turn_slot'] > turn:
+        blocks = lpb['turn_blocks']
+        return SERVICE_STATUS['OK'], '{} is producing, {} blocks so far in this turn | blocks={};;;0;{}'.format(BPA, blocks, blocks, producer_schedule.BLOCKS_PER_TURN)
+    blocks = lpb['turn_blocks'] if lpb['turn_slot'] == turn else 0
+    missed = producer_schedule.BLOCKS_PER_TURN - blocks
+    perfdata = 'blocks={};;;0;{} missed={}'.format(blocks, producer_schedule.BLOCKS_PER_TURN, missed)
+    if blocks == 0:
+        return SERVICE_STATUS['CRITICAL'], 'LPB CRITICAL: {} missed its last round. Last block: {} | {}'.format(BPA, lpb['last_block_produced_time'] or 'none', perfdata)
+    message = '{} produced {} of {} blocks in its last turn. Next turn in {:.1f}s | {}'.format(BPA, blocks, producer_schedule.BLOCKS_PER_TURN, secs_to_next, perfdata)
+    if missed > MISSED_BLOCKS:
+        return SERVICE_STATUS['WARNING'], 'LPB WARNING: {}'.format(message)
+    return SERVICE_STATUS['OK'], message
 
-def get_info(host_port, results = None, i = None):
+def endpoint_url(host_port, path):
+    # Config file entries are host:port, or a full url for https endpoints
+    if not '://' in host_port:
+        host_port = 'http://' + host_port
+    return host_port.rstrip('/') + path
+
+def get_info(host_port, results = None, i = None, timeout = 0.5):
+    import eoshttp
     try:
-        result = requests.get('http://{}/v1/chain/get_info'.format(host_port), verify=False, timeout=0.5).json()
+        result = eoshttp.get(endpoint_url(host_port, '/v1/chain/get_info'), verify=False, timeout=timeout).json()
     except:
         result = {'head_block_num': 0}
 
@@ -40,31 +80,226 @@ def get_info(host_port, results = None, i = None):
 
     return result
 
-def check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE):
+def get_block_id(host_port, block_num, results = None, i = None, timeout = 0.5):
+    import eoshttp
+    try:
+        result = eoshttp.fetch('POST', endpoint_url(host_port, '/v1/chain/get_block'), json_data={'block_num_or_id': block_num},
+                               verify=False, timeout=timeout)[0]['id']
+    except:
+        result = None
+
+    if results != None:
+        results[i] = result
+
+    return result
+
+# Blocks behind the shared head where block ids are compared, so a one block
+# micro fork at the head is not reported
+FORK_MARGIN = 12
+
+def fan_out(function, endpoints, timeout, *args):
+    # Calls function(endpoint, *args, results, i, timeout) for every endpoint at
+    # the same time. Takes as long as the slowest endpoint, at most timeout
+    import threading
+    results = [None] * len(endpoints)
+    threads = [threading.Thread(target=function, args=(endpoint,) + args + (results, i, timeout), daemon=True)
+               for i, endpoint in enumerate(endpoints)]
+    deadline = time.time() + timeout + 0.1
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(max(deadline - time.time(), 0))
+    return results
+
+def read_endpoints(config_file):
+    with open(config_file) as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+def fork_status(ours, references, heads, block_num, ids, THRESHOLD):
+    # heads and ids are lists with our node first. Returns the verdict on our
+    # node against the references that answered
+    import statistics
+    lag = int(statistics.median([h for h in heads[1:] if h])) - heads[0]
+    perfdata = 'lag={};;{} references={};;;0;{}'.format(lag, THRESHOLD, len([h for h in heads[1:] if h]), len(references))
+    reference_ids = [block_id for block_id in ids[1:] if block_id]
+    agree = 0
+    if ids[0] and reference_ids:
+        votes = {}
+        for block_id in reference_ids:
+            votes[block_id] = votes.get(block_id, 0) + 1
+        majority_id = max(votes, key=votes.get)
+        agree = votes.get(ids[0], 0)
+        perfdata += ' agree={};;;0;{}'.format(agree, len(reference_ids))
+        if agree < votes[majority_id]:
+            return SERVICE_STATUS['CRITICAL'], 'FORK CRITICAL: {} is on a minority fork. Block {} is {} on our node, {} on {} of {} references | {}'.format(
+                ours, block_num, ids[0][:16], majority_id[:16], votes[majority_id], len(reference_ids), perfdata)
+    if lag > THRESHOLD:
+        return SERVICE_STATUS['CRITICAL'], 'FORK CRITICAL: {} is {} blocks behind the median head of the references | {}'.format(ours, lag, perfdata)
+    if not ids[0] or not reference_ids:
+        return SERVICE_STATUS['UNKNOWN'], 'FORK UNKNOWN: could not read block {} to compare | {}'.format(block_num, perfdata)
+    return SERVICE_STATUS['OK'], 'BP FORK OK - block {} matches {} of {} references, lag {} | {}'.format(block_num, agree, len(reference_ids), lag, perfdata)
+
+def request_info(HOST, PORT, SSL, TIMEOUT):
+    import eoshttp
+    j_response, response = eoshttp.fetch('GET', eoshttp.url(HOST, PORT, SSL, '/v1/chain/get_info'), timeout=TIMEOUT)
+    return j_response, response.elapsed, response.timings
+
+def check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE, cache = None):
     try:
-        response = requests.get('{}://{}:{}/v1/chain/get_info'.format('http' if not SSL else 'https', HOST, PORT), timeout=TIMEOUT)
-        if response.status_code != 200:
-            print('HTTP CRITICAL: The server couldn\'t fulfill the request. Error code: {}'.format(response.status_code))
-            sys.exit(SERVICE_STATUS['CRITICAL'])
-        j_response = response.json()
-    except requests.exceptions.HTTPError as e:
-        print('HTTP CRITICAL: The server couldn\'t fulfill the request. Error code: {}'.format(e.response.status_code))
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-        print('HTTP CRITICAL: Failed to reach server. Reason: Timeout or Connection Error')
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except requests.exceptions.RequestException as e:
-        print('HTTP CRITICAL: Failed to reach server. Reason: {}'.format(e))
-        sys.exit(SERVICE_STATUS['CRITICAL'])
+        if cache != None:
+            # Checks running in check_daemon.py share a single get_info call per host
+            return cache.get(('get_info', HOST, PORT, SSL), lambda: request_info(HOST, PORT, SSL, TIMEOUT))
+        return request_info(HOST, PORT, SSL, TIMEOUT)
     except Exception as e:
-        print('HTTP CRITICAL: Failed to reach server. Reason: Unknown')
-        if VERBOSE:
-            print(e)
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    performance_data = response.elapsed.total_seconds()
-    return j_response, performance_data
+        import eoshttp
+        raise CheckResult(*eoshttp.nagios_error(e, VERBOSE))
 
-def main(argv):
+def head_status(head_block_num, j_response2, performance_data):
+    import datetime
+    head_block_num2 = int(j_response2['head_block_num'])
+    if head_block_num2 <= head_block_num:
+        return SERVICE_STATUS['CRITICAL'], 'BP HEAD BLOCK not advancing. Last block {}'.format(head_block_num2)
+
+    head_block_time = j_response2['head_block_time']
+    with tracing.span('parse_time'):
+        head_block_time_dt = datetime.datetime.strptime(head_block_time, "%Y-%m-%dT%H:%M:%S.%f")
+
+    now = datetime.datetime.utcnow()
+    secs_diff = int((now - head_block_time_dt).total_seconds())
+    if secs_diff > 30:
+        return SERVICE_STATUS['WARNING'], 'BP seems to be syncing. Last block: {}. Last block time: {}'.format(head_block_num, head_block_time)
+
+    return SERVICE_STATUS['OK'], 'BP HEAD OK - LB: {} | time={}s head_block_num={}c'.format(head_block_num2, performance_data, head_block_num2)
+
+def info_sample(j_response):
+    return {
+        'head_block_num': int(j_response['head_block_num']),
+        'last_irreversible_block_num': int(j_response['last_irreversible_block_num']),
+        'head_block_time': j_response['head_block_time'],
+        'timestamp': time.time()
+    }
+
+def stateful_samples(HOST, PORT, SSL, TIMEOUT, VERBOSE, CHECK, HEAD_INTERVAL, STATE_DIR, MIN_SAMPLE_AGE, MAX_SAMPLE_AGE, cache = None):
+    # Compares against the sample stored by the previous run instead of
+    # sleeping between two calls. Only waits when there is no usable sample
+    path = statestore.state_path(STATE_DIR, CHECK, HOST, PORT)
+    previous = statestore.load(path)
+    age = time.time() - previous['timestamp'] if previous else None
+    if previous == None or age > MAX_SAMPLE_AGE or age < 0:
+        j_response, performance_data, timings = check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE, cache)
+        previous = info_sample(j_response)
+        with tracing.span('sleep'):
+            time.sleep(HEAD_INTERVAL)
+    elif age < MIN_SAMPLE_AGE:
+        with tracing.span('sleep'):
+            time.sleep(MIN_SAMPLE_AGE - age)
+
+    j_response2, performance_data, timings = check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE, cache)
+    current = info_sample(j_response2)
+    statestore.save(path, current)
+    return previous, current, j_response2, performance_data
+
+def rates_perfdata(previous, current):
+    elapsed = current['timestamp'] - previous['timestamp']
+    head_rate = (current['head_block_num'] - previous['head_block_num']) / elapsed
+    lib_rate = (current['last_irreversible_block_num'] - previous['last_irreversible_block_num']) / elapsed
+    return 'head_rate={:.2f} lib_rate={:.2f}'.format(head_rate, lib_rate)
+
+def add_perfdata(output, perfdata):
+    if '|' in output:
+        return '{} {}'.format(output, perfdata)
+    return '{} | {}'.format(output, perfdata)
+
+def find_nodeos(PIDFILE, cached):
+    # Tries the pidfile and the pid found by the previous run before scanning
+    # every process on the box
+    import psutil
+    pids = []
+    if PIDFILE:
+        try:
+            with open(PIDFILE) as f:
+                pids.append(int(f.read().strip()))
+        except (OSError, ValueError):
+            pass
+    if cached:
+        pids.append(cached['pid'])
+    for pid in pids:
+        try:
+            p = psutil.Process(pid)
+            if p.name() == 'nodeos':
+                return p
+        except psutil.Error:
+            continue
+    for p in psutil.process_iter(['name']):
+        if p.info['name'] == 'nodeos':
+            return p
+    return None
+
+def nodeos_perfdata(p, cached):
+    import psutil
+    with p.oneshot():
+        cpu_times = p.cpu_times()
+        cpu_total = cpu_times.user + cpu_times.system
+        now = time.time()
+        if cached and cached['pid'] == p.pid and cached['create_time'] == p.create_time() and now > cached['timestamp']:
+            cpu_percent = 100.0 * (cpu_total - cached['cpu_total']) / (now - cached['timestamp'])
+        else:
+            cpu_percent = p.cpu_percent(interval=0.1)
+        perfdata = ['rss={}B'.format(p.memory_info().rss), 'cpu={:.2f}%'.format(cpu_percent), 'threads={}'.format(p.num_threads())]
+        try:
+            perfdata.append('fds={}'.format(p.num_fds()))
+        except (psutil.Error, AttributeError):
+            pass
+        try:
+            io = p.io_counters()
+            perfdata += ['read_bytes={}c'.format(io.read_bytes), 'write_bytes={}c'.format(io.write_bytes)]
+        except (psutil.Error, AttributeError):
+            pass
+        sample = {'pid': p.pid, 'create_time': p.create_time(), 'cpu_total': cpu_total, 'timestamp': now}
+    return ' '.join(perfdata), sample
+
+def probe_head(HOST, PORT, SSL, TIMEOUT, HEAD_INTERVAL, results = None, i = None):
+    # Same logic as the head check, but returns the verdict instead of exiting so
+    # several endpoints can be probed from threads in the same process
+    result = {
+        'host': HOST,
+        'port': PORT,
+        'head_block_num': 0,
+        'latency': None,
+        'status': SERVICE_STATUS['CRITICAL'],
+        'message': ''
+    }
+    try:
+        j_response, performance_data, timings = request_info(HOST, PORT, SSL, TIMEOUT)
+        with tracing.span('sleep'):
+            time.sleep(HEAD_INTERVAL)
+        j_response2, performance_data2, timings2 = request_info(HOST, PORT, SSL, TIMEOUT)
+        result['head_block_num'] = int(j_response2['head_block_num'])
+        result['latency'] = performance_data2
+        result['status'], result['message'] = head_status(int(j_response['head_block_num']), j_response2, performance_data)
+    except Exception as e:
+        import eoshttp
+        result['status'], result['message'] = eoshttp.nagios_error(e, True)
+
+    if results != None:
+        results[i] = result
+
+    return result
+
+def p2p_connect_time(HOST, PORT, TIMEOUT):
+    # Seconds to open a tcp connection to a p2p endpoint, None if it fails
+    # create_connection picks the address family, so IPv6 peers work too
+    import socket
+    start = time.perf_counter()
+    try:
+        sock = socket.create_connection((HOST, PORT), TIMEOUT)
+    except OSError:
+        return None
+    elapsed = time.perf_counter() - start
+    sock.close()
+    return elapsed
+
+def build_parser():
     parser = argparse.ArgumentParser(description='Check BP status')
     parser.add_argument('-v', '--verbose', action='store_true', help = 'Print verbose logging to stdout')
     parser.add_argument('-H', '--host', default='localhost',
@@ -74,13 +309,51 @@ def main(argv):
     parser.add_argument('-s', '--ssl', action='store_true', default=False, help = 'Use ssl to connect to the api endpoint')
     parser.add_argument('-t', '--timeout', type=int, default=3, help = 'Timeout in seconds')
     parser.add_argument('-i', '--head_interval', type=int, default=10, help = 'Time in seconds to check head')
-    parser.add_argument('-c', '--check', help='Check to perform [http,head,lib,p2p,nodeos,lpb]')
-    parser.add_argument('-lpb', '--lpb_file', default='eos.lpb.json',
-                        help='json file with the lpb info. Produced by eoslpb.py')
+    parser.add_argument('-c', '--check', help='Check to perform [{}]'.format(','.join(CHECKS)))
+    parser.add_argument('-lpb', '--lpb_file', default='eos.lpb',
+                        help='lpb store produced by eoslpb.py. Files ending in .json are read in the legacy json format')
     parser.add_argument('-bpa', '--bp_account',
                         help='BP accounts to check last block produced')
-    
-    args = parser.parse_args()
+    parser.add_argument('-S', '--stateful', action='store_true', default=False,
+                        help='head and lib: compare with the sample stored by the previous run instead of sleeping head_interval')
+    parser.add_argument('--state_dir', default=statestore.DEFAULT_STATE_DIR,
+                        help='Directory for the stateful samples. default = {}'.format(statestore.DEFAULT_STATE_DIR))
+    parser.add_argument('--min_sample_age', type=float, default=3,
+                        help='Stateful mode waits until the previous sample is this old. default = 3')
+    parser.add_argument('--max_sample_age', type=float, default=600,
+                        help='Stateful mode ignores previous samples older than this and falls back to sleeping head_interval. default = 600')
+    parser.add_argument('--pidfile',
+                        help='nodeos: pidfile to try before looking for the process')
+    parser.add_argument('--missed_blocks', type=int, default=2,
+                        help='lpb: blocks of its last 12 a producer can miss before WARNING. default = 2')
+    parser.add_argument('--max_store_age', type=int, default=60,
+                        help='lpb, missed: seconds the lpb store or production log can lag behind before UNKNOWN. default = 60')
+    parser.add_argument('--ref_api', default='http://localhost:8888',
+                        help='handshake: API of our node, for the chain_id and the head to compare the peer with. default = http://localhost:8888')
+    parser.add_argument('--lag_warning', type=int, default=120,
+                        help='handshake: blocks the peer can be behind our node before WARNING. default = 120')
+    parser.add_argument('--lag_critical', type=int, default=1200,
+                        help='handshake: blocks the peer can be behind our node before CRITICAL. default = 1200')
+    parser.add_argument('-cf', '--config-file', dest='config_file',
+                        help='fork: Config file to get the RPC endpoints (One host:port per line)')
+    parser.add_argument('-n', '--num-blocks-threshold', dest='num_blocks_threshold', type=int, default=60,
+                        help='fork: Threshold to consider that head is forked or not working. default = 60')
+    parser.add_argument('--ship_status',
+                        help='ship: status file written by ship_monitor.py')
+    parser.add_argument('--max_status_age', type=float, default=5,
+                        help='ship: seconds without a block from the stream before CRITICAL. default = 5')
+    parser.add_argument('--prodlog',
+                        help='missed: production log written by eoslpb.py or ship_monitor.py with -p')
+    parser.add_argument('--window', type=float, default=24,
+                        help='missed: hours over which the missed block ratio is computed. default = 24')
+    parser.add_argument('--missed_warning', type=float, default=0.01,
+                        help='missed: ratio of its scheduled blocks a producer can miss before WARNING. default = 0.01')
+    parser.add_argument('--missed_critical', type=float, default=0.05,
+                        help='missed: ratio of its scheduled blocks a producer can miss before CRITICAL. default = 0.05')
+    tracing.add_arguments(parser)
+    return parser
+
+def check(args, cache = None):
     HOST = args.host
     TIMEOUT = args.timeout
     HEAD_INTERVAL = args.head_interval
@@ -90,112 +363,205 @@ def main(argv):
     LPB_FILE = args.lpb_file
     BPA = args.bp_account
     SSL = args.ssl
+    STATEFUL = args.stateful
 
     performance_data = ''
     
     if CHECK == 'http':   
-        j_response, performance_data = check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE)
-        print('BP API OK | time={}s'.format(performance_data))
-        sys.exit(SERVICE_STATUS['OK'])
+        j_response, performance_data, timings = check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE, cache)
+        import eoshttp
+        return SERVICE_STATUS['OK'], 'BP API OK | time={}s {} head_block_num={}c lib_block_num={}c'.format(
+            performance_data, eoshttp.timings_perfdata(timings), j_response['head_block_num'], j_response['last_irreversible_block_num'])
     
+    if CHECK in ['head', 'lib'] and STATEFUL:
+        previous, current, j_response2, performance_data = stateful_samples(HOST, PORT, SSL, TIMEOUT, VERBOSE, CHECK, HEAD_INTERVAL,
+                                                                           args.state_dir, args.min_sample_age, args.max_sample_age, cache)
+        if CHECK == 'head':
+            status, output = head_status(previous['head_block_num'], j_response2, performance_data)
+        elif current['last_irreversible_block_num'] > previous['last_irreversible_block_num']:
+            status, output = SERVICE_STATUS['OK'], 'BP LIB OK - LIB {} | time={}s lib_block_num={}c'.format(current['last_irreversible_block_num'], performance_data,
+                                                                                                           current['last_irreversible_block_num'])
+        else:
+            status, output = SERVICE_STATUS['CRITICAL'], 'BP LIB not moving'
+        return status, add_perfdata(output, rates_perfdata(previous, current))
+
     if CHECK == 'head':
-        j_response, performance_data = check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE)
+        j_response, performance_data, timings = check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE, cache)
         head_block_num = int(j_response['head_block_num'])
         
-        time.sleep(HEAD_INTERVAL)
+        with tracing.span('sleep'):
+            time.sleep(HEAD_INTERVAL)
 
-        j_response2, performance_data2 = check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE)
-        head_block_num2 = int(j_response2['head_block_num'])
-
-        is_hb_advancing = head_block_num2 > head_block_num
-        
-        if is_hb_advancing:
-            head_block_time = j_response2['head_block_time']
-            head_block_time_dt = datetime.datetime.strptime(head_block_time, "%Y-%m-%dT%H:%M:%S.%f")
-
-            now = datetime.datetime.utcnow()
-            secs_diff = int((now - head_block_time_dt).total_seconds())
-            if secs_diff > 30:
-                print('BP seems to be syncing. Last block: {}. Last block time: {}'.format(head_block_num, head_block_time))
-                sys.exit(SERVICE_STATUS['WARNING'])
-
-            print('BP HEAD OK - LB: {} | time={}s'.format(head_block_num2, performance_data))
-            sys.exit(SERVICE_STATUS['OK'])
-        else:
-            print('BP HEAD BLOCK not advancing. Last block {}'.format(head_block_num2))
-            sys.exit(SERVICE_STATUS['CRITICAL'])
+        j_response2, performance_data2, timings2 = check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE, cache)
+        return head_status(head_block_num, j_response2, performance_data)
 
     if CHECK == 'lib':
-        j_response, performance_data = check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE)
+        j_response, performance_data, timings = check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE, cache)
         last_irreversible_block_num = int(j_response['last_irreversible_block_num'])
         
-        time.sleep(HEAD_INTERVAL)
+        with tracing.span('sleep'):
+            time.sleep(HEAD_INTERVAL)
 
-        j_response2, performance_data2 = check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE)
+        j_response2, performance_data2, timings2 = check_api(HOST, PORT, SSL, TIMEOUT, VERBOSE, cache)
         last_irreversible_block_num2 = int(j_response2['last_irreversible_block_num'])
 
         is_lib_advancing = last_irreversible_block_num2 > last_irreversible_block_num
         
         if is_lib_advancing:
-            head_block_time = j_response2['head_block_time']
-            head_block_time_dt = datetime.datetime.strptime(head_block_time, "%Y-%m-%dT%H:%M:%S.%f")
-
-            print('BP LIB OK - LIB {} | time={}s'.format(last_irreversible_block_num2, performance_data))
-            sys.exit(SERVICE_STATUS['OK'])
+            return SERVICE_STATUS['OK'], 'BP LIB OK - LIB {} | time={}s lib_block_num={}c'.format(last_irreversible_block_num2, performance_data, last_irreversible_block_num2)
         else:
-            print('BP LIB not moving')
-            sys.exit(SERVICE_STATUS['CRITICAL'])
+            return SERVICE_STATUS['CRITICAL'], 'BP LIB not moving'
 
     elif CHECK == 'p2p':
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(TIMEOUT)
-        start = time.time()
-        result = sock.connect_ex((HOST, PORT))
-        if result != 0:
-            print('P2P CRITICAL')
-            sys.exit(SERVICE_STATUS['CRITICAL'])
-        performance_data = time.time() - start
-        print('BP P2P OK | time={}s'.format(performance_data))
-        sys.exit(SERVICE_STATUS['OK'])
+        with tracing.span('p2p_connect'):
+            performance_data = p2p_connect_time(HOST, PORT, TIMEOUT)
+        if performance_data == None:
+            return SERVICE_STATUS['CRITICAL'], 'P2P CRITICAL'
+        return SERVICE_STATUS['OK'], 'BP P2P OK | time={:.6f}s'.format(performance_data)
+
+    elif CHECK == 'handshake':
+        import eoshttp
+        import p2p_handshake
+        try:
+            info = eoshttp.fetch('GET', '{}/v1/chain/get_info'.format(args.ref_api.rstrip('/')), timeout=TIMEOUT)[0]
+        except Exception as e:
+            return SERVICE_STATUS['UNKNOWN'], 'Reference API {} error: {}'.format(args.ref_api, str(e))
+        try:
+            with tracing.span('handshake'):
+                result = p2p_handshake.probe(HOST, PORT, info['chain_id'], TIMEOUT)
+        except (OSError, p2p_handshake.ProtocolError) as e:
+            return SERVICE_STATUS['CRITICAL'], 'P2P CRITICAL: {}'.format(str(e) or type(e).__name__)
+        if 'go_away' in result:
+            return SERVICE_STATUS['CRITICAL'], 'P2P CRITICAL: peer sent go_away {}'.format(result['go_away'])
+        lag = p2p_handshake.lag(result, info['head_block_num'])
+        perfdata = 'lag={} rtt={:.6f}s connect={:.6f}s'.format(lag, result['rtt'], result['connect'])
+        message = 'head {} lag {} blocks | {}'.format(result['handshake']['head_num'], lag, perfdata)
+        if lag > args.lag_critical:
+            return SERVICE_STATUS['CRITICAL'], 'P2P CRITICAL: {}'.format(message)
+        if lag > args.lag_warning:
+            return SERVICE_STATUS['WARNING'], 'P2P WARNING: {}'.format(message)
+        return SERVICE_STATUS['OK'], 'BP P2P handshake OK - {}'.format(message)
 
     elif CHECK == 'nodeos':
-        process_found = False
-        for pid in psutil.pids():
-            try:
-                p = psutil.Process(pid)
-            except:
-                continue
-            if p.name() == "nodeos":
-                process_found = True
-        if not process_found:
-            print('nodeos CRITICAL: Process not running')
-            sys.exit(SERVICE_STATUS['CRITICAL'])
-        print('BP nodeos running OK')
-        sys.exit(SERVICE_STATUS['OK'])
+        import psutil
+        path = statestore.state_path(args.state_dir, 'nodeos')
+        cached = statestore.load(path)
+        try:
+            with tracing.span('find_nodeos'):
+                p = find_nodeos(args.pidfile, cached)
+            if p == None:
+                return SERVICE_STATUS['CRITICAL'], 'nodeos CRITICAL: Process not running'
+            with tracing.span('nodeos_perfdata', pid=p.pid):
+                perfdata, sample = nodeos_perfdata(p, cached)
+        except psutil.NoSuchProcess:
+            return SERVICE_STATUS['CRITICAL'], 'nodeos CRITICAL: Process not running'
+        statestore.save(path, sample)
+        return SERVICE_STATUS['OK'], 'BP nodeos running OK | {}'.format(perfdata)
 
     elif CHECK == 'lpb':
-        lpb = get_lpb(LPB_FILE)
+        import datetime
+        if not BPA:
+            return SERVICE_STATUS['CRITICAL'], 'LPB CRITICAL: No BP account specified'
 
-        if not BPA in lpb['producers']:
-            print('{} is not in top 21'.format(BPA))
-            sys.exit(SERVICE_STATUS['OK'])
-        else:
-            if not BPA:
-                print('LPB CRITICAL: No BP account specified')
-                sys.exit(SERVICE_STATUS['CRITICAL'])
+        with tracing.span('read_lpb', file=LPB_FILE):
+            header, lpb = get_lpb(LPB_FILE, BPA)
 
-            last_block_produced_time = lpb[BPA]['last_block_produced_time']
+        if lpb == None:
+            return SERVICE_STATUS['OK'], '{} is not in top 21'.format(BPA)
+        if header != None and header['last_block_time']:
+            store_age = int((datetime.datetime.utcnow() - datetime.datetime.strptime(header['last_block_time'], "%Y-%m-%dT%H:%M:%S.%f")).total_seconds())
+            if store_age > args.max_store_age:
+                return SERVICE_STATUS['UNKNOWN'], 'LPB UNKNOWN: {} has not been updated for {} seconds'.format(LPB_FILE, store_age)
+        status = turn_status(header, lpb, BPA, args.missed_blocks)
+        if status != None:
+            return status
+        else:
+            last_block_produced_time = lpb['last_block_produced_time']
+            if not last_block_produced_time:
+                return SERVICE_STATUS['CRITICAL'], 'LPB CRITICAL: {} has not produced any block yet'.format(BPA)
             last_block_produced_time_dt = datetime.datetime.strptime(last_block_produced_time, "%Y-%m-%dT%H:%M:%S.%f")
             now = datetime.datetime.utcnow()
             secs_diff = int((now - last_block_produced_time_dt).total_seconds())
             if secs_diff > 150:
-                print('LPB CRITICAL: {} last produced {} seconds ago. '.format(BPA, secs_diff))
-                sys.exit(SERVICE_STATUS['CRITICAL'])
-            print('{} produced {} secs ago'.format(BPA, secs_diff))
-            sys.exit(SERVICE_STATUS['OK'])
-    else:
+                return SERVICE_STATUS['CRITICAL'], 'LPB CRITICAL: {} last produced {} seconds ago. '.format(BPA, secs_diff)
+            return SERVICE_STATUS['OK'], '{} produced {} secs ago'.format(BPA, secs_diff)
+
+    elif CHECK == 'fork':
+        if not args.config_file:
+            return SERVICE_STATUS['UNKNOWN'], 'FORK UNKNOWN: No config file with reference endpoints specified'
+        references = read_endpoints(args.config_file)
+        ours = '{}://{}:{}'.format('https' if SSL else 'http', HOST, PORT)
+        endpoints = [ours] + references
+        with tracing.span('get_info', endpoints=len(endpoints)):
+            heads = [int((info or {}).get('head_block_num', 0)) for info in fan_out(get_info, endpoints, TIMEOUT)]
+        if not heads[0]:
+            return SERVICE_STATUS['CRITICAL'], 'FORK CRITICAL: {} did not answer get_info'.format(ours)
+        answered = sorted(h for h in heads[1:] if h)
+        if not answered:
+            return SERVICE_STATUS['UNKNOWN'], 'FORK UNKNOWN: none of the {} reference endpoints answered'.format(len(references))
+        # Highest block our node and at least half of the references have
+        block_num = max(min(heads[0], answered[(len(answered) - 1) // 2]) - FORK_MARGIN, 1)
+        holders = [i for i, h in enumerate(heads) if h >= block_num]
+        ids = [None] * len(endpoints)
+        with tracing.span('get_block_id', endpoints=len(holders), block_num=block_num):
+            for i, block_id in zip(holders, fan_out(get_block_id, [endpoints[i] for i in holders], TIMEOUT, block_num)):
+                ids[i] = block_id
+        return fork_status(ours, references, heads, block_num, ids, args.num_blocks_threshold)
+
+    elif CHECK == 'ship':
+        import datetime
+        status = statestore.load(args.ship_status) if args.ship_status else None
+        if status == None or not 'block_time' in status:
+            return SERVICE_STATUS['UNKNOWN'], 'SHIP UNKNOWN: no status in {}'.format(args.ship_status)
+        status_age = time.time() - status['updated']
+        if status_age > args.max_status_age:
+            return SERVICE_STATUS['CRITICAL'], 'SHIP CRITICAL: no block from {} for {:.1f} seconds. Last block: {}'.format(status['url'], status_age, status['block_num'])
+        with tracing.span('parse_time'):
+            block_time_dt = datetime.datetime.strptime(status['block_time'], "%Y-%m-%dT%H:%M:%S.%f")
+        head_age = (datetime.datetime.utcnow() - block_time_dt).total_seconds()
+        perfdata = 'head_block_num={}c lib_block_num={}c head_age={:.3f}s status_age={:.3f}s'.format(
+            status['head_block_num'], status['last_irreversible_block_num'], head_age, status_age)
+        if head_age > 30:
+            return SERVICE_STATUS['WARNING'], 'BP seems to be syncing. Last block: {}. Last block time: {} | {}'.format(status['block_num'], status['block_time'], perfdata)
+        return SERVICE_STATUS['OK'], 'BP SHIP OK - head {} lib {} producer {} | {}'.format(status['head_block_num'], status['last_irreversible_block_num'],
+                                                                                          status['block_producer'], perfdata)
+
+    elif CHECK == 'missed':
+        import prodlog
+        import producer_schedule
+        if not BPA:
+            return SERVICE_STATUS['CRITICAL'], 'MISSED CRITICAL: No BP account specified'
+        if not args.prodlog:
+            return SERVICE_STATUS['UNKNOWN'], 'MISSED UNKNOWN: No production log specified'
+        with tracing.span('read_prodlog', file=args.prodlog):
+            log = prodlog.ProdLogReader(args.prodlog)
+            last_slot = log.last_slot
+            if last_slot == None:
+                return SERVICE_STATUS['UNKNOWN'], 'MISSED UNKNOWN: {} is empty'.format(args.prodlog)
+            produced, missed = log.stats(BPA, last_slot + 1 - int(args.window * 3600 * 2), last_slot + 1)
+        log_age = time.time() - producer_schedule.slot_to_ms(last_slot) / 1000.0
+        if log_age > args.max_store_age:
+            return SERVICE_STATUS['UNKNOWN'], 'MISSED UNKNOWN: {} has not been updated for {} seconds'.format(args.prodlog, int(log_age))
+        if produced + missed == 0:
+            return SERVICE_STATUS['OK'], '{} was not scheduled in the last {:g} hours'.format(BPA, args.window)
+        ratio = prodlog.missed_ratio(produced, missed)
+        perfdata = 'missed_ratio={:.6f};{};{};0;1 produced={} missed={}'.format(ratio, args.missed_warning, args.missed_critical, produced, missed)
+        summary = '{} missed {} of {} blocks ({:.2f}%) in the last {:g} hours | {}'.format(BPA, missed, produced + missed, ratio * 100, args.window, perfdata)
+        if ratio >= args.missed_critical:
+            return SERVICE_STATUS['CRITICAL'], 'MISSED CRITICAL: ' + summary
+        if ratio >= args.missed_warning:
+            return SERVICE_STATUS['WARNING'], 'MISSED WARNING: ' + summary
+        return SERVICE_STATUS['OK'], summary
+
+def main(argv):
+    parser = build_parser()
+    args = parser.parse_args()
+    if not args.check in CHECKS:
         print('Unknown check')
         parser.print_help()
         sys.exit(SERVICE_STATUS['WARNING'])
+    tracing.configure_from(args)
+    nagios.exit_with(check, args)
+
 if __name__ == "__main__":
     main(sys.argv)
@@ -2,65 +2,54 @@
 
 import sys
 import argparse
-import requests
+import eoshttp
 import dateutil.parser as dp
 import time
-
-SERVICE_STATUS = {
-    'OK': 0,
-    'WARNING': 1,
-    'CRITICAL': 2,
-    'UNKNOWN': 3
-}
+import nagios
+import tracing
+import statestore
+from nagios import SERVICE_STATUS
 
 def get_health(HOST, PORT, SSL, TIMEOUT, VERBOSE):
-    try:
-        response = requests.get('{}://{}:{}/v2/health'.format('http' if not SSL else 'https', HOST, PORT), timeout=TIMEOUT)
-        if response.status_code != 200:
-            print('HTTP CRITICAL: The server couldn\'t fulfill the request. Error code: {}'.format(response.status_code))
-            sys.exit(SERVICE_STATUS['CRITICAL'])
-        j_response = response.json()
-    except requests.exceptions.HTTPError as e:
-        print('HTTP CRITICAL: The server couldn\'t fulfill the request. Error code: {}'.format(e.response.status_code))
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-        print('HTTP CRITICAL: Failed to reach server. Reason: Timeout or Connection Error')
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except requests.exceptions.RequestException as e:
-        print('HTTP CRITICAL: Failed to reach server. Reason: {}'.format(e))
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except Exception as e:
-        print('HTTP CRITICAL: Failed to reach server. Reason: Unknown')
-        if VERBOSE:
-            print(e)
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    performance_data = response.elapsed.total_seconds()
+    j_response, response = eoshttp.checked_fetch('GET', eoshttp.url(HOST, PORT, SSL, '/v2/health'), TIMEOUT, VERBOSE)
+    performance_data = response.elapsed
     return j_response, performance_data
 
 def get_last_action_timestamp(HOST, PORT, SSL, TIMEOUT, VERBOSE):
-    try:
-        response = requests.get('{}://{}:{}/v2/history/get_actions?limit=1'.format('http' if not SSL else 'https', HOST, PORT), timeout=TIMEOUT)
-        if response.status_code != 200:
-            print('HTTP CRITICAL: The server couldn\'t fulfill the request. Error code: {}'.format(response.status_code))
-            sys.exit(SERVICE_STATUS['CRITICAL'])
-        j_response = response.json()
-    except requests.exceptions.HTTPError as e:
-        print('HTTP CRITICAL: The server couldn\'t fulfill the request. Error code: {}'.format(e.response.status_code))
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-        print('HTTP CRITICAL: Failed to reach server. Reason: Timeout or Connection Error')
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except requests.exceptions.RequestException as e:
-        print('HTTP CRITICAL: Failed to reach server. Reason: {}'.format(e))
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except Exception as e:
-        print('HTTP CRITICAL: Failed to reach server. Reason: Unknown')
-        if VERBOSE:
-            print(e)
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    return time.mktime(dp.parse(j_response['actions'][0]['timestamp']).timetuple())
+    j_response, response = eoshttp.checked_fetch('GET', eoshttp.url(HOST, PORT, SSL, '/v2/history/get_actions?limit=1'), TIMEOUT, VERBOSE)
+    with tracing.span('parse_time'):
+        return time.mktime(dp.parse(j_response['actions'][0]['timestamp']).timetuple())
 
-def main(argv):
+def index_gap_of(sample):
+    return sample['head_block_num'] - sample['last_indexed_block']
+
+def index_trend(samples, growing_samples):
+    # samples are ordered oldest first. Rates are computed over the whole
+    # history, growing looks at the last growing_samples changes only
+    if len(samples) < 2:
+        return None
+    first, last = samples[0], samples[-1]
+    elapsed = last['timestamp'] - first['timestamp']
+    if elapsed <= 0:
+        return None
+    index_rate = (last['last_indexed_block'] - first['last_indexed_block']) / elapsed
+    gap_rate = (index_gap_of(last) - index_gap_of(first)) / elapsed
+    recent = samples[-(growing_samples + 1):]
+    return {
+        'index_rate': index_rate,
+        'gap_rate': gap_rate,
+        'eta': max(0.0, index_gap_of(last) / -gap_rate) if gap_rate < 0 else None,
+        'growing': len(recent) > growing_samples and all(index_gap_of(b) > index_gap_of(a) for a, b in zip(recent, recent[1:]))
+    }
+
+def update_history(path, sample, history, max_age):
+    samples = statestore.load(path, {'samples': []})['samples']
+    samples = [s for s in samples if 0 <= sample['timestamp'] - s['timestamp'] <= max_age]
+    samples = (samples + [sample])[-history:]
+    statestore.save(path, {'samples': samples})
+    return samples
+
+def build_parser():
     parser = argparse.ArgumentParser(description='Check BP status')
     parser.add_argument('-v', '--verbose', action='store_true', help = 'Print verbose logging to stdout')
     parser.add_argument('-H', '--host', default='localhost',
@@ -77,8 +66,20 @@ def main(argv):
                         help='warning threshold of last indexed action. default 120')
     parser.add_argument('-lacc', '--lastactioncritical', type=int, default='300',
                         help='critical threshold of last indexed action. default 300')
-    
-    args = parser.parse_args()
+    parser.add_argument('--state_dir', default=statestore.DEFAULT_STATE_DIR,
+                        help='Directory where the indexing history is kept between runs. default = {}'.format(statestore.DEFAULT_STATE_DIR))
+    parser.add_argument('--history', type=int, default=10,
+                        help='Number of samples kept to compute indexing rates. default 10')
+    parser.add_argument('--history_max_age', type=int, default=3600,
+                        help='Samples older than this many seconds are discarded. default 3600')
+    parser.add_argument('--catchup_eta', type=int, default=900,
+                        help='A gap over the threshold that closes within this many seconds is only a warning. default 900')
+    parser.add_argument('--growing_samples', type=int, default=3,
+                        help='A gap that grew in this many consecutive samples is critical, even under the threshold. default 3')
+    tracing.add_arguments(parser)
+    return parser
+
+def check(args, cache = None):
     HOST = args.host
     TIMEOUT = args.timeout
     PORT = args.port
@@ -106,6 +107,15 @@ def main(argv):
     except:
         missing_blocks = abs(last_indexed_block - total_indexed_blocks)
 
+    with tracing.span('update_history'):
+        samples = update_history(statestore.state_path(args.state_dir, 'hyperion', HOST, PORT), {
+            'timestamp': time.time(),
+            'head_block_num': head_block,
+            'last_indexed_block': last_indexed_block,
+            'query_time_ms': query_time
+        }, args.history, args.history_max_age)
+    trend = index_trend(samples, args.growing_samples)
+
     # Check last action timestamp
     last_action_lag = time.time() - last_action_timestamp
     if last_action_lag > C_LAST_ACTION_THRESHOLD:
@@ -119,9 +129,17 @@ def main(argv):
     index_gap = abs(head_block - last_indexed_block)
     if index_gap > W_THRESHOLD:
         output_message += "{} blocks gap between head and last indexed block. ".format(index_gap)
-        output_status = SERVICE_STATUS['WARNING']
+        gap_status = SERVICE_STATUS['WARNING']
         if index_gap > C_THRESHOLD:
-            output_status = SERVICE_STATUS['CRITICAL']
+            gap_status = SERVICE_STATUS['CRITICAL']
+        # Catching up only softens the gap verdict, not the last action one
+        if trend and trend['eta'] != None and trend['eta'] < args.catchup_eta:
+            output_message += "Catching up at {:,.0f} blocks/s, ETA {:,.0f}s. ".format(trend['index_rate'], trend['eta'])
+            gap_status = SERVICE_STATUS['WARNING']
+        output_status = max(output_status, gap_status)
+    elif trend and trend['growing'] and index_gap > 0:
+        output_message += "{} blocks gap growing for the last {} samples. ".format(index_gap, args.growing_samples)
+        output_status = SERVICE_STATUS['CRITICAL']
 
     #Check services status
     if not all(map(lambda x: x['status'] == 'OK', services)):
@@ -135,10 +153,19 @@ def main(argv):
     #    output_status = SERVICE_STATUS['CRITICAL']
     
 
+    performance_data = f"'http_query_time'={http_query_time:,.2f}s; 'query_time'={query_time:,.2f}ms; 'last_action_lag'={last_action_lag:,.2f}s"
+    if trend:
+        eta = '{:.0f}s'.format(trend['eta']) if trend['eta'] != None else 'U'
+        performance_data += f"; 'index_rate'={trend['index_rate']:.2f}; 'gap_rate'={trend['gap_rate']:.2f}; 'catchup_eta'={eta}"
+
     if not output_message: 
         output_message = 'Everything Ok'
-    print(f"{output_message.rstrip()} | 'http_query_time'={http_query_time:,.2f}s; 'query_time'={query_time:,.2f}ms; 'last_action_lag'={last_action_lag:,.2f}s")
-    sys.exit(output_status)
+    return output_status, f"{output_message.rstrip()} | {performance_data}"
+
+def main(argv):
+    args = build_parser().parse_args()
+    tracing.configure_from(args)
+    nagios.exit_with(check, args)
 
 if __name__ == "__main__":
     main(sys.argv)
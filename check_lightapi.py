@@ -2,41 +2,56 @@
 
 import sys
 import argparse
-import requests
-
-SERVICE_STATUS = {
-    'OK': 0,
-    'WARNING': 1,
-    'CRITICAL': 2,
-    'UNKNOWN': 3
-}
+import concurrent.futures
+import eoshttp
+import nagios
+import tracing
+from nagios import SERVICE_STATUS, CheckResult
 
 def get_health(HOST, PORT, SSL, TIMEOUT, VERBOSE):
-    try:
-        response = requests.get('{}://{}:{}/api/status'.format('http' if not SSL else 'https', HOST, PORT), timeout=TIMEOUT)
-        if response.status_code != 200:
-            print('HTTP CRITICAL: The server couldn\'t fulfill the request. Error code: {}'.format(response.status_code))
-            sys.exit(SERVICE_STATUS['CRITICAL'])
-        j_response = response.text
-    except requests.exceptions.HTTPError as e:
-        print('HTTP CRITICAL: The server couldn\'t fulfill the request. Error code: {}'.format(e.response.status_code))
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-        print('HTTP CRITICAL: Failed to reach server. Reason: Timeout or Connection Error')
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except requests.exceptions.RequestException as e:
-        print('HTTP CRITICAL: Failed to reach server. Reason: {}'.format(e))
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    except Exception as e:
-        print('HTTP CRITICAL: Failed to reach server. Reason: Unknown')
-        if VERBOSE:
-            print(e)
-        sys.exit(SERVICE_STATUS['CRITICAL'])
-    performance_data = response.elapsed.total_seconds()
+    j_response, response = eoshttp.checked_fetch('GET', eoshttp.url(HOST, PORT, SSL, '/api/status'), TIMEOUT, VERBOSE, parse='text')
+    performance_data = response.elapsed
     return j_response.strip(), performance_data
 
+def get_networks(HOST, PORT, SSL, TIMEOUT, VERBOSE):
+    j_response, response = eoshttp.checked_fetch('GET', eoshttp.url(HOST, PORT, SSL, '/api/networks'), TIMEOUT, VERBOSE)
+    return sorted(j_response)
 
-def main(argv):
+def get_sync(HOST, PORT, SSL, TIMEOUT, network):
+    # Plain text: seconds between now and the last block the network's
+    # writer processed, then OK or OUT_OF_SYNC
+    text, response = eoshttp.fetch('GET', eoshttp.url(HOST, PORT, SSL, '/api/sync/{}'.format(network)), parse='text', timeout=TIMEOUT)
+    fields = text.split()
+    return int(fields[0]), fields[1] if len(fields) > 1 else ''
+
+def get_all_sync(HOST, PORT, SSL, TIMEOUT, networks):
+    # Queries every network at the same time. Networks that did not answer
+    # within TIMEOUT are returned with the error instead of holding the check
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(networks))
+    futures = {network: executor.submit(get_sync, HOST, PORT, SSL, TIMEOUT, network) for network in networks}
+    concurrent.futures.wait(futures.values(), timeout=TIMEOUT)
+    executor.shutdown(wait=False)
+    results = {}
+    for network, future in futures.items():
+        if not future.done():
+            results[network] = eoshttp.Timeout('Timeout after {}s'.format(TIMEOUT))
+        elif future.exception():
+            results[network] = future.exception()
+        else:
+            results[network] = future.result()
+    return results
+
+def parse_thresholds(values, warning, critical):
+    # NETWORK:WARNING:CRITICAL, a missing value keeps the default
+    thresholds = {}
+    for value in values:
+        network, _, rest = value.partition(':')
+        w, _, c = rest.partition(':')
+        thresholds[network] = (int(w) if w else warning, int(c) if c else critical)
+    return thresholds
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description='Check BP status')
     parser.add_argument('-v', '--verbose', action='store_true', help = 'Print verbose logging to stdout')
     parser.add_argument('-H', '--host', default='localhost',
@@ -46,30 +61,67 @@ def main(argv):
     parser.add_argument('-s', '--ssl', action='store_true', default=False, help = 'Use ssl to connect to the api endpoint')
     parser.add_argument('-t', '--timeout', type=int, default=3, help = 'Timeout in seconds')
     parser.add_argument('-w', '--warning', type=int, default='10',
-                        help='warning threshold of head block - last indexed block. default 10')
+                        help='warning threshold of the sync lag of a network in seconds. default 10')
     parser.add_argument('-c', '--critical', type=int, default='100',
-                        help='critical threshold of head block - last indexed block. default 100')
-    
-    args = parser.parse_args()
+                        help='critical threshold of the sync lag of a network in seconds. default 100')
+    parser.add_argument('-n', '--networks',
+                        help='Comma separated networks to check. default = every network in /api/networks')
+    parser.add_argument('-T', '--threshold', action='append', default=[],
+                        help='Thresholds of one network as NETWORK:WARNING:CRITICAL, e.g. wax:30:300. Can be repeated')
+    tracing.add_arguments(parser)
+    return parser
+
+def check(args, cache = None):
     HOST = args.host
     TIMEOUT = args.timeout
     PORT = args.port
     SSL = args.ssl
     VERBOSE = args.verbose
-    W_THRESHOLD = args.critical
-    C_THRESHOLD = args.warning
+    W_THRESHOLD = args.warning
+    C_THRESHOLD = args.critical
+    thresholds = parse_thresholds(args.threshold, W_THRESHOLD, C_THRESHOLD)
 
     output_message = ''
     output_status = SERVICE_STATUS['OK']
     response, http_query_time = get_health(HOST, PORT, SSL, TIMEOUT, VERBOSE)
 
     if response != "OK": 
-      print(f'HTTP CRITICAL: NOT OK, reponse: {response}')
-      sys.exit(SERVICE_STATUS['CRITICAL'])
-    
-    output_message = 'Everything Ok'
-    print('{} | http_query_time={}s'.format(output_message.rstrip(), http_query_time))
-    sys.exit(output_status)
+      raise CheckResult(SERVICE_STATUS['CRITICAL'], f'HTTP CRITICAL: NOT OK, reponse: {response}')
+
+    networks = args.networks.split(',') if args.networks else get_networks(HOST, PORT, SSL, TIMEOUT, VERBOSE)
+    if not networks:
+        raise CheckResult(SERVICE_STATUS['UNKNOWN'], 'No networks served by {}'.format(HOST))
+
+    performance_data = ['http_query_time={}s'.format(http_query_time)]
+    with tracing.span('sync', networks=len(networks)):
+        results = get_all_sync(HOST, PORT, SSL, TIMEOUT, networks)
+    for network, result in sorted(results.items()):
+        warning, critical = thresholds.get(network, (W_THRESHOLD, C_THRESHOLD))
+        if isinstance(result, Exception):
+            output_message += "{}: {}. ".format(network, eoshttp.nagios_error(result, VERBOSE)[1].replace('HTTP CRITICAL: ', ''))
+            output_status = SERVICE_STATUS['CRITICAL']
+            performance_data.append("'{}_lag'=Us;{};{}".format(network, warning, critical))
+            continue
+        lag, sync_status = result
+        performance_data.append("'{}_lag'={}s;{};{}".format(network, lag, warning, critical))
+        if lag > critical:
+            output_message += "{} is {}s behind. ".format(network, lag)
+            output_status = SERVICE_STATUS['CRITICAL']
+        elif lag > warning:
+            output_message += "{} is {}s behind. ".format(network, lag)
+            output_status = max(output_status, SERVICE_STATUS['WARNING'])
+        elif sync_status != 'OK':
+            output_message += "{} reports {}. ".format(network, sync_status)
+            output_status = max(output_status, SERVICE_STATUS['WARNING'])
+
+    if not output_message:
+        output_message = 'Everything Ok, {} networks in sync'.format(len(networks))
+    return output_status, '{} | {}'.format(output_message.rstrip(), ' '.join(performance_data))
+
+def main(argv):
+    args = build_parser().parse_args()
+    tracing.configure_from(args)
+    nagios.exit_with(check, args)
 
 if __name__ == "__main__":
     main(sys.argv)
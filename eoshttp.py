@@ -0,0 +1,258 @@
+import json
+import time
+import socket
+import threading
+import http.client
+import urllib.parse
+import tracing
+from nagios import SERVICE_STATUS, CheckResult
+
+# HTTP client shared by the check scripts, eoslpb.py and bp_failover.py.
+#
+# Connections are kept alive and pooled per host, DNS answers are cached for
+# dns_ttl seconds and TLS sessions are resumed on new connections to the same
+# host. Every response carries the time spent in each phase of the request:
+# dns, connect, tls, ttfb (request sent until headers received) and parse
+# (body read and decoded). Phases skipped thanks to a pooled connection are 0.
+
+DEFAULT_TIMEOUT = 3
+
+class HttpError(Exception):
+    pass
+
+class Timeout(HttpError):
+    pass
+
+class ConnectError(HttpError):
+    pass
+
+class StatusError(HttpError):
+    def __init__(self, response):
+        HttpError.__init__(self, 'HTTP status {}'.format(response.status_code))
+        self.response = response
+        self.status_code = response.status_code
+
+class Response:
+    def __init__(self, status_code, headers, content, timings):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.timings = timings
+        self.elapsed = round(timings['dns'] + timings['connect'] + timings['tls'] + timings['ttfb'], 6)
+        self._json = None
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        if self._json == None:
+            start = time.perf_counter()
+            self._json = json.loads(self.content)
+            self.timings['parse'] += time.perf_counter() - start
+        return self._json
+
+class Resolver:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def resolve(self, host, port):
+        key = (host, port)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry[0] < self.ttl:
+                return entry[1]
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with self.lock:
+            self.entries[key] = (time.time(), addresses)
+        return addresses
+
+class Connection(http.client.HTTPConnection):
+    def __init__(self, client, scheme, host, port, verify, timeout):
+        http.client.HTTPConnection.__init__(self, host, port, timeout=timeout)
+        self.client = client
+        self.scheme = scheme
+        self.verify = verify
+        self.timings = {'dns': 0.0, 'connect': 0.0, 'tls': 0.0}
+
+    def connect(self):
+        start = time.perf_counter()
+        addresses = self.client.resolver.resolve(self.host, self.port)
+        resolved = time.perf_counter()
+        error = None
+        sock = None
+        for family, socktype, proto, canonname, address in addresses:
+            sock = socket.socket(family, socktype, proto)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(address)
+                break
+            except OSError as e:
+                sock.close()
+                sock = None
+                error = e
+        if sock == None:
+            raise error or OSError('No address for {}'.format(self.host))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connected = time.perf_counter()
+        if self.scheme == 'https':
+            key = (self.host, self.port, self.verify)
+            sock = self.client.ssl_context(self.verify).wrap_socket(sock, server_hostname=self.host,
+                                                                    session=self.client.tls_sessions.get(key))
+            self.client.tls_sessions[key] = sock.session
+        self.sock = sock
+        self.timings = {
+            'dns': resolved - start,
+            'connect': connected - resolved,
+            'tls': time.perf_counter() - connected
+        }
+
+class Client:
+    def __init__(self, dns_ttl = 60, max_idle = 32):
+        self.resolver = Resolver(dns_ttl)
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.tls_sessions = {}
+        self.contexts = {}
+
+    def ssl_context(self, verify):
+        # ssl is only imported by the first https request, it is the most
+        # expensive import of a plain http check
+        import ssl
+        if not verify in self.contexts:
+            context = ssl.create_default_context()
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            self.contexts[verify] = context
+        return self.contexts[verify]
+
+    def _acquire(self, key, timeout):
+        with self.lock:
+            pool = self.idle.get(key)
+            if pool:
+                conn = pool.pop()
+                conn.timeout = timeout
+                if conn.sock != None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return Connection(self, key[0], key[1], key[2], key[3], timeout), False
+
+    def _release(self, key, conn):
+        with self.lock:
+            pool = self.idle.setdefault(key, [])
+            if len(pool) < self.max_idle:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, data = None, json_data = None, timeout = DEFAULT_TIMEOUT, verify = True, headers = None):
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme or 'http'
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parsed.hostname, port, verify)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        if json_data != None:
+            data = json.dumps(json_data)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        request_headers = {'Connection': 'keep-alive', 'Accept': 'application/json'}
+        request_headers.update(headers or {})
+
+        with tracing.span('http', method=method, url=url) as span:
+            response = self._request(key, method, path, data, request_headers, timeout)
+            span.set(status=response.status_code, reused=response.timings['dns'] == 0 and response.timings['connect'] == 0)
+            tracing.phases(response.timings)
+            return response
+
+    def _request(self, key, method, path, data, request_headers, timeout):
+        while True:
+            conn, reused = self._acquire(key, timeout)
+            try:
+                if conn.sock == None:
+                    conn.connect()
+                    timings = dict(conn.timings)
+                else:
+                    timings = {'dns': 0.0, 'connect': 0.0, 'tls': 0.0}
+                sent = time.perf_counter()
+                conn.request(method, path, body=data, headers=request_headers)
+                response = conn.getresponse()
+                timings['ttfb'] = time.perf_counter() - sent
+                read = time.perf_counter()
+                content = response.read()
+                timings['parse'] = time.perf_counter() - read
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                conn.close()
+                if reused:
+                    # The server closed the idle keep-alive connection, retry on a new one
+                    continue
+                raise ConnectError(str(e))
+            except socket.timeout as e:
+                conn.close()
+                raise Timeout('Timeout after {}s'.format(timeout))
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise ConnectError(str(e))
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+            return Response(response.status, response.headers, content, timings)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+CLIENT = Client()
+
+def get(url, **kwargs):
+    return CLIENT.request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return CLIENT.request('POST', url, **kwargs)
+
+def url(HOST, PORT, SSL, path):
+    return '{}://{}:{}{}'.format('http' if not SSL else 'https', HOST, PORT, path)
+
+def nagios_error(e, VERBOSE = False):
+    # Same status and output for a failed request in every check script
+    if isinstance(e, StatusError):
+        return SERVICE_STATUS['CRITICAL'], 'HTTP CRITICAL: The server couldn\'t fulfill the request. Error code: {}'.format(e.status_code)
+    if isinstance(e, (Timeout, ConnectError)):
+        return SERVICE_STATUS['CRITICAL'], 'HTTP CRITICAL: Failed to reach server. Reason: Timeout or Connection Error'
+    if isinstance(e, HttpError):
+        return SERVICE_STATUS['CRITICAL'], 'HTTP CRITICAL: Failed to reach server. Reason: {}'.format(e)
+    output = 'HTTP CRITICAL: Failed to reach server. Reason: Unknown'
+    if VERBOSE:
+        output += '\n{}'.format(e)
+    return SERVICE_STATUS['CRITICAL'], output
+
+def fetch(method, url, parse = 'json', **kwargs):
+    # Returns the decoded body and the response, raising StatusError when the
+    # server does not answer 200
+    response = CLIENT.request(method, url, **kwargs)
+    if response.status_code != 200:
+        raise StatusError(response)
+    if parse == 'json':
+        return response.json(), response
+    start = time.perf_counter()
+    text = response.text
+    response.timings['parse'] += time.perf_counter() - start
+    return text, response
+
+def checked_fetch(method, url, TIMEOUT, VERBOSE, parse = 'json', **kwargs):
+    # fetch for the check scripts: any failure finishes the check as CRITICAL
+    try:
+        return fetch(method, url, parse, timeout=TIMEOUT, **kwargs)
+    except Exception as e:
+        raise CheckResult(*nagios_error(e, VERBOSE))
+
+def timings_perfdata(timings):
+    return ' '.join('{}={:.6f}s'.format(phase, timings[phase]) for phase in ['dns', 'connect', 'tls', 'ttfb', 'parse'])
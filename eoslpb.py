@@ -1,19 +1,232 @@
 #!/usr/bin/env python
-import requests
+import eoshttp
 import time
-import mpu.io
+import lpbstore
+import producer_schedule
+import prodlog
 import optparse
 import json
+import threading
+import collections
+import concurrent.futures
+import statestore
+import tracing
 from tendo import singleton
 
+# A failed request counts as this many seconds of latency when ranking endpoints
+ERROR_PENALTY = 2.0
+
 def get_info(endpoint):
-    return requests.get('{}/v1/chain/get_info'.format(endpoint), timeout=2.0).json()
+    return eoshttp.fetch('GET', '{}/v1/chain/get_info'.format(endpoint), timeout=2.0)[0]
 
 def make_request(endpoint, function, data):
-    return requests.post('{}/v1/chain/{}'.format(endpoint, function), timeout=2.0, data=json.dumps(data)).json()['rows']
+    return eoshttp.fetch('POST', '{}/v1/chain/{}'.format(endpoint, function), timeout=2.0, data=json.dumps(data))[0]['rows']
+
+def get_schedule(endpoint):
+    return eoshttp.fetch('GET', '{}/v1/chain/get_producer_schedule'.format(endpoint), timeout=2.0)[0]
+
+def get_block(endpoint, block_num):
+    return eoshttp.fetch('POST', '{}/v1/chain/get_block'.format(endpoint), timeout=2.0, data=json.dumps({'block_num_or_id': block_num}))[0]
+
+class EndpointPool:
+    # Keeps a rolling latency and error score per endpoint and sends every
+    # request to the best one first. If it has not answered after hedge_after
+    # seconds the same request goes to the second best and the first answer
+    # wins. Errors fade with a half life so a node that was down is tried again
+    # later. The scores are saved so a restart does not begin with a dead node.
+    def __init__(self, endpoints, hedge_after, state_file = None, alpha = 0.3, error_half_life = 300, workers = None):
+        self.endpoints = endpoints
+        self.hedge_after = hedge_after
+        self.state_file = state_file
+        self.alpha = alpha
+        self.error_half_life = error_half_life
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or 2 * len(endpoints))
+        saved = statestore.load(state_file, {}) if state_file else {}
+        self.stats = {e: saved.get(e, {'latency': None, 'errors': 0.0, 'updated': 0}) for e in endpoints}
+        self.saved = 0
+
+    def score(self, endpoint):
+        stats = self.stats[endpoint]
+        errors = stats['errors'] * 0.5 ** (max(time.time() - stats['updated'], 0) / self.error_half_life)
+        return (stats['latency'] or 0) + errors * ERROR_PENALTY
+
+    def ranked(self):
+        with self.lock:
+            return sorted(self.endpoints, key=self.score)
+
+    def record(self, endpoint, latency, ok):
+        with self.lock:
+            stats = self.stats[endpoint]
+            if ok:
+                stats['latency'] = latency if stats['latency'] == None else (1 - self.alpha) * stats['latency'] + self.alpha * latency
+            stats['errors'] = (1 - self.alpha) * stats['errors'] + (0 if ok else self.alpha)
+            stats['updated'] = time.time()
+
+    def timed(self, endpoint, function, *args):
+        start = time.perf_counter()
+        try:
+            result = function(endpoint, *args)
+        except Exception:
+            self.record(endpoint, time.perf_counter() - start, False)
+            raise
+        self.record(endpoint, time.perf_counter() - start, True)
+        return result
+
+    def call(self, function, *args):
+        # Returns the first answer and the endpoint that gave it. Endpoints are
+        # tried in rank order until one answers
+        ranked = self.ranked()
+        futures = {}
+        error = None
+        futures[self.executor.submit(self.timed, ranked[0], function, *args)] = ranked[0]
+        launched = 1
+        while futures:
+            hedge = len(futures) == 1 and launched < len(ranked)
+            done, _ = concurrent.futures.wait(futures, timeout=self.hedge_after if hedge else None,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                endpoint = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                # Endpoints still working on it are scored by timed() with
+                # their own latency or error once they finish
+                return result, endpoint
+            if (not done or not futures) and launched < len(ranked):
+                futures[self.executor.submit(self.timed, ranked[launched], function, *args)] = ranked[launched]
+                launched += 1
+        raise error
+
+    def save(self, interval = 30):
+        if self.state_file and time.time() - self.saved >= interval:
+            with self.lock:
+                stats = json.loads(json.dumps(self.stats))
+            statestore.save(self.state_file, stats)
+            self.saved = time.time()
+
+class ScheduleTracker:
+    # Fetches get_producer_schedule only when the blocks carry a schedule
+    # version we have not seen. Without block headers (info mode), and while a
+    # schedule change is proposed or pending, it refetches every `refresh`
+    # seconds instead. The slot where a new schedule became active is kept in
+    # the store, so the lpb check does not judge turns of the old schedule.
+    # Blocks of an older version than the stored one, replayed while catching
+    # up, do not trigger a fetch and their turns are not counted.
+    def __init__(self, pool, store, refresh = 60):
+        self.pool = pool
+        self.store = store
+        self.refresh = refresh
+        self.version = store.schedule_version if store.producers else None
+        self.pending = None
+        self.proposed = None
+        self.fetched = 0
+        self.block_version = None
+
+    def describe(self, schedule):
+        return 'version {}: {}'.format(schedule['version'], ','.join(p['producer_name'] for p in schedule['producers']))
 
-def get_producers(endpoint, limit = 1000):
-    return requests.get('{}/v1/chain/get_producer_schedule'.format(endpoint), timeout=2.0).json()['active']['producers']
+    def current(self, block_version):
+        return block_version == None or self.version == None or block_version >= self.version
+
+    def due(self, block_version):
+        age = time.time() - self.fetched
+        if self.version == None or (block_version != None and block_version > self.version):
+            # At most once a second while the API still reports the old version
+            return age >= 1
+        if block_version == None or self.pending or self.proposed:
+            return age >= self.refresh
+        return False
+
+    def update(self, block_version = None, slot = None):
+        previous, self.block_version = self.block_version, block_version
+        if block_version != None and block_version == self.version and previous != None and previous < block_version and slot != None:
+            # The schedule was fetched while replaying older blocks, it became
+            # active with this one
+            print('Schedule version {} active since slot {}'.format(block_version, slot))
+            self.store.set_producers(self.store.producers, self.version, slot)
+        if not self.due(block_version):
+            return False
+        schedule, endpoint = self.pool.call(get_schedule)
+        self.fetched = time.time()
+        for kind in ['pending', 'proposed']:
+            if schedule.get(kind) and schedule[kind] != getattr(self, kind):
+                print('Schedule {} {}'.format(kind, self.describe(schedule[kind])))
+            setattr(self, kind, schedule.get(kind))
+        active = schedule['active']
+        if active['version'] == self.version:
+            return False
+        print('Schedule active {}'.format(self.describe(active)))
+        # The block that carries a new version is the first one of the schedule.
+        # On the first fetch we do not know when it became active, unless the
+        # block is older than the schedule: then that is fixed up by the first
+        # block of the new version
+        if self.version == None and block_version in (None, active['version']):
+            slot = 0
+        elif slot == None or block_version != active['version']:
+            slot = producer_schedule.ms_to_slot(int(time.time() * 1000))
+        self.version = active['version']
+        self.store.set_producers([p['producer_name'] for p in active['producers']], self.version, slot)
+        return True
+
+def stream_blocks(fetch_block, start, end, executor, window):
+    # Keeps up to `window` get_block requests in flight and yields the blocks in
+    # order, so no block between start and end is skipped
+    pending = collections.deque()
+    next_num = start
+    try:
+        while next_num <= end and len(pending) < window:
+            pending.append(executor.submit(fetch_block, next_num))
+            next_num += 1
+        while pending:
+            block = pending.popleft().result()
+            if next_num <= end:
+                pending.append(executor.submit(fetch_block, next_num))
+                next_num += 1
+            yield block
+    finally:
+        for future in pending:
+            future.cancel()
+
+def ingest_blocks(pool, store, tracker, executor, window, max_catchup, prodlog = None):
+    info, endpoint = pool.call(get_info)
+    head_block_num = info['head_block_num']
+    start = store.last_block_num + 1
+    if start <= 1 or head_block_num - start > max_catchup:
+        start = max(1, head_block_num - max_catchup)
+
+    processed = 0
+    try:
+        # Irreversible blocks are the same on every endpoint, so they are hedged.
+        # Blocks above LIB stay on the endpoint that answered get_info, so a
+        # micro fork between endpoints can not mix blocks of two branches
+        lib = info['last_irreversible_block_num']
+        fetch_block = lambda block_num: (pool.call(get_block, block_num)[0] if block_num <= lib else
+                                         pool.timed(endpoint, get_block, block_num))
+        for block in stream_blocks(fetch_block, start, head_block_num, executor, window):
+            slot = producer_schedule.ms_to_slot(lpbstore.time_to_ms(block['timestamp']))
+            tracker.update(block.get('schedule_version'), slot)
+            # Blocks of an older schedule are not judged against the current one
+            current = tracker.current(block.get('schedule_version'))
+            if prodlog != None:
+                prodlog.record_block(block['block_num'], slot, block['producer'], store.producers if current else [])
+            store.update(block['producer'], block['timestamp'], block['block_num'], count_turn=True if current else None)
+            store.set_last_block(block['block_num'], block['timestamp'])
+            processed += 1
+            if processed % window == 0:
+                with tracing.span('flush'):
+                    store.flush()
+                    if prodlog != None:
+                        prodlog.flush()
+    finally:
+        if processed:
+            with tracing.span('flush'):
+                store.flush()
+                if prodlog != None:
+                    prodlog.flush()
+    return processed
 
 def main():
     #me = singleton.SingleInstance()
@@ -23,43 +236,66 @@ def main():
                     help="Coma separated list of API nodes. Defaults to https://nodes.get-scatter.com")
     parser.add_option("-n", '--network', dest="network", default="eos",
                     help="Network name. Defaults to eos")
+    parser.add_option("-f", '--format', dest="format", default="store", choices=["store", "json"],
+                    help="store: fixed-layout <network>.lpb file updated in place. json: legacy <network>.lpb.json. Defaults to store")
+    parser.add_option("-m", '--mode', dest="mode", default="blocks", choices=["blocks", "info"],
+                    help="blocks: process every block since the last one seen. info: sample get_info every 3 seconds. Defaults to blocks")
+    parser.add_option("-w", '--window', dest="window", type="int", default=20,
+                    help="Number of get_block requests kept in flight in blocks mode. Defaults to 20")
+    parser.add_option("-x", '--max-catchup', dest="max_catchup", type="int", default=7200,
+                    help="Maximum number of blocks to catch up after a stall or restart. Defaults to 7200")
+    parser.add_option("-H", '--hedge-after', dest="hedge_after", type="float", default=0.3,
+                    help="Seconds to wait for the best endpoint before sending the same request to the second best. Defaults to 0.3")
+    parser.add_option("-r", '--schedule-refresh', dest="schedule_refresh", type="int", default=60,
+                    help="Seconds between get_producer_schedule calls in info mode or while a schedule change is proposed or pending. Defaults to 60")
+    parser.add_option("-s", '--state-dir', dest="state_dir", default=statestore.DEFAULT_STATE_DIR,
+                    help="Directory where the endpoint scores are kept between restarts. Defaults to {}".format(statestore.DEFAULT_STATE_DIR))
+    parser.add_option("-p", '--prodlog', dest="prodlog",
+                    help="Also append every block and missed slot to this production log (see prodlog.py), blocks mode only")
+    parser.add_option("--trace", dest="trace",
+                    help="Write timed spans of every phase to this json lines file, - for stderr")
+    parser.add_option("--trace-sample", dest="trace_sample", type="float", default=1.0,
+                    help="Probability that this run is traced. Defaults to 1")
+    parser.add_option("--profile", dest="profile", help="Run cProfile and write the stats to this file on exit")
     options, args = parser.parse_args()
+    tracing.configure(options.trace, options.trace_sample, options.profile)
 
     endpoints = options.endpoints.split(',')
     network = options.network
+    mode = options.mode
 
-    json_file = '{}.lpb.json'.format(network)
-    try:
-        eoslpb = mpu.io.read(json_file)
-    except:
-        eoslpb = {
-        }
-        mpu.io.write(json_file, eoslpb)
+    if options.format == 'json':
+        store = lpbstore.JsonLpbStore('{}.lpb.json'.format(network))
+    else:
+        store = lpbstore.LpbStore('{}.lpb'.format(network))
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=options.window)
+    # Every get_block in flight can be hedged to all the endpoints
+    pool = EndpointPool(endpoints, options.hedge_after, statestore.state_path(options.state_dir, 'eoslpb', network, 'endpoints'),
+                        workers=options.window * len(endpoints))
+
+    tracker = ScheduleTracker(pool, store, options.schedule_refresh)
+    log = prodlog.ProdLog(options.prodlog) if options.prodlog and mode == 'blocks' else None
 
     while True:
-        for endpoint in endpoints: 
+        if mode == 'blocks':
             try:
-                info = get_info(endpoint)
-            except:
-                print('Error getting info from endpoint {}'.format(endpoint))
-                continue
-            try:    
-                if not info['head_block_producer'] in eoslpb:
-                    eoslpb[info['head_block_producer']] = {}
-                eoslpb[info['head_block_producer']]['last_block_produced_time'] = info['head_block_time']
-            except:
-                print('Error getting head_block_producer from endpoint {}'.format(endpoint))
-                continue
-
+                with tracing.span('ingest') as span:
+                    span.set(blocks=ingest_blocks(pool, store, tracker, executor, options.window, options.max_catchup, log))
+            except Exception as e:
+                print('Error getting blocks: {}'.format(e))
+        else:
             try:
-                producers = get_producers(endpoint)
-            except:
-                print('Error getting producers from endpoint {}'.format(endpoint))
-                continue
-            eoslpb['producers'] = [ p['producer_name'] for p in producers ]
-            mpu.io.write(json_file, eoslpb)
-            break
-        time.sleep(3)
+                with tracing.span('sample'):
+                    info, endpoint = pool.call(get_info)
+                    tracker.update()
+                    store.update(info['head_block_producer'], info['head_block_time'], info['head_block_num'])
+                    store.set_last_block(info['head_block_num'], info['head_block_time'])
+                    store.flush()
+            except Exception as e:
+                print('Error getting info: {}'.format(e))
+        pool.save()
+        time.sleep(3 if mode == 'info' else 0.5)
 
 if __name__ == "__main__":
     main()
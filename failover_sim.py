@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+# Failover simulation. Starts a stand-in nodeos per endpoint serving
+# /v1/chain/get_info and /v1/producer/pause|resume|paused, runs bp_failover.py
+# against them, injects a fault in the producing node and measures the time
+# until another node is resumed. Faults:
+#   stall        the head stops advancing
+#   slow         every response takes --slow_delay seconds
+#   refused      the node stops accepting connections
+#   pause_fails  the head stops advancing and pause calls fail while the old
+#                producer still reports it is producing. No other node may be
+#                resumed for --blocked_wait seconds. Then pause calls work
+#                again and the failover time is measured from that point
+#
+# Every fault is run for every endpoint count and weight layout. A run checks
+# that the new producer is the healthy endpoint with the highest weight and
+# fails if more than one node is left producing or the failover took longer
+# than --max_failover seconds. Before that the pause,
+# resume and paused calls of bp_failover.py are checked against the state of
+# stand-in nodes. Save a run with --save and compare later
+# runs with --baseline to track failover time across releases.
+
+import argparse
+import os
+import sys
+import json
+import time
+import shlex
+import datetime
+import tempfile
+import threading
+import statistics
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+FAULTS = ['stall', 'slow', 'refused', 'pause_fails']
+
+class ProducerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, status = 200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_one_request(self):
+        # Connections already open are dropped too when the node goes away
+        if self.server.node.refused:
+            self.close_connection = True
+            return
+        BaseHTTPRequestHandler.handle_one_request(self)
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        node = self.server.node
+        # A keep-alive connection may have been waiting for this request
+        if node.refused:
+            self.close_connection = True
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if node.delay:
+            time.sleep(node.delay)
+        if self.path.startswith('/v1/chain/get_info'):
+            self.send_json(node.info())
+        elif self.path == '/v1/producer/paused':
+            self.send_json(node.paused)
+        elif self.path == '/v1/producer/pause':
+            node.pause_calls += 1
+            if node.pause_fails:
+                self.send_json({'code': 500, 'message': 'Internal Service Error'}, 500)
+            else:
+                node.paused = True
+                self.send_json({'result': 'ok'})
+        elif self.path == '/v1/producer/resume':
+            node.paused = False
+            node.resumed_at = time.monotonic()
+            self.send_json({'result': 'ok'})
+        else:
+            self.send_json({'code': 404, 'message': 'Not Found'}, 404)
+
+class MockNodeos:
+    def __init__(self, start_head = 1000):
+        self.start = time.monotonic()
+        self.start_head = start_head
+        self.stalled_head = None
+        self.paused = False
+        self.resumed_at = None
+        self.delay = 0
+        self.refused = False
+        self.pause_fails = False
+        self.pause_calls = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ProducerHandler)
+        self.server.daemon_threads = True
+        self.server.node = self
+        # Clients giving up on the slow fault are expected
+        self.server.handle_error = lambda request, address: None
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def head(self):
+        if self.stalled_head != None:
+            return self.stalled_head
+        return self.start_head + int((time.monotonic() - self.start) * 2)
+
+    def info(self):
+        head = self.head()
+        head_time = self.stalled_time if self.stalled_head != None else datetime.datetime.utcnow()
+        return {
+            'head_block_num': head,
+            'last_irreversible_block_num': head - 325,
+            'head_block_time': head_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3],
+            'chain_id': 'ab' * 32
+        }
+
+    def fault(self, fault, slow_delay):
+        if fault in ['stall', 'pause_fails']:
+            self.stalled_head = self.head()
+            self.stalled_time = datetime.datetime.utcnow()
+        if fault == 'pause_fails':
+            self.pause_fails = True
+        if fault == 'slow':
+            self.delay = slow_delay
+        if fault == 'refused':
+            self.refused = True
+            self.server.shutdown()
+            self.server.server_close()
+
+    def close(self):
+        if not self.refused:
+            self.server.shutdown()
+            self.server.server_close()
+
+def weights_for(layout, count):
+    if layout == 'equal':
+        return [100] * count
+    return [100 - 10 * i for i in range(count)]
+
+def wait_for(condition, timeout, interval = 0.01):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = condition()
+        if result:
+            return result
+        time.sleep(interval)
+    return None
+
+def producing(nodes):
+    return [n for n in nodes if not n.paused and n.resumed_at != None]
+
+def check_endpoint_calls(timeout):
+    # Returns the failed assertions
+    import logging
+    import bp_failover
+    bp_failover.logger.addHandler(logging.NullHandler())
+    errors = []
+    def expect(condition, message):
+        if not condition:
+            errors.append(message)
+    endpoint = lambda node, i: {'desc': 'node{}'.format(i), 'network': 'SIM', 'host': '127.0.0.1', 'port': node.port, 'weight': 100 - i}
+    a, b = MockNodeos(), MockNodeos()
+    ea, eb = endpoint(a, 0), endpoint(b, 1)
+    try:
+        expect(bp_failover.disable_endpoint(ea, timeout), 'disable_endpoint failed')
+        expect(a.paused, 'disable_endpoint did not pause the node')
+        expect(bp_failover.producer_paused(ea, timeout) == True, 'producer_paused is not True after a pause')
+        expect(bp_failover.enable_endpoint(ea, timeout), 'enable_endpoint failed')
+        expect(not a.paused and a.resumed_at != None, 'enable_endpoint did not resume the node')
+        expect(bp_failover.producer_paused(ea, timeout) == False, 'producer_paused is not False after a resume')
+
+        # b takes over from a
+        expect(bp_failover.activate([eb], [ea, eb], timeout) is eb, 'activate did not return the candidate')
+        expect(a.paused and not b.paused, 'activate left a.paused={} b.paused={}'.format(a.paused, b.paused))
+
+        # a can not be paused and still produces: b must not be resumed
+        bp_failover.enable_endpoint(ea, timeout)
+        bp_failover.disable_endpoint(eb, timeout)
+        a.pause_fails = True
+        a.pause_calls = 0
+        expect(not bp_failover.disable_endpoint(ea, timeout), 'disable_endpoint succeeded on a failing pause')
+        expect(bp_failover.activate([eb], [ea, eb], timeout, retries=1) == None, 'activate resumed a node while another still produced')
+        expect(b.paused, 'b was resumed while a still produced')
+        expect(a.pause_calls == 3, 'expected 3 pause calls to a, got {}'.format(a.pause_calls))
+
+        # Once a is unreachable b can take over
+        a.fault('refused', 0)
+        expect(bp_failover.producer_paused(ea, timeout) == None, 'producer_paused of an unreachable node is not None')
+        expect(bp_failover.activate([eb], [ea, eb], timeout, retries=1) is eb, 'activate did not fail over from an unreachable node')
+        expect(not b.paused, 'b was not resumed after a became unreachable')
+    finally:
+        a.close()
+        b.close()
+    return errors
+
+def run_scenario(fault, count, layout, args, tmpdir):
+    nodes = [MockNodeos() for _ in range(count)]
+    weights = weights_for(layout, count)
+    config = {'endpoints': [{'desc': 'node{}'.format(i), 'network': 'SIM', 'host': '127.0.0.1', 'port': n.port, 'weight': w}
+                            for i, (n, w) in enumerate(zip(nodes, weights))]}
+    config_file = os.path.join(tmpdir, 'failover_{}_{}_{}.json'.format(fault, count, layout))
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    log_file = config_file.replace('.json', '.log')
+    command = [sys.executable, os.path.join(SCRIPT_PATH, 'bp_failover.py'), '-D', '-c', config_file, '-l', log_file] + shlex.split(args.failover_args)
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    result = {'fault': fault, 'endpoints': count, 'weights': layout, 'failover': None, 'producers': None, 'expected': False}
+    try:
+        # Lets the daemon settle on a single producer before breaking it
+        if not wait_for(lambda: len(producing(nodes)) == 1 and len([n for n in nodes if n.resumed_at]) >= 1, args.max_wait):
+            result['error'] = 'no single producer at startup'
+            return result
+        time.sleep(args.settle)
+        old = producing(nodes)[0]
+        fault_time = time.monotonic()
+        old.fault(fault, args.slow_delay)
+        resumed = lambda: [n for n in nodes if n is not old and not n.paused and n.resumed_at and n.resumed_at > fault_time]
+        if fault == 'pause_fails':
+            # The old producer can not be paused, nothing else may produce
+            if wait_for(resumed, args.blocked_wait):
+                result['error'] = 'resumed another node while the old producer could not be paused'
+                return result
+            if old.pause_calls < 2:
+                result['error'] = 'pause of the old producer not retried ({} calls)'.format(old.pause_calls)
+                return result
+            old.pause_fails = False
+            fault_time = time.monotonic()
+        new = wait_for(resumed, args.max_wait)
+        if not new:
+            result['error'] = 'no failover in {}s'.format(args.max_wait)
+            return result
+        result['failover'] = new[0].resumed_at - fault_time
+        # Healthy endpoint with the highest weight, first in the config on ties
+        healthy = [i for i, n in enumerate(nodes) if not n is old]
+        best = max(healthy, key=lambda i: (weights[i], -i))
+        result['expected'] = new[0] is nodes[best]
+        # A slow node only applies the pause once it gets to it
+        time.sleep(args.settle + (args.slow_delay if fault == 'slow' else 0))
+        result['producers'] = len([n for n in nodes if not n.paused and not n.refused])
+        return result
+    finally:
+        process.terminate()
+        process.wait()
+        for n in nodes:
+            n.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Measure bp_failover.py failover time against stand-in producer nodes')
+    parser.add_argument('-f', '--faults', default=','.join(FAULTS),
+                        help='Comma separated list of faults. default = {}'.format(','.join(FAULTS)))
+    parser.add_argument('-e', '--endpoints', default='2,3,5', help='Comma separated endpoint counts. default = 2,3,5')
+    parser.add_argument('-w', '--weights', default='descending',
+                        help='Comma separated weight layouts: equal, descending. default = descending')
+    parser.add_argument('-n', '--runs', type=int, default=1, help='Runs per scenario. default = 1')
+    parser.add_argument('-a', '--failover_args', default='', help='Extra arguments for bp_failover.py, e.g. "--stall 2"')
+    parser.add_argument('--slow_delay', type=float, default=5, help='Response delay of the slow fault. default = 5')
+    parser.add_argument('--settle', type=float, default=1, help='Seconds to wait before the fault and before counting producers. default = 1')
+    parser.add_argument('--max_wait', type=float, default=30, help='Seconds to wait for a failover. default = 30')
+    parser.add_argument('--max_failover', type=float, default=6,
+                        help='Failover time target, about one producer round. A slower failover fails the run. default = 6')
+    parser.add_argument('--blocked_wait', type=float, default=8,
+                        help='pause_fails: seconds during which no other node may be resumed. default = 8')
+    parser.add_argument('--timeout', type=float, default=3, help='Timeout of the endpoint calls. default = 3')
+    parser.add_argument('--save', help='Write the results to this json file')
+    parser.add_argument('--baseline', help='json file from a previous --save to compare with')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    errors = check_endpoint_calls(args.timeout)
+    for error in errors:
+        print('Endpoint calls: {}'.format(error))
+    if not errors:
+        print('Endpoint calls: ok')
+
+    tmpdir = tempfile.mkdtemp()
+    results = {}
+    failed = bool(errors)
+    print('{:<12} {:>9} {:<10} {:>10} {:>10} {:>9} {:>9} {:>8}'.format('fault', 'endpoints', 'weights', 'median s', 'max s',
+                                                                       'producers', 'expected', 'vs base'))
+    for fault in args.faults.split(','):
+        for count in [int(c) for c in args.endpoints.split(',')]:
+            for layout in args.weights.split(','):
+                runs = [run_scenario(fault, count, layout, args, tmpdir) for _ in range(args.runs)]
+                times = [r['failover'] for r in runs if r['failover'] != None]
+                name = '{}/{}/{}'.format(fault, count, layout)
+                results[name] = {
+                    'median': statistics.median(times) if times else None,
+                    'max': max(times) if times else None,
+                    'producers': max(r['producers'] or 0 for r in runs),
+                    'expected': all(r['expected'] for r in runs),
+                    'errors': [r['error'] for r in runs if 'error' in r]
+                }
+                if times and max(times) > args.max_failover:
+                    results[name]['errors'].append('failover took {:.2f}s, target {:g}s'.format(max(times), args.max_failover))
+                row = results[name]
+                compare = ''
+                if row['median'] != None and baseline.get(name, {}).get('median'):
+                    compare = '{:+.0%}'.format(row['median'] / baseline[name]['median'] - 1)
+                failed = failed or bool(row['errors']) or not row['expected'] or row['producers'] > 1
+                seconds = lambda v: '{:.2f}'.format(v) if v != None else '-'
+                print('{:<12} {:>9} {:<10} {:>10} {:>10} {:>9} {:>9} {:>8}'.format(fault, count, layout, seconds(row['median']),
+                                                                                   seconds(row['max']), row['producers'],
+                                                                                   'yes' if row['expected'] else 'no', compare))
+                for error in row['errors']:
+                    print('    {}'.format(error))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4)
+    print('Logs in {}'.format(tmpdir))
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# Checks every p2p-peer-address of a nodeos config at the same time and prints
+# the reachable ones ordered by connect round trip time, ready to paste back
+# into config.ini. Each peer is connected to several times and ranked by its
+# median RTT, peers that failed some attempts go after the ones that never did.
+# Every worker holds at most one socket, so --workers caps the open sockets.
+#
+# With --handshake each reachable peer is also asked for its head over the
+# p2p protocol (p2p_handshake.py). Peers on another chain or that send a
+# go_away are dropped, and peers more than --max_lag blocks behind our node go
+# after the ones that can actually help us sync.
+
+import argparse
+import sys
+import socket
+import threading
+import statistics
+import concurrent.futures
+import check_eos_bp
+import p2p_handshake
+
+def read_peers(config_file):
+    peers = []
+    with open(config_file) as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith('p2p-peer-address'):
+                continue
+            address = line.split('=', 1)[1].split('#')[0].strip()
+            if address and not address in peers:
+                peers.append(address)
+    return peers
+
+def split_address(address):
+    host, port = address.rsplit(':', 1)
+    return host.strip('[]'), int(port)
+
+def resolve(host, port, timeout):
+    # getaddrinfo can not be given a timeout, so a lookup that hangs is left
+    # behind in its own thread. Returns the first IPv4 or IPv6 address
+    answer = []
+    def lookup():
+        try:
+            answer.extend(socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM))
+        except OSError:
+            pass
+    thread = threading.Thread(target=lookup, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if not answer:
+        raise OSError('Can not resolve {} in {}s'.format(host, timeout))
+    return answer[0][4][0]
+
+def probe_peer(address, samples, timeout, info = None):
+    # Resolved once so the samples only measure the tcp connect
+    result = {'address': address, 'rtts': [], 'failures': samples, 'lag': None}
+    try:
+        host, port = split_address(address)
+        ip = resolve(host, port, timeout)
+    except (ValueError, OSError):
+        return result
+    for _ in range(samples):
+        rtt = check_eos_bp.p2p_connect_time(ip, port, timeout)
+        if rtt != None:
+            result['rtts'].append(rtt)
+    result['failures'] = samples - len(result['rtts'])
+    if info and result['rtts']:
+        try:
+            handshake = p2p_handshake.probe(ip, port, info['chain_id'], timeout)
+            if 'go_away' in handshake:
+                result['go_away'] = handshake['go_away']
+            else:
+                result['lag'] = p2p_handshake.lag(handshake, info['head_block_num'])
+        except (OSError, p2p_handshake.ProtocolError) as e:
+            result['go_away'] = str(e) or type(e).__name__
+    return result
+
+def probe_peers(peers, samples, timeout, workers, info = None):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda p: probe_peer(p, samples, timeout, info), peers))
+
+def usable(result):
+    return result['rtts'] and not 'go_away' in result
+
+def rank(results, max_lag = None):
+    reachable = [r for r in results if usable(r)]
+    for r in reachable:
+        r['median'] = statistics.median(r['rtts'])
+    lagging = lambda r: max_lag != None and r['lag'] != None and r['lag'] > max_lag
+    return sorted(reachable, key=lambda r: (lagging(r), r['failures'], r['median']))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Print the reachable p2p peers of a nodeos config ordered by round trip time')
+    parser.add_argument('config_file', help='nodeos config.ini')
+    parser.add_argument('-n', '--samples', type=int, default=3, help='Connections per peer. default = 3')
+    parser.add_argument('-t', '--timeout', type=float, default=1, help='Connect timeout in seconds. default = 1')
+    parser.add_argument('-w', '--workers', type=int, default=64, help='Peers probed at the same time. default = 64')
+    parser.add_argument('-T', '--top', type=int, help='Only print the N fastest peers')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print the RTT of every peer to stderr')
+    parser.add_argument('-H', '--handshake', action='store_true',
+                        help='Perform the p2p handshake and rank the peers by how far behind our node they are')
+    parser.add_argument('-a', '--api', default='http://localhost:8888',
+                        help='API of our node for --handshake. default = http://localhost:8888')
+    parser.add_argument('-l', '--max_lag', type=int, default=120,
+                        help='With --handshake, peers more than this many blocks behind our node go last. default = 120')
+    args = parser.parse_args()
+
+    try:
+        peers = read_peers(args.config_file)
+    except OSError:
+        print('Cant find config file: {}'.format(args.config_file))
+        sys.exit(1)
+
+    info = None
+    if args.handshake:
+        import eoshttp
+        try:
+            info = eoshttp.fetch('GET', '{}/v1/chain/get_info'.format(args.api.rstrip('/')), timeout=args.timeout)[0]
+        except Exception as e:
+            print('Error getting info from {}: {}'.format(args.api, e))
+            sys.exit(1)
+
+    results = probe_peers(peers, args.samples, args.timeout, args.workers, info)
+    ranked = rank(results, args.max_lag if args.handshake else None)
+    if args.top:
+        ranked = ranked[:args.top]
+
+    for r in ranked:
+        print('p2p-peer-address = {}'.format(r['address']))
+    if args.verbose:
+        for r in ranked:
+            lag = '' if r['lag'] == None else ' lag {} blocks'.format(r['lag'])
+            print('{:<48} {:>9.2f} ms {}/{} ok{}'.format(r['address'], r['median'] * 1000, len(r['rtts']), args.samples, lag), file=sys.stderr)
+        for r in results:
+            if not r['rtts']:
+                print('{:<48} unreachable'.format(r['address']), file=sys.stderr)
+            elif 'go_away' in r:
+                print('{:<48} go_away {}'.format(r['address'], r['go_away']), file=sys.stderr)
+    print('{} of {} peers usable'.format(len([r for r in results if usable(r)]), len(peers)), file=sys.stderr)
+
+if __name__ == "__main__":
+    main(sys.argv)
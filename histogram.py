@@ -0,0 +1,89 @@
+import math
+
+# Streaming latency histogram with log-linear buckets. Memory is fixed by the
+# range and precision, not by the number of samples, and percentiles are
+# within `precision` of the real value. Histograms with the same settings can
+# be merged and saved as json to compare runs.
+
+class LatencyHistogram:
+    def __init__(self, lowest = 1e-5, highest = 100.0, precision = 0.01):
+        self.lowest = lowest
+        self.highest = highest
+        self.precision = precision
+        self.log_base = math.log(1 + precision)
+        self.counts = [0] * (self.bucket(highest) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        if value <= self.lowest:
+            return 0
+        return int(math.log(value / self.lowest) / self.log_base) + 1
+
+    def bucket_value(self, index):
+        if index == 0:
+            return self.lowest
+        return self.lowest * (1 + self.precision) ** (index - 0.5)
+
+    def record(self, value):
+        self.counts[min(self.bucket(value), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min == None else min(self.min, value)
+        self.max = value if self.max == None else max(self.max, value)
+
+    def merge(self, other):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min == None else min(self.min, other.min)
+            self.max = other.max if self.max == None else max(self.max, other.max)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(p / 100.0 * self.count)))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(max(self.bucket_value(i), self.min), self.max)
+        return self.max
+
+    def count_below(self, value):
+        # Samples at or below value, as cumulative histogram buckets need
+        return sum(self.counts[:min(self.bucket(value), len(self.counts) - 1) + 1])
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def summary(self, percentiles = (50, 95, 99)):
+        result = {'count': self.count, 'min': self.min, 'max': self.max, 'mean': self.mean}
+        for p in percentiles:
+            result['p{}'.format(p)] = self.percentile(p)
+        return result
+
+    def to_dict(self):
+        return {
+            'lowest': self.lowest,
+            'highest': self.highest,
+            'precision': self.precision,
+            'counts': {str(i): c for i, c in enumerate(self.counts) if c},
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        h = cls(data['lowest'], data['highest'], data['precision'])
+        for i, c in data['counts'].items():
+            h.counts[int(i)] = c
+        h.count, h.total, h.min, h.max = data['count'], data['total'], data['min'], data['max']
+        return h
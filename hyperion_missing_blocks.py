@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Finds the block ranges missing from a Hyperion index by bisection.
+#
+# A range is split in two only when it is partially indexed, so the number of
+# count queries grows with the number of gaps times log(range length) instead
+# of the chain length. Every level of the bisection is queried concurrently.
+#
+# The counts come from the Elasticsearch block index Hyperion writes
+# (<chain>-block-*), the same index behind total_indexed_blocks in /v2/health.
+# The output is a list of [start, end] ranges ready to be fed to a reindex
+# (indexer.start_on / indexer.stop_on with indexer.rewrite enabled).
+
+import argparse
+import sys
+import json
+import base64
+import concurrent.futures
+import eoshttp
+
+def es_headers(user, password):
+    headers = {'Content-Type': 'application/json'}
+    if user:
+        token = base64.b64encode('{}:{}'.format(user, password or '').encode()).decode()
+        headers['Authorization'] = 'Basic {}'.format(token)
+    return headers
+
+class BlockIndex:
+    def __init__(self, es_url, index, headers, timeout):
+        self.es_url = es_url.rstrip('/')
+        self.index = index
+        self.headers = headers
+        self.timeout = timeout
+
+    def search(self, endpoint, query):
+        return eoshttp.fetch('POST', '{}/{}/{}'.format(self.es_url, self.index, endpoint), json_data=query,
+                             headers=self.headers, timeout=self.timeout)[0]
+
+    def count(self, start, end):
+        query = {'query': {'range': {'block_num': {'gte': start, 'lte': end}}}}
+        return self.search('_count', query)['count']
+
+    def bounds(self):
+        query = {'size': 0, 'aggs': {'first': {'min': {'field': 'block_num'}}, 'last': {'max': {'field': 'block_num'}}}}
+        aggs = self.search('_search', query)['aggregations']
+        return int(aggs['first']['value']), int(aggs['last']['value'])
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def find_missing(count, start, end, workers):
+    # Returns the merged missing ranges and the number of count queries made
+    missing = []
+    queries = 0
+    frontier = [(start, end)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while frontier:
+            counts = list(executor.map(lambda r: count(*r), frontier))
+            queries += len(frontier)
+            next_frontier = []
+            for (lo, hi), indexed in zip(frontier, counts):
+                if indexed >= hi - lo + 1:
+                    continue
+                if indexed == 0 or lo == hi:
+                    missing.append((lo, hi))
+                    continue
+                mid = (lo + hi) // 2
+                next_frontier += [(lo, mid), (mid + 1, hi)]
+            frontier = next_frontier
+    return merge_ranges(missing), queries
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Find the block ranges missing from a Hyperion index')
+    parser.add_argument('-e', '--es_url', default='http://localhost:9200',
+                        help='Elasticsearch url used by Hyperion. default = http://localhost:9200')
+    parser.add_argument('-n', '--chain', default='eos', help='Hyperion chain name. default = eos')
+    parser.add_argument('-i', '--index', help='Block index pattern. default = <chain>-block-*')
+    parser.add_argument('-u', '--user', help='Elasticsearch user')
+    parser.add_argument('-P', '--password', help='Elasticsearch password')
+    parser.add_argument('-s', '--start', type=int, help='First block to check. default = first indexed block')
+    parser.add_argument('-E', '--end', type=int, help='Last block to check. default = last indexed block')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='Concurrent count queries. default = 16')
+    parser.add_argument('-t', '--timeout', type=int, default=30, help='Timeout in seconds for each query. default = 30')
+    parser.add_argument('-j', '--json', action='store_true', help='Print the ranges as a json list')
+    args = parser.parse_args()
+
+    index = BlockIndex(args.es_url, args.index or '{}-block-*'.format(args.chain),
+                       es_headers(args.user, args.password), args.timeout)
+    start, end = args.start, args.end
+    if start == None or end == None:
+        first, last = index.bounds()
+        start = first if start == None else start
+        end = last if end == None else end
+
+    missing, queries = find_missing(index.count, start, end, args.workers)
+    total = sum(hi - lo + 1 for lo, hi in missing)
+    if args.json:
+        print(json.dumps(missing))
+    else:
+        for lo, hi in missing:
+            print('{}-{}'.format(lo, hi))
+    print('{} missing blocks in {} ranges between {} and {} ({} queries)'.format(total, len(missing), start, end, queries), file=sys.stderr)
+    sys.exit(1 if missing else 0)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+# Fixed-layout last produced block store written by eoslpb.py and read by
+# check_eos_bp.py -c lpb.
+#
+# The file is a 64 bytes header followed by one 48 bytes record per producer:
+#
+#   header: magic, version, record count, record size, last processed block
+#           num, last processed block time (ms), schedule version, schedule
+#           size, slot the schedule became active, flags, reserved
+#   record: seq, flags, account name, last block time (ms), last block num,
+#           first slot of the last turn, blocks signed in that turn, crc32 of
+#           flags..turn blocks
+#
+# The turn fields are only kept when blocks are processed one by one
+# (eoslpb.py --mode blocks), see producer_schedule.py for the slot math.
+#
+# Records never move once written, so a reader mmaps the file and looks up a
+# single account without parsing the rest. Each record is updated in place as
+# a seqlock (seq is odd while the writer is in the middle of an update) and
+# protected by a crc32, so a reader never accepts a half written record, even
+# when the writer crashed in the middle of an update.
+
+import os
+import mmap
+import struct
+import zlib
+import time
+import calendar
+import datetime
+import producer_schedule
+
+MAGIC = b'EOSLPB\x00\x01'
+VERSION = 1
+HEADER = struct.Struct('<8sIIIIqIIII16s')
+RECORD = struct.Struct('<II16sqIIII')
+SEQ = struct.Struct('<I')
+NAME_OFFSET = 8
+CRC_START = 4
+CRC_END = RECORD.size - 4
+
+FLAG_SCHEDULED = 0x1
+HEADER_FLAG_TURNS = 0x1
+POSITION_SHIFT = 8
+POSITION_MASK = 0xff00
+
+READ_RETRIES = 50
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+class LpbStoreError(Exception):
+    pass
+
+def time_to_ms(block_time):
+    dt = datetime.datetime.strptime(block_time, TIME_FORMAT)
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+
+def ms_to_time(ms):
+    return datetime.datetime.utcfromtimestamp(ms / 1000.0).strftime(TIME_FORMAT)[:-3]
+
+def encode_name(account):
+    name = account.encode('ascii')
+    if len(name) > 16:
+        raise LpbStoreError('Account name too long: {}'.format(account))
+    return name.ljust(16, b'\x00')
+
+def record_crc(body):
+    return zlib.crc32(body) & 0xffffffff
+
+def record_to_dict(record):
+    seq, flags, name, time_ms, block_num, turn_slot, turn_blocks, crc = record
+    return {
+        'account': name.rstrip(b'\x00').decode('ascii'),
+        'last_block_produced_time': ms_to_time(time_ms) if time_ms else None,
+        'last_block_produced': block_num,
+        'scheduled': bool(flags & FLAG_SCHEDULED),
+        'schedule_position': (flags & POSITION_MASK) >> POSITION_SHIFT,
+        'turn_slot': turn_slot,
+        'turn_blocks': turn_blocks
+    }
+
+def read_record(buf, offset):
+    record = None
+    for _ in range(READ_RETRIES):
+        record = RECORD.unpack_from(buf, offset)
+        body = bytes(buf[offset + CRC_START:offset + CRC_END])
+        if record[0] % 2 == 0 and SEQ.unpack_from(buf, offset)[0] == record[0] and record_crc(body) == record[-1]:
+            return record
+        time.sleep(0.001)
+    # The writer died in the middle of an update but the body is complete
+    if record_crc(bytes(buf[offset + CRC_START:offset + CRC_END])) == record[-1]:
+        return record
+    raise LpbStoreError('Corrupted record at offset {}'.format(offset))
+
+def read_header(buf):
+    if len(buf) < HEADER.size:
+        raise LpbStoreError('File too small')
+    header = HEADER.unpack_from(buf, 0)
+    magic, version, count, record_size = header[:4]
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise LpbStoreError('Not a lpb store or unsupported version')
+    count = min(count, (len(buf) - HEADER.size) // RECORD.size)
+    return {
+        'count': count,
+        'last_block_num': header[4],
+        'last_block_time': ms_to_time(header[5]) if header[5] else None,
+        'schedule_version': header[6],
+        'schedule_size': header[7],
+        'schedule_slot': header[8],
+        'counts_turns': bool(header[9] & HEADER_FLAG_TURNS)
+    }
+
+def find_record(buf, account, count):
+    name = encode_name(account)
+    end = HEADER.size + count * RECORD.size
+    pos = buf.find(name, HEADER.size, end)
+    while pos != -1:
+        offset = pos - NAME_OFFSET
+        if offset >= HEADER.size and (offset - HEADER.size) % RECORD.size == 0:
+            return offset
+        pos = buf.find(name, pos + 1, end)
+    return None
+
+def read_producer(path, account):
+    # Returns (header, record) for a single account. record is None when the
+    # account is not in the store
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            header = read_header(buf)
+            offset = find_record(buf, account, header['count'])
+            if offset is None:
+                return header, None
+            return header, record_to_dict(read_record(buf, offset))
+
+def read_all(path):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            header = read_header(buf)
+            records = [record_to_dict(read_record(buf, HEADER.size + i * RECORD.size)) for i in range(header['count'])]
+    return header, records
+
+class LpbStore:
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.records = {}
+        self.order = []
+        size = os.fstat(self.fd).st_size
+        if size < HEADER.size:
+            self.header = [MAGIC, VERSION, 0, RECORD.size, 0, 0, 0, 0, 0, 0, b'']
+            self._write_header()
+        else:
+            self.header = list(HEADER.unpack(os.pread(self.fd, HEADER.size, 0)))
+            if self.header[0] != MAGIC or self.header[1] != VERSION or self.header[3] != RECORD.size:
+                raise LpbStoreError('{} is not a lpb store or has an unsupported version'.format(path))
+            self._load(min(self.header[2], (size - HEADER.size) // RECORD.size))
+
+    def _load(self, count):
+        data = os.pread(self.fd, count * RECORD.size, HEADER.size)
+        for i in range(count):
+            offset = HEADER.size + i * RECORD.size
+            record = list(RECORD.unpack_from(data, i * RECORD.size))
+            body = data[i * RECORD.size + CRC_START:i * RECORD.size + CRC_END]
+            repair = record[0] % 2 == 1
+            if record_crc(body) != record[-1]:
+                # Torn write from a crash. Drop the data, it is refilled by
+                # the next block this producer signs
+                record[1], record[3], record[4] = 0, 0, 0
+                repair = True
+            record[0] -= record[0] % 2
+            name = record[2].rstrip(b'\x00').decode('ascii')
+            self.records[name] = (offset, record)
+            self.order.append(name)
+            if repair:
+                self._write_record(offset, record)
+
+    def _write_header(self):
+        os.pwrite(self.fd, HEADER.pack(*self.header), 0)
+
+    def _write_record(self, offset, record):
+        body = RECORD.pack(*record)[CRC_START:CRC_END]
+        record[-1] = record_crc(body)
+        record[0] += 1
+        os.pwrite(self.fd, SEQ.pack(record[0]), offset)
+        os.pwrite(self.fd, body + struct.pack('<I', record[-1]), offset + CRC_START)
+        record[0] += 1
+        os.pwrite(self.fd, SEQ.pack(record[0]), offset)
+
+    def _record(self, account):
+        if account in self.records:
+            return self.records[account]
+        offset = HEADER.size + len(self.order) * RECORD.size
+        record = [0, 0, encode_name(account), 0, 0, 0, 0, 0]
+        self._write_record(offset, record)
+        self.records[account] = (offset, record)
+        self.order.append(account)
+        # The record is complete before the count makes it visible to readers
+        self.header[2] = len(self.order)
+        self._write_header()
+        return self.records[account]
+
+    def get(self, account):
+        if not account in self.records:
+            return None
+        return record_to_dict(self.records[account][1])
+
+    def update(self, account, block_time, block_num = None, count_turn = False):
+        # count_turn is set when every block is passed in, so the blocks signed
+        # in the producer's last turn can be counted. None for a block of an
+        # older schedule than the stored one: it is not counted as a turn
+        offset, record = self._record(account)
+        time_ms = time_to_ms(block_time)
+        if block_num != None:
+            if block_num <= record[4]:
+                return False
+        elif time_ms == record[3]:
+            return False
+        record[3] = time_ms
+        record[4] = block_num or record[4]
+        if count_turn:
+            turn = producer_schedule.turn_start(producer_schedule.ms_to_slot(time_ms))
+            record[5], record[6] = turn, record[6] + 1 if record[5] == turn else 1
+        else:
+            record[5], record[6] = 0, 0
+        self._write_record(offset, record)
+        if count_turn != None and bool(self.header[9] & HEADER_FLAG_TURNS) != count_turn:
+            self.header[9] ^= HEADER_FLAG_TURNS
+            self._write_header()
+        return True
+
+    @property
+    def producers(self):
+        scheduled = [(record[1] & POSITION_MASK, name) for name, (offset, record) in self.records.items() if record[1] & FLAG_SCHEDULED]
+        return [name for position, name in sorted(scheduled)]
+
+    @property
+    def schedule_version(self):
+        return self.header[6]
+
+    def set_producers(self, producers, version = 0, schedule_slot = 0):
+        if producers == self.producers and version == self.header[6] and schedule_slot == self.header[8]:
+            return
+        positions = {name: i for i, name in enumerate(producers)}
+        for name in self.order + [p for p in producers if not p in self.records]:
+            offset, record = self._record(name)
+            flags = 0
+            if name in positions:
+                flags = FLAG_SCHEDULED | (positions[name] << POSITION_SHIFT)
+            if record[1] != flags:
+                record[1] = flags
+                self._write_record(offset, record)
+        self.header[6] = version
+        self.header[7] = len(producers)
+        self.header[8] = schedule_slot
+        self._write_header()
+
+    @property
+    def last_block_num(self):
+        return self.header[4]
+
+    def set_last_block(self, block_num, block_time):
+        self.header[4] = block_num
+        self.header[5] = time_to_ms(block_time)
+        self._write_header()
+
+    def flush(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        os.close(self.fd)
+
+class JsonLpbStore:
+    # Legacy <network>.lpb.json format. The whole file is rewritten on flush
+    def __init__(self, path):
+        import mpu.io
+        self.path = path
+        try:
+            self.data = mpu.io.read(path)
+        except:
+            self.data = {}
+            mpu.io.write(path, self.data)
+
+    def get(self, account):
+        return self.data.get(account)
+
+    def update(self, account, block_time, block_num = None, count_turn = False):
+        if not account in self.data:
+            self.data[account] = {}
+        if block_num != None:
+            if block_num <= self.data[account].get('last_block_produced', 0):
+                return False
+            self.data[account]['last_block_produced'] = block_num
+        self.data[account]['last_block_produced_time'] = block_time
+        return True
+
+    @property
+    def producers(self):
+        return self.data.get('producers', [])
+
+    @property
+    def schedule_version(self):
+        return self.data.get('schedule_version', 0)
+
+    def set_producers(self, producers, version = 0, schedule_slot = 0):
+        self.data['producers'] = producers
+        self.data['schedule_version'] = version
+
+    @property
+    def last_block_num(self):
+        return self.data.get('last_block_num', 0)
+
+    def set_last_block(self, block_num, block_time):
+        self.data['last_block_num'] = block_num
+
+    def flush(self):
+        import mpu.io
+        mpu.io.write(self.path, self.data)
+
+    def close(self):
+        self.flush()
+
+def open_store(path):
+    if path.endswith('.json'):
+        return JsonLpbStore(path)
+    return LpbStore(path)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+# OpenMetrics exporter for the checks. Runs the checks of a check_daemon.py
+# config on their own schedule and turns every result into metrics:
+#
+#   eos_check_status                 last Nagios status (0 OK .. 3 UNKNOWN)
+#   eos_check_runs_total             runs by status
+#   eos_check_duration_seconds       histogram of the time each run took
+#   eos_check_<perfdata label>       last value of every perfdata label. Labels
+#                                    in seconds also get a histogram, labels
+#                                    with the Nagios counter unit (c) are
+#                                    counters with a _per_second rate derived
+#                                    from the history, e.g. head blocks/sec
+#
+# Every series keeps its last --history samples in a ring buffer, served as
+# json on /history. Scrapes are answered from memory and never call upstream.
+
+import argparse
+import re
+import sys
+import json
+import time
+import logging
+import threading
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import check_daemon
+from histogram import LatencyHistogram
+from nagios import SERVICE_STATUS
+
+logger = logging.getLogger(__name__)
+
+PERFDATA = re.compile(r"'?([^'=\s;]+)'?=(-?[\d.,]+(?:[eE][-+]?\d+)?|U)([a-zA-Z%]*)")
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+UNITS = {'s': 1, 'ms': 0.001, 'us': 0.000001}
+STATUS_NAMES = {v: k for k, v in SERVICE_STATUS.items()}
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+def parse_perfdata(output):
+    # Returns (label, value, unit) for every perfdata label with a value.
+    # Times are converted to seconds
+    if not '|' in output:
+        return []
+    result = []
+    for label, value, unit in PERFDATA.findall(output.split('|', 1)[1]):
+        if value == 'U':
+            continue
+        value = float(value.replace(',', ''))
+        if unit in UNITS:
+            value, unit = value * UNITS[unit], 's'
+        result.append((label, value, unit))
+    return result
+
+def family_name(label, unit):
+    name = 'eos_check_{}'.format(re.sub(r'[^a-zA-Z0-9_]', '_', label))
+    suffix = {'s': '_seconds', 'B': '_bytes', '%': '_percent'}.get(unit, '')
+    return name if name.endswith(suffix) else name + suffix
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def histogram_lines(name, labels, histogram):
+    lines = []
+    for bound in BUCKETS:
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, histogram.count_below(bound)))
+    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, histogram.count))
+    lines.append('{}_sum{{{}}} {}'.format(name, labels, histogram.total))
+    lines.append('{}_count{{{}}} {}'.format(name, labels, histogram.count))
+    return lines
+
+class MetricStore:
+    def __init__(self, history):
+        self.history = history
+        self.lock = threading.Lock()
+        self.status = {}
+        self.runs = collections.Counter()
+        self.durations = collections.defaultdict(LatencyHistogram)
+        # (family, check) -> {'unit', 'samples': deque of (timestamp, value)}
+        self.series = {}
+        self.histograms = collections.defaultdict(LatencyHistogram)
+
+    def record(self, check, status, output, duration):
+        now = time.time()
+        with self.lock:
+            self.status[check] = (status, now)
+            self.runs[(check, STATUS_NAMES.get(status, 'UNKNOWN'))] += 1
+            self.durations[check].record(duration)
+            for label, value, unit in parse_perfdata(output):
+                key = (family_name(label, unit), check)
+                if not key in self.series:
+                    self.series[key] = {'unit': unit, 'samples': collections.deque(maxlen=self.history)}
+                self.series[key]['samples'].append((now, value))
+                if unit == 's':
+                    self.histograms[key].record(value)
+
+    def rate(self, samples):
+        # Per second change between the oldest and newest sample in the ring
+        if len(samples) < 2 or samples[-1][0] <= samples[0][0]:
+            return None
+        return (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0])
+
+    def render(self):
+        with self.lock:
+            families = collections.OrderedDict()
+            def add(name, kind, line):
+                families.setdefault((name, kind), []).append(line)
+
+            for check, (status, timestamp) in sorted(self.status.items()):
+                labels = 'check="{}"'.format(escape(check))
+                add('eos_check_status', 'gauge', 'eos_check_status{{{}}} {}'.format(labels, status))
+                add('eos_check_last_run_timestamp_seconds', 'gauge', 'eos_check_last_run_timestamp_seconds{{{}}} {:.3f}'.format(labels, timestamp))
+            for (check, status), count in sorted(self.runs.items()):
+                add('eos_check_runs', 'counter', 'eos_check_runs_total{{check="{}",status="{}"}} {}'.format(escape(check), status, count))
+            for check, histogram in sorted(self.durations.items()):
+                for line in histogram_lines('eos_check_duration_seconds', 'check="{}"'.format(escape(check)), histogram):
+                    add('eos_check_duration_seconds', 'histogram', line)
+
+            for (name, check), series in sorted(self.series.items()):
+                labels = 'check="{}"'.format(escape(check))
+                samples = series['samples']
+                if series['unit'] == 'c':
+                    add(name, 'counter', '{}_total{{{}}} {}'.format(name, labels, samples[-1][1]))
+                    rate = self.rate(samples)
+                    if rate != None:
+                        add(name + '_per_second', 'gauge', '{}_per_second{{{}}} {}'.format(name, labels, rate))
+                elif series['unit'] == 's':
+                    for line in histogram_lines(name, labels, self.histograms[(name, check)]):
+                        add(name, 'histogram', line)
+                    add(name + '_last', 'gauge', '{}_last{{{}}} {}'.format(name, labels, samples[-1][1]))
+                else:
+                    add(name, 'gauge', '{}{{{}}} {}'.format(name, labels, samples[-1][1]))
+
+        lines = []
+        for (name, kind), samples in families.items():
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines += samples
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def history_json(self):
+        with self.lock:
+            result = {}
+            for (name, check), series in self.series.items():
+                result.setdefault(check, {})[name] = list(series['samples'])
+        return json.dumps(result)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            body, content_type = self.server.store.render().encode(), CONTENT_TYPE
+        elif path == '/history':
+            body, content_type = self.server.store.history_json().encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run checks on a schedule and expose their results as OpenMetrics')
+    parser.add_argument('-c', '--config_file', default='check_daemon.json',
+                        help='json file with the checks to run, same format as check_daemon.py. default = check_daemon.json')
+    parser.add_argument('-l', '--listen', default='0.0.0.0', help='Address to listen on. default = 0.0.0.0')
+    parser.add_argument('-p', '--port', type=int, default=9880, help='Port to listen on. default = 9880')
+    parser.add_argument('-n', '--history', type=int, default=120, help='Samples kept per metric. default = 120')
+    parser.add_argument('-w', '--workers', type=int, default=32,
+                        help='Checks running at the same time. default = 32')
+    parser.add_argument('-s', '--share_window', type=float, default=1.0,
+                        help='Seconds during which checks of the same host share a get_info response. default = 1')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every result')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    check_daemon.logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    with open(args.config_file) as f:
+        checks = check_daemon.load_checks(json.load(f))
+    store = MetricStore(args.history)
+    server = ThreadingHTTPServer((args.listen, args.port), MetricsHandler)
+    server.daemon_threads = True
+    server.store = store
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('Running {} checks, metrics on http://{}:{}/metrics'.format(len(checks), args.listen, args.port))
+    check_daemon.serve(checks, args.workers, args.share_window,
+                       lambda check, status, output, duration: store.record(check['name'], status, output, duration))
+
+if __name__ == "__main__":
+    main(sys.argv)
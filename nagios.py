@@ -0,0 +1,30 @@
+import sys
+import tracing
+
+SERVICE_STATUS = {
+    'OK': 0,
+    'WARNING': 1,
+    'CRITICAL': 2,
+    'UNKNOWN': 3
+}
+
+class CheckResult(Exception):
+    # Raised from anywhere in a check to finish it with the given status and
+    # output, so checks can also run inside a long lived process
+    def __init__(self, status, output):
+        Exception.__init__(self, output)
+        self.status = status
+        self.output = output
+
+def run(check, args, **kwargs):
+    try:
+        return check(args, **kwargs)
+    except CheckResult as e:
+        return e.status, e.output
+
+def exit_with(check, args, **kwargs):
+    with tracing.span('check', script=sys.argv[0].rsplit('/', 1)[-1]) as span:
+        status, output = run(check, args, **kwargs)
+        span.set(status=status)
+    print(output)
+    sys.exit(status)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+# nodeos net_plugin handshake. Opens a p2p connection, sends a handshake_message
+# for our chain and decodes the peer's handshake, which carries its chain_id,
+# head and LIB. A peer on another chain or network version answers with a
+# go_away_message instead.
+#
+# Every message is a uint32 little endian length, the varuint32 index of the
+# message type in net_message and the fc::raw packed message. A probe with an
+# empty key, token and signature is accepted by peers with the default
+# allowed-connection = any.
+#
+# FakePeer answers handshakes with a configured head and LIB, for trying the
+# probe and the checks built on it without a real node:
+#   ./p2p_handshake.py --serve 9876 --chain_id <id> --head 1000
+
+import argparse
+import sys
+import os
+import time
+import struct
+import socket
+import threading
+
+HANDSHAKE_MESSAGE = 0
+GO_AWAY_MESSAGE = 2
+TIME_MESSAGE = 3
+
+# net_version_base + proto_explicit_sync, understood by every nodeos since 2.0
+NETWORK_VERSION = 1206
+
+GO_AWAY_REASONS = ['no_reason', 'self', 'duplicate', 'wrong_chain', 'wrong_version', 'forked', 'unlinkable',
+                   'bad_transaction', 'validation', 'benign_other', 'fatal_other', 'authentication']
+
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+class ProtocolError(Exception):
+    pass
+
+def pack_varuint32(value):
+    out = bytearray()
+    while True:
+        b = value & 0x7f
+        value >>= 7
+        out.append(b | (0x80 if value else 0))
+        if not value:
+            return bytes(out)
+
+def pack_string(value):
+    data = value.encode()
+    return pack_varuint32(len(data)) + data
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def raw(self, size):
+        if self.pos + size > len(self.data):
+            raise ProtocolError('Truncated message')
+        value = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return value
+
+    def unpack(self, fmt):
+        return struct.unpack(fmt, self.raw(struct.calcsize(fmt)))[0]
+
+    def varuint32(self):
+        value = shift = 0
+        while True:
+            b = self.raw(1)[0]
+            value |= (b & 0x7f) << shift
+            shift += 7
+            if not b & 0x80:
+                return value
+
+    def string(self):
+        return self.raw(self.varuint32()).decode(errors='replace')
+
+    def public_key(self):
+        # K1 and R1 are 33 bytes, WebAuthn adds user presence and the rpid
+        key_type = self.varuint32()
+        self.raw(33)
+        if key_type == 2:
+            self.raw(1)
+            self.string()
+
+    def signature(self):
+        sig_type = self.varuint32()
+        self.raw(65)
+        if sig_type == 2:
+            self.raw(self.varuint32())
+            self.string()
+
+def frame(message_type, payload):
+    body = pack_varuint32(message_type) + payload
+    return struct.pack('<I', len(body)) + body
+
+def encode_handshake(chain_id, head_num = 0, head_id = None, lib_num = 0, lib_id = None, node_id = None,
+                     p2p_address = 'eos-scripts:0', agent = 'eos-scripts', network_version = NETWORK_VERSION, generation = 1):
+    return frame(HANDSHAKE_MESSAGE, b''.join([
+        struct.pack('<H', network_version),
+        bytes.fromhex(chain_id),
+        node_id or os.urandom(32),
+        b'\x00' + bytes(33),                       # key
+        struct.pack('<q', time.time_ns()),
+        bytes(32),                                 # token
+        b'\x00' + bytes(65),                       # sig
+        pack_string(p2p_address),
+        struct.pack('<I', lib_num),
+        bytes.fromhex(lib_id) if lib_id else bytes(32),
+        struct.pack('<I', head_num),
+        bytes.fromhex(head_id) if head_id else bytes(32),
+        pack_string(sys.platform),
+        pack_string(agent),
+        struct.pack('<h', generation)
+    ]))
+
+def decode_handshake(reader):
+    result = {'network_version': reader.unpack('<H'), 'chain_id': reader.raw(32).hex(), 'node_id': reader.raw(32).hex()}
+    reader.public_key()
+    result['time'] = reader.unpack('<q')
+    reader.raw(32)
+    reader.signature()
+    result['p2p_address'] = reader.string()
+    result['last_irreversible_block_num'] = reader.unpack('<I')
+    result['last_irreversible_block_id'] = reader.raw(32).hex()
+    result['head_num'] = reader.unpack('<I')
+    result['head_id'] = reader.raw(32).hex()
+    result['os'] = reader.string()
+    result['agent'] = reader.string()
+    result['generation'] = reader.unpack('<h')
+    return result
+
+def encode_go_away(reason):
+    # fc::raw packs enums as int64
+    return frame(GO_AWAY_MESSAGE, struct.pack('<q', GO_AWAY_REASONS.index(reason)) + bytes(32))
+
+def decode_go_away(reader):
+    reason = reader.unpack('<q')
+    return GO_AWAY_REASONS[reason] if 0 <= reason < len(GO_AWAY_REASONS) else 'unknown ({})'.format(reason)
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ProtocolError('Connection closed by peer')
+        data += chunk
+    return bytes(data)
+
+def read_message(sock):
+    size = struct.unpack('<I', recv_exact(sock, 4))[0]
+    if size == 0 or size > MAX_MESSAGE_SIZE:
+        raise ProtocolError('Invalid message size {}'.format(size))
+    reader = Reader(recv_exact(sock, size))
+    return reader.varuint32(), reader
+
+def probe(host, port, chain_id, timeout = 3, network_version = NETWORK_VERSION):
+    # Returns connect and handshake round trip times with either the peer's
+    # handshake or the reason of its go_away. Socket errors are raised
+    deadline = time.perf_counter() + timeout
+    start = time.perf_counter()
+    sock = socket.create_connection((host, port), timeout=timeout)
+    try:
+        result = {'connect': time.perf_counter() - start}
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        start = time.perf_counter()
+        sock.sendall(encode_handshake(chain_id, network_version=network_version))
+        while True:
+            sock.settimeout(max(deadline - time.perf_counter(), 0.001))
+            message_type, reader = read_message(sock)
+            if message_type == HANDSHAKE_MESSAGE:
+                result['handshake'] = decode_handshake(reader)
+                break
+            if message_type == GO_AWAY_MESSAGE:
+                result['go_away'] = decode_go_away(reader)
+                break
+        result['rtt'] = time.perf_counter() - start
+        return result
+    finally:
+        sock.close()
+
+def lag(result, head_block_num):
+    return head_block_num - result['handshake']['head_num']
+
+class FakePeer:
+    def __init__(self, port, chain_id, head_num, lib_num = None, delay = 0, go_away = None, host = '127.0.0.1'):
+        self.chain_id = chain_id
+        self.head_num = head_num
+        self.lib_num = lib_num if lib_num != None else max(head_num - 325, 0)
+        self.delay = delay
+        self.go_away = go_away
+        self.sock = socket.create_server((host, port))
+        self.port = self.sock.getsockname()[1]
+
+    def serve_forever(self):
+        while True:
+            conn, address = self.sock.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def handle(self, conn):
+        try:
+            message_type, reader = read_message(conn)
+            if message_type != HANDSHAKE_MESSAGE:
+                return
+            handshake = decode_handshake(reader)
+            time.sleep(self.delay)
+            if self.go_away:
+                conn.sendall(encode_go_away(self.go_away))
+            elif handshake['chain_id'] != self.chain_id:
+                conn.sendall(encode_go_away('wrong_chain'))
+            else:
+                conn.sendall(frame(TIME_MESSAGE, struct.pack('<qqqq', 0, 0, time.time_ns(), 0)))
+                conn.sendall(encode_handshake(self.chain_id, self.head_num, lib_num=self.lib_num,
+                                              p2p_address='127.0.0.1:{} - fake'.format(self.port), agent='fake peer'))
+            # Real peers keep the connection open until we close it
+            conn.recv(1)
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            conn.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Perform the nodeos p2p handshake with a peer, or run a fake peer')
+    parser.add_argument('peer', nargs='?', help='host:port of the peer')
+    parser.add_argument('-a', '--api', default='http://localhost:8888',
+                        help='API of our node, for the chain_id and the head to compare with. default = http://localhost:8888')
+    parser.add_argument('--chain_id', help='Chain id to send. default = chain_id of --api')
+    parser.add_argument('-t', '--timeout', type=float, default=3, help='Timeout in seconds. default = 3')
+    parser.add_argument('-N', '--network_version', type=int, default=NETWORK_VERSION,
+                        help='Network version to send. default = {}'.format(NETWORK_VERSION))
+    parser.add_argument('--serve', type=int, help='Run a fake peer on this port')
+    parser.add_argument('--head', type=int, default=1000, help='Fake peer: head block number. default = 1000')
+    parser.add_argument('--delay', type=float, default=0, help='Fake peer: seconds before answering. default = 0')
+    parser.add_argument('--go_away', choices=GO_AWAY_REASONS, help='Fake peer: answer with a go_away')
+    args = parser.parse_args()
+
+    if args.serve != None:
+        if not args.chain_id:
+            parser.error('--serve needs --chain_id')
+        FakePeer(args.serve, args.chain_id, args.head, delay=args.delay, go_away=args.go_away, host='0.0.0.0').serve_forever()
+
+    if not args.peer:
+        parser.error('peer is required')
+    import eoshttp
+    info = eoshttp.fetch('GET', '{}/v1/chain/get_info'.format(args.api.rstrip('/')), timeout=args.timeout)[0]
+    host, port = args.peer.rsplit(':', 1)
+    result = probe(host.strip('[]'), int(port), args.chain_id or info['chain_id'], args.timeout, args.network_version)
+    if 'go_away' in result:
+        print('go_away: {} after {:.2f} ms'.format(result['go_away'], result['rtt'] * 1000))
+        sys.exit(1)
+    handshake = result['handshake']
+    for key in ['agent', 'p2p_address', 'network_version', 'chain_id', 'head_num', 'last_irreversible_block_num']:
+        print('{:<28} {}'.format(key, handshake[key]))
+    print('{:<28} {}'.format('lag', lag(result, info['head_block_num'])))
+    print('{:<28} {:.2f} ms'.format('connect', result['connect'] * 1000))
+    print('{:<28} {:.2f} ms'.format('handshake rtt', result['rtt'] * 1000))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+# Append-only production log. eoslpb.py and ship_monitor.py append one entry
+# per block slot: the slot, the block number and the producer. A slot nobody
+# signed is appended with block number 0 under the producer scheduled for it,
+# so misses are counted per producer. Files, all fixed size records:
+#
+#   <log>.log     slot, block num, producer index               (10 bytes)
+#   <log>.names   producer names, the line number is the index
+#   <log>.turns   first slot of a producer turn, producer index,
+#                 blocks produced and missed in the turn         (8 bytes)
+#   <log>.hours   hour, producer index, produced, missed         (16 bytes)
+#
+# A turn record is appended once the turn is over and added to the hourly
+# rollup of its first slot; turns never cross hours. A window query sums the
+# hourly rollups of the hours inside the window and the turns at its edges,
+# found by bisecting the turns file, so it reads a few hundred records even
+# over months of blocks.
+#
+# The log entries of a turn reach the file before the turn record, and the
+# turn record before its hourly rollup. Only the rollup of the hour of the
+# last turn on disk can be behind, so readers sum that hour from the turns
+# and the writer recomputes it on open.
+
+import argparse
+import os
+import sys
+import mmap
+import time
+import struct
+import bisect
+import producer_schedule
+
+ENTRY = struct.Struct('<IIH')
+TURN = struct.Struct('<IHBB')
+HOUR = struct.Struct('<IHHII')
+SLOTS_PER_HOUR = 3600 * 1000 // producer_schedule.BLOCK_INTERVAL_MS
+
+class RecordFile:
+    # Read only view of a file of fixed size records sorted by their first field
+    def __init__(self, path, record):
+        self.record = record
+        self.buf = b''
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size >= record.size:
+                    self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            pass
+        # A writer may be in the middle of a record
+        self.count = len(self.buf) // record.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.record.unpack_from(self.buf, i * self.record.size)
+
+    def first_field(self):
+        # Sequence view for bisect
+        outer = self
+        class Keys:
+            def __len__(self):
+                return outer.count
+            def __getitem__(self, i):
+                return struct.unpack_from('<I', outer.buf, i * outer.record.size)[0]
+        return Keys()
+
+    def since(self, slot):
+        return bisect.bisect_left(self.first_field(), slot)
+
+def read_names(path):
+    try:
+        with open(path) as f:
+            return [line.strip() for line in f]
+    except FileNotFoundError:
+        return []
+
+class ProdLog:
+    def __init__(self, path):
+        self.path = path
+        self.names = read_names(path + '.names')
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.hours = {}
+        hours = RecordFile(path + '.hours', HOUR)
+        for i in range(len(hours)):
+            hour, producer, _, produced, missed = hours[i]
+            self.hours[(hour, producer)] = i
+        self.hour_count = len(hours)
+        entries = RecordFile(path + '.log', ENTRY)
+        turns = RecordFile(path + '.turns', TURN)
+        # Rollups of the hour of the last turn, which may miss that turn
+        last_hour = {}
+        if len(turns):
+            hour = turns[len(turns) - 1][0] // SLOTS_PER_HOUR
+            for i in range(turns.since(hour * SLOTS_PER_HOUR), len(turns)):
+                turn_slot, producer, produced, missed = turns[i]
+                totals = last_hour.setdefault((hour, producer), [0, 0])
+                totals[0], totals[1] = totals[0] + produced, totals[1] + missed
+        self.last_slot = entries[len(entries) - 1][0] if len(entries) else 0
+        self.last_block_num = 0
+        for i in range(len(entries) - 1, max(len(entries) - 100, 0) - 1, -1):
+            if entries[i][1]:
+                self.last_block_num = entries[i][1]
+                break
+        # Turns still open when the writer stopped are rebuilt from the log
+        self.open_turns = {}
+        closed = turns[len(turns) - 1][0] + producer_schedule.BLOCKS_PER_TURN if len(turns) else 0
+        for i in range(entries.since(closed), len(entries)):
+            slot, block_num, producer = entries[i]
+            self._count(slot, producer, block_num != 0)
+        for f in [entries, turns, hours]:
+            if isinstance(f.buf, mmap.mmap):
+                f.buf.close()
+        # Cut a record left half written by a crash
+        self._truncate(path + '.log', len(entries) * ENTRY.size)
+        self._truncate(path + '.turns', len(turns) * TURN.size)
+        self.entries = open(path + '.log', 'ab')
+        self.turns = open(path + '.turns', 'ab')
+        self.hours_fd = os.open(path + '.hours', os.O_RDWR | os.O_CREAT, 0o644)
+        if last_hour:
+            hour = min(last_hour)[0]
+            for hour_key in [k for k in self.hours if k[0] >= hour and not k in last_hour]:
+                last_hour[hour_key] = [0, 0]
+        for hour_key, (produced, missed) in last_hour.items():
+            self._write_hour(hour_key, produced, missed)
+        self.names_file = open(path + '.names', 'a')
+
+    def _truncate(self, path, size):
+        if os.path.exists(path) and os.path.getsize(path) != size:
+            os.truncate(path, size)
+
+    def producer_index(self, name):
+        if not name in self.index:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+            self.names_file.write(name + '\n')
+            self.names_file.flush()
+        return self.index[name]
+
+    def _count(self, slot, producer, produced):
+        turn = self.open_turns.setdefault((producer_schedule.turn_start(slot), producer), [0, 0])
+        turn[0 if produced else 1] += 1
+
+    def _write_hour(self, hour_key, produced, missed):
+        if not hour_key in self.hours:
+            self.hours[hour_key] = self.hour_count
+            self.hour_count += 1
+        os.pwrite(self.hours_fd, HOUR.pack(hour_key[0], hour_key[1], 0, produced, missed), self.hours[hour_key] * HOUR.size)
+
+    def _close_turns(self, before):
+        closing = sorted(k for k in self.open_turns if k[0] < before)
+        if not closing:
+            return
+        # Log entries, then turn records, then rollups
+        self.entries.flush()
+        counts = [self.open_turns.pop(key) for key in closing]
+        for key, (produced, missed) in zip(closing, counts):
+            self.turns.write(TURN.pack(key[0], key[1], produced, missed))
+        self.turns.flush()
+        for key, (produced, missed) in zip(closing, counts):
+            hour_key = (key[0] // SLOTS_PER_HOUR, key[1])
+            if hour_key in self.hours:
+                hour, producer, _, total_produced, total_missed = HOUR.unpack(os.pread(self.hours_fd, HOUR.size, self.hours[hour_key] * HOUR.size))
+                produced, missed = produced + total_produced, missed + total_missed
+            self._write_hour(hour_key, produced, missed)
+
+    def append(self, slot, block_num, producer):
+        # block_num 0 records a missed slot. Slots already logged are ignored,
+        # so a replay or a fork switch does not count blocks twice
+        if slot <= self.last_slot:
+            return False
+        index = self.producer_index(producer)
+        self._close_turns(producer_schedule.turn_start(slot))
+        self.entries.write(ENTRY.pack(slot, block_num, index))
+        self._count(slot, index, block_num != 0)
+        self.last_slot = slot
+        if block_num:
+            self.last_block_num = block_num
+        return True
+
+    def record_block(self, block_num, slot, producer, schedule):
+        # Slots skipped since the previous block are misses of the producers
+        # scheduled for them. Only known for consecutive blocks and a known
+        # schedule (producer names in schedule order)
+        if schedule and self.last_block_num and block_num == self.last_block_num + 1:
+            for missed in range(self.last_slot + 1, slot):
+                self.append(missed, 0, schedule[producer_schedule.scheduled_position(missed, len(schedule))])
+        return self.append(slot, block_num, producer)
+
+    def flush(self):
+        self.entries.flush()
+        self.turns.flush()
+
+    def close(self):
+        self.flush()
+        self.entries.close()
+        self.turns.close()
+        self.names_file.close()
+        os.close(self.hours_fd)
+
+class ProdLogReader:
+    def __init__(self, path):
+        self.names = read_names(path + '.names')
+        self.entries = RecordFile(path + '.log', ENTRY)
+        self.turns = RecordFile(path + '.turns', TURN)
+        hours = RecordFile(path + '.hours', HOUR)
+        self.hours = {}
+        for i in range(len(hours)):
+            hour, producer, _, produced, missed = hours[i]
+            self.hours[(hour, producer)] = (produced, missed)
+
+    @property
+    def last_slot(self):
+        return self.entries[len(self.entries) - 1][0] if len(self.entries) else None
+
+    def stats(self, producer, start_slot, end_slot):
+        # Blocks produced and missed by producer in [start_slot, end_slot),
+        # at turn granularity
+        if not producer in self.names:
+            return 0, 0
+        index = self.names.index(producer)
+        produced = missed = 0
+        first_hour = -(-start_slot // SLOTS_PER_HOUR)
+        last_hour = end_slot // SLOTS_PER_HOUR
+        # The rollup of the hour of the last turn may not have it yet
+        if len(self.turns):
+            last_hour = min(last_hour, self.turns[len(self.turns) - 1][0] // SLOTS_PER_HOUR)
+        for hour in range(first_hour, last_hour):
+            p, m = self.hours.get((hour, index), (0, 0))
+            produced, missed = produced + p, missed + m
+        if first_hour >= last_hour:
+            edges = [(start_slot, end_slot)]
+        else:
+            edges = [(start_slot, first_hour * SLOTS_PER_HOUR), (last_hour * SLOTS_PER_HOUR, end_slot)]
+        closed = self.turns[len(self.turns) - 1][0] + producer_schedule.BLOCKS_PER_TURN if len(self.turns) else 0
+        for start, end in edges:
+            for i in range(self.turns.since(start), len(self.turns)):
+                turn_slot, turn_producer, p, m = self.turns[i]
+                if turn_slot >= end:
+                    break
+                if turn_producer == index:
+                    produced, missed = produced + p, missed + m
+        # The turn still open is only in the log
+        for i in range(self.entries.since(max(closed, start_slot)), len(self.entries)):
+            slot, block_num, entry_producer = self.entries[i]
+            if slot >= end_slot:
+                break
+            if entry_producer == index:
+                if block_num:
+                    produced += 1
+                else:
+                    missed += 1
+        return produced, missed
+
+def missed_ratio(produced, missed):
+    return missed / float(produced + missed) if produced + missed else 0.0
+
+def synthesize(path, days, producers, miss_rate, seed = 1):
+    # Fills a log with `days` of blocks ending now, each slot missed with
+    # probability miss_rate, for trying the queries on a realistic size
+    import random
+    rng = random.Random(seed)
+    log = ProdLog(path)
+    end = producer_schedule.ms_to_slot(int(time.time() * 1000))
+    block_num = log.last_block_num
+    for slot in range(max(end - int(days * 86400 * 2), log.last_slot + 1), end):
+        if rng.random() < miss_rate:
+            continue
+        block_num += 1
+        log.record_block(block_num, slot, producers[producer_schedule.scheduled_position(slot, len(producers))], producers)
+    log.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Blocks produced and missed per producer from a production log')
+    parser.add_argument('log', help='Production log, without the .log extension')
+    parser.add_argument('-b', '--bp_account', help='Only this producer')
+    parser.add_argument('-w', '--windows', default='3600,86400,604800', help='Comma separated windows in seconds. default = 1h,24h,7d')
+    parser.add_argument('--synthesize', type=float, metavar='DAYS', help='Append DAYS of synthetic blocks to the log first')
+    parser.add_argument('--producers', default='bpa,bpb,bpc', help='Producers of the synthetic blocks. default = bpa,bpb,bpc')
+    parser.add_argument('--miss_rate', type=float, default=0.01, help='Missed slot probability of the synthetic blocks. default = 0.01')
+    args = parser.parse_args()
+
+    if args.synthesize:
+        synthesize(args.log, args.synthesize, args.producers.split(','), args.miss_rate)
+
+    start = time.perf_counter()
+    reader = ProdLogReader(args.log)
+    if reader.last_slot == None:
+        print('{} is empty'.format(args.log))
+        sys.exit(1)
+    windows = [int(w) for w in args.windows.split(',')]
+    print('{:<13} {:>10} {:>10} {:>10} {:>8}'.format('producer', 'window', 'produced', 'missed', 'missed %'))
+    for producer in [args.bp_account] if args.bp_account else reader.names:
+        for window in windows:
+            produced, missed = reader.stats(producer, reader.last_slot + 1 - window * 2, reader.last_slot + 1)
+            print('{:<13} {:>9}s {:>10} {:>10} {:>7.2f}%'.format(producer, window, produced, missed, missed_ratio(produced, missed) * 100))
+    print('{} blocks logged, queried in {:.1f} ms'.format(len(reader.entries), (time.perf_counter() - start) * 1000))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,36 @@
+# Block slot math. Blocks are produced every 500ms and every slot since the
+# block timestamp epoch belongs to one producer: each producer in the active
+# schedule signs 12 consecutive blocks (a turn) and a round is one turn per
+# producer. Turns start on slots that are a multiple of 12.
+
+BLOCK_INTERVAL_MS = 500
+BLOCK_TIMESTAMP_EPOCH_MS = 946684800000
+BLOCKS_PER_TURN = 12
+
+def ms_to_slot(time_ms):
+    return (time_ms - BLOCK_TIMESTAMP_EPOCH_MS) // BLOCK_INTERVAL_MS
+
+def slot_to_ms(slot):
+    return BLOCK_TIMESTAMP_EPOCH_MS + slot * BLOCK_INTERVAL_MS
+
+def turn_start(slot):
+    return slot - slot % BLOCKS_PER_TURN
+
+def scheduled_position(slot, schedule_size):
+    return (slot % (schedule_size * BLOCKS_PER_TURN)) // BLOCKS_PER_TURN
+
+def last_turn(position, schedule_size, slot):
+    # First slot of the last turn of `position` that ended at or before `slot`
+    round_length = schedule_size * BLOCKS_PER_TURN
+    start = slot - slot % round_length + position * BLOCKS_PER_TURN
+    if start + BLOCKS_PER_TURN - 1 > slot:
+        start -= round_length
+    return start
+
+def next_turn(position, schedule_size, slot):
+    # First slot of the next turn of `position` starting after `slot`
+    round_length = schedule_size * BLOCKS_PER_TURN
+    start = slot - slot % round_length + position * BLOCKS_PER_TURN
+    if start <= slot:
+        start += round_length
+    return start
@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+
+# Streams blocks from the nodeos state_history_plugin websocket instead of
+# polling get_info. Every block result carries the head and LIB of the node,
+# and the block header the producer and timestamp, so head, LIB and the last
+# produced block of every producer are known as soon as a block is applied.
+#
+# Results are written to the lpb store read by check_eos_bp.py -c lpb and to
+# a json status file read by check_eos_bp.py -c ship. Blocks are requested
+# with get_blocks_request_v0 and acknowledged with get_blocks_ack_request_v0
+# every max_messages_in_flight / 2 results. Only the block header is decoded,
+# traces and deltas are not requested.
+#
+# ShipFakeServer replays a recording of the results of a real node, made with
+# --record, or a synthetic one made with --synthesize:
+#   ./ship_monitor.py --synthesize ship.rec --blocks 600
+#   ./ship_monitor.py --serve 8080 --replay ship.rec
+#   ./ship_monitor.py -u ws://localhost:8080 -e http://localhost:8888
+
+import argparse
+import sys
+import os
+import time
+import json
+import struct
+import socket
+import base64
+import hashlib
+import threading
+import urllib.parse
+import lpbstore
+import statestore
+import producer_schedule
+import prodlog
+from p2p_handshake import Reader, ProtocolError, pack_varuint32, recv_exact
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC11B85'
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+GET_STATUS_REQUEST = 0
+GET_BLOCKS_REQUEST = 1
+GET_BLOCKS_ACK_REQUEST = 2
+GET_STATUS_RESULT = 0
+GET_BLOCKS_RESULT = 1
+
+NAME_CHARS = '.12345abcdefghijklmnopqrstuvwxyz'
+MAX_BLOCK_NUM = 0xffffffff
+
+class WebSocket:
+    # Just enough of RFC 6455 for state history: binary and text messages,
+    # fragmentation, ping and close. Clients mask the frames they send
+    def __init__(self, sock, client, pending = b''):
+        self.sock = sock
+        self.client = client
+        self.pending = pending
+        self.lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, url, timeout = 10):
+        parsed = urllib.parse.urlsplit(url)
+        port = parsed.port or (443 if parsed.scheme == 'wss' else 80)
+        sock = socket.create_connection((parsed.hostname, port), timeout=timeout)
+        if parsed.scheme == 'wss':
+            import ssl
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=parsed.hostname)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        key = base64.b64encode(os.urandom(16)).decode()
+        sock.sendall(('GET {} HTTP/1.1\r\nHost: {}:{}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                      'Sec-WebSocket-Key: {}\r\nSec-WebSocket-Version: 13\r\n\r\n').format(parsed.path or '/', parsed.hostname, port, key).encode())
+        status, headers, pending = read_http_head(sock)
+        if not status.split(' ')[1:2] == ['101']:
+            raise ProtocolError('Websocket upgrade refused: {}'.format(status))
+        if headers.get('sec-websocket-accept') != accept_key(key):
+            raise ProtocolError('Invalid Sec-WebSocket-Accept')
+        return cls(sock, True, pending)
+
+    @classmethod
+    def accept(cls, sock):
+        status, headers, pending = read_http_head(sock)
+        if not 'sec-websocket-key' in headers:
+            raise ProtocolError('Not a websocket request: {}'.format(status))
+        sock.sendall(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                      'Sec-WebSocket-Accept: {}\r\n\r\n').format(accept_key(headers['sec-websocket-key'])).encode())
+        return cls(sock, False, pending)
+
+    def send(self, payload, opcode = OP_BINARY):
+        size = len(payload)
+        if size < 126:
+            head = struct.pack('!BB', 0x80 | opcode, size | (0x80 if self.client else 0))
+        elif size < 65536:
+            head = struct.pack('!BBH', 0x80 | opcode, 126 | (0x80 if self.client else 0), size)
+        else:
+            head = struct.pack('!BBQ', 0x80 | opcode, 127 | (0x80 if self.client else 0), size)
+        if self.client:
+            mask = os.urandom(4)
+            head += mask
+            payload = mask_payload(payload, mask)
+        with self.lock:
+            self.sock.sendall(head + payload)
+
+    def recv_exact(self, size):
+        # Frames sent right after the handshake can arrive with the headers
+        if self.pending:
+            data, self.pending = self.pending[:size], self.pending[size:]
+            return data + recv_exact(self.sock, size - len(data)) if len(data) < size else data
+        return recv_exact(self.sock, size)
+
+    def recv_frame(self):
+        b1, b2 = self.recv_exact(2)
+        size = b2 & 0x7f
+        if size == 126:
+            size = struct.unpack('!H', self.recv_exact(2))[0]
+        elif size == 127:
+            size = struct.unpack('!Q', self.recv_exact(8))[0]
+        mask = self.recv_exact(4) if b2 & 0x80 else None
+        payload = self.recv_exact(size)
+        if mask:
+            payload = mask_payload(payload, mask)
+        return bool(b1 & 0x80), b1 & 0x0f, payload
+
+    def recv(self):
+        # Returns the opcode and payload of the next data message
+        message = None
+        while True:
+            fin, opcode, payload = self.recv_frame()
+            if opcode == OP_PING:
+                self.send(payload, OP_PONG)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_CLOSE:
+                raise ProtocolError('Websocket closed by peer')
+            if opcode != OP_CONTINUATION:
+                message = (opcode, bytearray())
+            elif message == None:
+                raise ProtocolError('Continuation frame without a message')
+            message[1].extend(payload)
+            if fin:
+                return message[0], bytes(message[1])
+
+    def close(self):
+        try:
+            self.send(b'', OP_CLOSE)
+        except OSError:
+            pass
+        self.sock.close()
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+
+def mask_payload(payload, mask):
+    # xor of the whole payload at once, a python loop per byte is too slow for
+    # catch up streams
+    key = int.from_bytes((mask * (len(payload) // 4 + 1))[:len(payload)], 'big')
+    return (int.from_bytes(payload, 'big') ^ key).to_bytes(len(payload), 'big')
+
+def read_http_head(sock):
+    data = b''
+    while not b'\r\n\r\n' in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ProtocolError('Connection closed during the websocket handshake')
+        data += chunk
+        if len(data) > 65536:
+            raise ProtocolError('HTTP headers too long')
+    head, pending = data.split(b'\r\n\r\n', 1)
+    lines = head.decode(errors='replace').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return lines[0], headers, pending
+
+def name_to_string(value):
+    chars = []
+    for i in range(13):
+        if i == 0:
+            chars.append(NAME_CHARS[value & 0x0f])
+            value >>= 4
+        else:
+            chars.append(NAME_CHARS[value & 0x1f])
+            value >>= 5
+    return ''.join(reversed(chars)).rstrip('.')
+
+def string_to_name(name):
+    value = 0
+    for i in range(13):
+        c = NAME_CHARS.index(name[i]) if i < len(name) else 0
+        if i < 12:
+            value |= (c & 0x1f) << (64 - 5 * (i + 1))
+        else:
+            value |= c & 0x0f
+    return value
+
+def encode_status_request():
+    return pack_varuint32(GET_STATUS_REQUEST)
+
+def encode_blocks_request(start_block_num, end_block_num = MAX_BLOCK_NUM, max_messages_in_flight = 10, have_positions = None,
+                          irreversible_only = False, fetch_block = True, fetch_traces = False, fetch_deltas = False):
+    positions = have_positions or []
+    return b''.join([
+        pack_varuint32(GET_BLOCKS_REQUEST),
+        struct.pack('<III', start_block_num, end_block_num, max_messages_in_flight),
+        pack_varuint32(len(positions)),
+        b''.join(encode_position(p) for p in positions),
+        bytes([irreversible_only, fetch_block, fetch_traces, fetch_deltas])
+    ])
+
+def encode_ack(num_messages):
+    return pack_varuint32(GET_BLOCKS_ACK_REQUEST) + struct.pack('<I', num_messages)
+
+def encode_position(position):
+    return struct.pack('<I', position['block_num']) + bytes.fromhex(position['block_id'])
+
+def encode_optional(value, encode):
+    return b'\x00' if value == None else b'\x01' + encode(value)
+
+def encode_bytes(value):
+    return pack_varuint32(len(value)) + value
+
+def encode_status_result(head, last_irreversible, begin_block, end_block):
+    return b''.join([pack_varuint32(GET_STATUS_RESULT), encode_position(head), encode_position(last_irreversible),
+                     struct.pack('<IIII', begin_block, end_block, begin_block, end_block)])
+
+def encode_blocks_result(head, last_irreversible, this_block = None, prev_block = None, block = None):
+    return b''.join([
+        pack_varuint32(GET_BLOCKS_RESULT),
+        encode_position(head),
+        encode_position(last_irreversible),
+        encode_optional(this_block, encode_position),
+        encode_optional(prev_block, encode_position),
+        encode_optional(block, encode_bytes),
+        b'\x00',                                   # traces
+        b'\x00'                                    # deltas
+    ])
+
+def encode_block_header(slot, producer, previous, schedule_version = 0):
+    # signed_block: the header, then an empty producer signature, transaction
+    # list and block extensions
+    return b''.join([
+        struct.pack('<IQH', slot, string_to_name(producer), 0),
+        bytes.fromhex(previous),
+        bytes(64),                                 # transaction_mroot, action_mroot
+        struct.pack('<I', schedule_version),
+        b'\x00',                                   # new_producers
+        pack_varuint32(0),                         # header_extensions
+        b'\x00' + bytes(65),                       # producer_signature
+        pack_varuint32(0),                         # transactions
+        pack_varuint32(0)                          # block_extensions
+    ])
+
+def read_position(reader):
+    return {'block_num': reader.unpack('<I'), 'block_id': reader.raw(32).hex()}
+
+def read_optional(reader, read):
+    return read(reader) if reader.raw(1)[0] else None
+
+def read_bytes(reader):
+    return reader.raw(reader.varuint32())
+
+def decode_block_header(data):
+    reader = Reader(data)
+    slot = reader.unpack('<I')
+    producer = name_to_string(reader.unpack('<Q'))
+    reader.unpack('<H')
+    previous = reader.raw(32).hex()
+    reader.raw(64)
+    return {'slot': slot, 'producer': producer, 'previous': previous, 'schedule_version': reader.unpack('<I')}
+
+def decode_result(data):
+    reader = Reader(data)
+    kind = reader.varuint32()
+    if kind == GET_STATUS_RESULT:
+        result = {'head': read_position(reader), 'last_irreversible': read_position(reader)}
+        result['trace_begin_block'], result['trace_end_block'], result['chain_state_begin_block'], result['chain_state_end_block'] = \
+            struct.unpack('<IIII', reader.raw(16))
+        return kind, result
+    if kind == GET_BLOCKS_RESULT:
+        result = {
+            'head': read_position(reader),
+            'last_irreversible': read_position(reader),
+            'this_block': read_optional(reader, read_position),
+            'prev_block': read_optional(reader, read_position)
+        }
+        block = read_optional(reader, read_bytes)
+        result['block'] = decode_block_header(block) if block else None
+        return kind, result
+    raise ProtocolError('Unknown result type {}'.format(kind))
+
+def block_time(slot):
+    return lpbstore.ms_to_time(producer_schedule.slot_to_ms(slot))
+
+class ShipMonitor:
+    def __init__(self, url, store = None, status_file = None, tracker = None, max_in_flight = 10, max_catchup = 7200,
+                 flush_interval = 0.5, timeout = 10, record = None, prodlog = None):
+        self.url = url
+        self.prodlog = prodlog
+        self.store = store
+        self.status_file = status_file
+        self.tracker = tracker
+        self.max_in_flight = max_in_flight
+        self.max_catchup = max_catchup
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.record = open(record, 'a') if record else None
+        self.status = {}
+        self.flushed = 0
+        self.started = time.time()
+
+    def start_block(self, status):
+        head = status['head']['block_num']
+        start = max(head - self.max_catchup, status['chain_state_begin_block'], 1)
+        if self.store != None and self.store.last_block_num:
+            start = max(start, self.store.last_block_num + 1)
+        return min(start, head)
+
+    def stream(self):
+        # The connect timeout stays on the socket: a node that sends nothing for
+        # that long is treated as gone and the stream is reopened
+        ws = WebSocket.connect(self.url, self.timeout)
+        try:
+            opcode, abi = ws.recv()
+            if self.record:
+                self.write_record({'t': 0, 'abi': abi.decode()})
+            ws.send(encode_status_request())
+            kind, status = decode_result(ws.recv()[1])
+            start = self.start_block(status)
+            print('Connected to {}, head {}, streaming from block {}'.format(self.url, status['head']['block_num'], start))
+            ws.send(encode_blocks_request(start, max_messages_in_flight=self.max_in_flight))
+            unacked = 0
+            while True:
+                opcode, data = ws.recv()
+                unacked += 1
+                if unacked >= max(self.max_in_flight // 2, 1):
+                    ws.send(encode_ack(unacked))
+                    unacked = 0
+                if self.record:
+                    self.write_record({'t': round(time.time() - self.started, 3), 'data': data.hex()})
+                kind, result = decode_result(data)
+                if kind == GET_BLOCKS_RESULT:
+                    self.process(result)
+        finally:
+            ws.close()
+
+    def write_record(self, entry):
+        self.record.write(json.dumps(entry) + '\n')
+        self.record.flush()
+
+    def process(self, result):
+        block = result['block']
+        this_block = result['this_block']
+        at_head = this_block != None and this_block['block_num'] >= result['head']['block_num']
+        self.status.update({
+            'head_block_num': result['head']['block_num'],
+            'head_block_id': result['head']['block_id'],
+            'last_irreversible_block_num': result['last_irreversible']['block_num'],
+            'last_irreversible_block_id': result['last_irreversible']['block_id']
+        })
+        if this_block != None and block != None:
+            timestamp = block_time(block['slot'])
+            self.status.update({
+                'block_num': this_block['block_num'],
+                'block_id': this_block['block_id'],
+                'block_time': timestamp,
+                'block_producer': block['producer']
+            })
+            if self.store != None:
+                if self.tracker != None:
+                    self.tracker.update(block['schedule_version'], block['slot'])
+                # Blocks of an older schedule are not judged against the current one
+                current = self.tracker == None or self.tracker.current(block['schedule_version'])
+                self.store.update(block['producer'], timestamp, this_block['block_num'], count_turn=True if current else None)
+                self.store.set_last_block(this_block['block_num'], timestamp)
+            if self.prodlog != None:
+                schedule = self.store.producers if self.store != None and current else []
+                self.prodlog.record_block(this_block['block_num'], block['slot'], block['producer'], schedule)
+        # Every block at the head is published at once, catch up in batches
+        now = time.time()
+        if at_head or now - self.flushed >= self.flush_interval:
+            if self.store != None:
+                self.store.flush()
+            if self.prodlog != None:
+                self.prodlog.flush()
+            if self.status_file:
+                self.status['updated'] = now
+                self.status['url'] = self.url
+                statestore.save(self.status_file, self.status)
+            self.flushed = now
+
+    def run(self, retry = 1):
+        while True:
+            try:
+                self.stream()
+            except (OSError, ProtocolError) as e:
+                print('Stream from {} failed: {}'.format(self.url, str(e) or type(e).__name__))
+            time.sleep(retry)
+
+class ShipFakeServer:
+    # Replays a recording to every client, keeping the pace of the recording
+    # divided by speed and honouring max_messages_in_flight and the acks
+    def __init__(self, port, recording, speed = 1.0, host = '127.0.0.1'):
+        with open(recording) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        self.abi = next((e['abi'] for e in entries if 'abi' in e), '{}')
+        self.messages = [(e['t'], bytes.fromhex(e['data'])) for e in entries if 'data' in e]
+        self.results = [decode_result(data)[1] for t, data in self.messages]
+        self.speed = speed
+        self.sock = socket.create_server((host, port))
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        while True:
+            conn, address = self.sock.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        try:
+            ws = WebSocket.accept(conn)
+            ws.send(self.abi.encode(), OP_TEXT)
+            credits = threading.Semaphore(0)
+            while True:
+                opcode, data = ws.recv()
+                reader = Reader(data)
+                kind = reader.varuint32()
+                if kind == GET_STATUS_REQUEST:
+                    # Every block of the recording is available, as in the block log of a node
+                    first, last = self.results[0], self.results[-1]
+                    ws.send(encode_status_result(last['head'], last['last_irreversible'],
+                                                 first['this_block']['block_num'] if first['this_block'] else 1, last['head']['block_num']))
+                elif kind == GET_BLOCKS_REQUEST:
+                    start, end, in_flight = reader.unpack('<I'), reader.unpack('<I'), reader.unpack('<I')
+                    for _ in range(in_flight):
+                        credits.release()
+                    threading.Thread(target=self.replay, args=(ws, start, end, credits), daemon=True).start()
+                elif kind == GET_BLOCKS_ACK_REQUEST:
+                    for _ in range(reader.unpack('<I')):
+                        credits.release()
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            conn.close()
+
+    def replay(self, ws, start, end, credits):
+        began = time.time()
+        first = None
+        try:
+            for (t, data), result in zip(self.messages, self.results):
+                block_num = result['this_block']['block_num'] if result['this_block'] else 0
+                if block_num < start or block_num >= end:
+                    continue
+                if first == None:
+                    first = t
+                delay = began + (t - first) / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                credits.acquire()
+                ws.send(data)
+        except OSError:
+            pass
+
+def synthesize(path, blocks, producers, start_block = 1000, lib_distance = 325, interval = 0.5, missed = ()):
+    # A recording of `blocks` consecutive blocks, 12 per producer, as a node
+    # at the head would send them. The slot before each block index in
+    # `missed` is left empty, as when its producer misses it
+    slot = producer_schedule.turn_start(producer_schedule.ms_to_slot(int(time.time() * 1000)))
+    ids = {}
+    block_id = lambda n: ids.setdefault(n, struct.pack('>I', n).hex() + os.urandom(28).hex())
+    with open(path, 'w') as f:
+        f.write(json.dumps({'t': 0, 'abi': json.dumps({'version': 'eosio::abi/1.1'})}) + '\n')
+        for i in range(blocks):
+            n = start_block + i
+            if i in missed:
+                slot += 1
+            producer = producers[producer_schedule.scheduled_position(slot + i, len(producers))]
+            position = {'block_num': n, 'block_id': block_id(n)}
+            lib = {'block_num': max(n - lib_distance, 1), 'block_id': block_id(max(n - lib_distance, 1))}
+            data = encode_blocks_result(position, lib, position, {'block_num': n - 1, 'block_id': block_id(n - 1)},
+                                        encode_block_header(slot + i, producer, block_id(n - 1), 1))
+            f.write(json.dumps({'t': round(i * interval, 3), 'data': data.hex()}) + '\n')
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Follow head, LIB and producers through the state history websocket')
+    parser.add_argument('-u', '--url', default='ws://localhost:8080', help='state_history_plugin endpoint. default = ws://localhost:8080')
+    parser.add_argument('-n', '--network', default='eos', help='Network name, for the default file names. default = eos')
+    parser.add_argument('-l', '--lpb_file', help='lpb store to update, - for none. default = <network>.lpb')
+    parser.add_argument('-S', '--status_file',
+                        help='json status file for check_eos_bp.py -c ship. default = {}'.format(statestore.state_path(statestore.DEFAULT_STATE_DIR, 'ship', '<network>')))
+    parser.add_argument('-e', '--endpoint-list', dest='endpoints',
+                        help='Comma separated API nodes for get_producer_schedule. Without them the lpb store has no schedule')
+    parser.add_argument('-m', '--max_in_flight', type=int, default=10, help='max_messages_in_flight of the blocks request. default = 10')
+    parser.add_argument('-x', '--max_catchup', type=int, default=7200,
+                        help='Maximum number of blocks to catch up after a stall or restart. default = 7200')
+    parser.add_argument('-t', '--timeout', type=float, default=10, help='Seconds without a message before reconnecting. default = 10')
+    parser.add_argument('-p', '--prodlog', help='Also append every block and missed slot to this production log (see prodlog.py)')
+    parser.add_argument('--record', help='Append every message received to this recording')
+    parser.add_argument('--serve', type=int, help='Replay --replay on this port')
+    parser.add_argument('--replay', help='Recording to replay')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed factor. default = 1')
+    parser.add_argument('--synthesize', help='Write a synthetic recording to this file and exit')
+    parser.add_argument('--blocks', type=int, default=600, help='Blocks in the synthetic recording. default = 600')
+    parser.add_argument('--producers', default='bpa,bpb,bpc', help='Producers in the synthetic recording. default = bpa,bpb,bpc')
+    parser.add_argument('--missed', default='', help='Comma separated block indexes of the synthetic recording preceded by a missed slot')
+    args = parser.parse_args()
+
+    if args.synthesize:
+        synthesize(args.synthesize, args.blocks, args.producers.split(','), missed=[int(i) for i in args.missed.split(',') if i])
+        return
+    if args.serve != None:
+        if not args.replay:
+            parser.error('--serve needs --replay')
+        server = ShipFakeServer(args.serve, args.replay, args.speed, host='0.0.0.0')
+        print('Replaying {} results on ws://0.0.0.0:{}'.format(len(server.messages), server.port))
+        server.serve_forever()
+
+    store = tracker = None
+    if args.lpb_file != '-':
+        store = lpbstore.LpbStore(args.lpb_file or '{}.lpb'.format(args.network))
+        if args.endpoints:
+            import eoslpb
+            pool = eoslpb.EndpointPool(args.endpoints.split(','), 0.3)
+            tracker = eoslpb.ScheduleTracker(pool, store)
+    status_file = args.status_file or statestore.state_path(statestore.DEFAULT_STATE_DIR, 'ship', args.network)
+    ShipMonitor(args.url, store, status_file, tracker, args.max_in_flight, args.max_catchup,
+                timeout=args.timeout, record=args.record, prodlog=prodlog.ProdLog(args.prodlog) if args.prodlog else None).run()
+
+if __name__ == "__main__":
+    main(sys.argv)
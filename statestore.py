@@ -0,0 +1,30 @@
+import os
+import re
+import json
+
+# Small json documents that checks keep between runs, one file per host and
+# check so hundreds of concurrent checks never contend for the same file.
+
+DEFAULT_STATE_DIR = '/var/tmp/eos-scripts'
+
+def state_path(state_dir, *parts):
+    name = '_'.join(re.sub(r'[^A-Za-z0-9.-]', '-', str(p)) for p in parts)
+    return os.path.join(state_dir, '{}.json'.format(name))
+
+def load(path, default = None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save(path, data):
+    # Written to a temporary file and renamed so a concurrent reader always
+    # sees either the previous or the new document
+    import tempfile
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.{}.'.format(os.path.basename(path)))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Runs the p2p handshake probe, the handshake check of check_eos_bp and the
+# --handshake ranking of filter_peers against FakePeer, with a stand-in
+# get_info for our node. Run with python3 -m unittest test_p2p_handshake or
+# pytest.
+
+import json
+import socket
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import check_eos_bp
+import filter_peers
+import p2p_handshake
+from nagios import SERVICE_STATUS
+
+CHAIN_ID = 'ab' * 32
+OTHER_CHAIN_ID = 'cd' * 32
+HEAD = 1000
+REF_HEAD = 1150
+
+class InfoHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = json.dumps({'head_block_num': REF_HEAD, 'last_irreversible_block_num': REF_HEAD - 325, 'chain_id': CHAIN_ID}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class P2PHandshakeTest(unittest.TestCase):
+    def start_peer(self, *args, **kwargs):
+        peer = p2p_handshake.FakePeer(0, *args, **kwargs).start()
+        self.addCleanup(peer.sock.close)
+        return peer
+
+    def start_api(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), InfoHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    def test_probe(self):
+        peer = self.start_peer(CHAIN_ID, HEAD)
+        result = p2p_handshake.probe('127.0.0.1', peer.port, CHAIN_ID, 2)
+        self.assertNotIn('go_away', result)
+        handshake = result['handshake']
+        self.assertEqual(handshake['chain_id'], CHAIN_ID)
+        self.assertEqual(handshake['head_num'], 1000)
+        self.assertEqual(handshake['last_irreversible_block_num'], 675)
+        self.assertEqual(handshake['agent'], 'fake peer')
+        self.assertGreater(result['rtt'], 0)
+        self.assertEqual(p2p_handshake.lag(result, REF_HEAD), REF_HEAD - HEAD)
+
+    def test_wrong_chain(self):
+        peer = self.start_peer(CHAIN_ID, HEAD)
+        result = p2p_handshake.probe('127.0.0.1', peer.port, OTHER_CHAIN_ID, 2)
+        self.assertEqual(result['go_away'], 'wrong_chain')
+        self.assertNotIn('handshake', result)
+
+    def test_go_away(self):
+        peer = self.start_peer(CHAIN_ID, HEAD, go_away='authentication')
+        result = p2p_handshake.probe('127.0.0.1', peer.port, CHAIN_ID, 2)
+        self.assertEqual(result['go_away'], 'authentication')
+
+    def test_timeout(self):
+        peer = self.start_peer(CHAIN_ID, HEAD, delay=1)
+        with self.assertRaises(socket.timeout):
+            p2p_handshake.probe('127.0.0.1', peer.port, CHAIN_ID, 0.2)
+
+    def run_check(self, port, *extra):
+        args = check_eos_bp.build_parser().parse_args(['-H', '127.0.0.1', '-p', str(port), '-c', 'handshake',
+                                                       '--ref_api', self.start_api()] + list(extra))
+        return check_eos_bp.check(args)
+
+    def test_check(self):
+        peer = self.start_peer(CHAIN_ID, HEAD)
+        status, output = self.run_check(peer.port, '--lag_warning', '200')
+        self.assertEqual(status, SERVICE_STATUS['OK'], output)
+        self.assertIn('lag={}'.format(REF_HEAD - HEAD), output)
+
+        status, output = self.run_check(peer.port, '--lag_warning', '100')
+        self.assertEqual(status, SERVICE_STATUS['WARNING'], output)
+        status, output = self.run_check(peer.port, '--lag_warning', '50', '--lag_critical', '100')
+        self.assertEqual(status, SERVICE_STATUS['CRITICAL'], output)
+
+    def test_check_go_away(self):
+        peer = self.start_peer(OTHER_CHAIN_ID, HEAD)
+        status, output = self.run_check(peer.port)
+        self.assertEqual(status, SERVICE_STATUS['CRITICAL'])
+        self.assertIn('wrong_chain', output)
+
+    def test_filter_peers(self):
+        info = {'chain_id': CHAIN_ID, 'head_block_num': REF_HEAD}
+        peer = self.start_peer(CHAIN_ID, HEAD)
+        result = filter_peers.probe_peer('127.0.0.1:{}'.format(peer.port), 2, 1, info=info)
+        self.assertEqual(len(result['rtts']), 2)
+        self.assertEqual(result['failures'], 0)
+        self.assertEqual(result['lag'], REF_HEAD - HEAD)
+        self.assertTrue(filter_peers.usable(result))
+
+        other = self.start_peer(OTHER_CHAIN_ID, HEAD)
+        result = filter_peers.probe_peer('127.0.0.1:{}'.format(other.port), 1, 1, info=info)
+        self.assertEqual(result['go_away'], 'wrong_chain')
+        self.assertFalse(filter_peers.usable(result))
+
+    @unittest.skipUnless(socket.has_ipv6, 'no IPv6')
+    def test_filter_peers_ipv6(self):
+        try:
+            peer = self.start_peer(CHAIN_ID, HEAD, host='::1')
+        except OSError:
+            self.skipTest('can not bind ::1')
+        result = filter_peers.probe_peer('[::1]:{}'.format(peer.port), 2, 1, info={'chain_id': CHAIN_ID, 'head_block_num': REF_HEAD})
+        self.assertEqual(result['failures'], 0)
+        self.assertEqual(result['lag'], REF_HEAD - HEAD)
+        self.assertIsNotNone(check_eos_bp.p2p_connect_time('::1', peer.port, 1))
+
+    def test_unresolvable(self):
+        result = filter_peers.probe_peer('peer.invalid:9876', 2, 1)
+        self.assertEqual(result['rtts'], [])
+        self.assertEqual(result['failures'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Replays a synthetic state history recording through ShipMonitor against
+# ShipFakeServer and checks the status file, the lpb store and the production
+# log it writes. Run with python3 -m unittest test_ship_monitor or pytest.
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import lpbstore
+import prodlog
+import statestore
+import producer_schedule
+import ship_monitor
+
+PRODUCERS = ['bpa', 'bpb', 'bpc']
+BLOCKS = 60
+MISSED = 30
+
+class ShipMonitorReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        recording = os.path.join(self.tmpdir, 'ship.rec')
+        # The slot before block index MISSED is left empty
+        ship_monitor.synthesize(recording, BLOCKS, PRODUCERS, missed=[MISSED])
+        self.server = ship_monitor.ShipFakeServer(0, recording, speed=100).start()
+        self.addCleanup(self.server.sock.close)
+        self.results = self.server.results
+
+        self.lpb_file = os.path.join(self.tmpdir, 'eos.lpb')
+        self.status_file = os.path.join(self.tmpdir, 'ship.json')
+        self.log_path = os.path.join(self.tmpdir, 'eos.prod')
+        store = lpbstore.LpbStore(self.lpb_file)
+        store.set_producers(PRODUCERS, 1)
+        monitor = ship_monitor.ShipMonitor('ws://127.0.0.1:{}'.format(self.server.port), store, self.status_file,
+                                           max_in_flight=4, timeout=30, prodlog=prodlog.ProdLog(self.log_path))
+        threading.Thread(target=monitor.stream, daemon=True).start()
+
+        last_block_num = self.results[-1]['this_block']['block_num']
+        deadline = time.time() + 10
+        self.status = None
+        while time.time() < deadline:
+            self.status = statestore.load(self.status_file)
+            if self.status and self.status.get('block_num') == last_block_num:
+                break
+            time.sleep(0.05)
+        self.assertEqual((self.status or {}).get('block_num'), last_block_num, 'replay did not reach the last block')
+
+    def test_status(self):
+        last = self.results[-1]
+        self.assertEqual(self.status['head_block_num'], last['head']['block_num'])
+        self.assertEqual(self.status['head_block_id'], last['head']['block_id'])
+        self.assertEqual(self.status['last_irreversible_block_num'], last['last_irreversible']['block_num'])
+        self.assertEqual(self.status['block_producer'], last['block']['producer'])
+        self.assertEqual(self.status['block_time'], ship_monitor.block_time(last['block']['slot']))
+
+    def test_lpb_store(self):
+        header, records = lpbstore.read_all(self.lpb_file)
+        self.assertEqual(header['last_block_num'], self.results[-1]['this_block']['block_num'])
+        records = {r['account']: r for r in records}
+        for producer in PRODUCERS:
+            last = [r for r in self.results if r['block']['producer'] == producer][-1]
+            self.assertEqual(records[producer]['last_block_produced'], last['this_block']['block_num'])
+            self.assertEqual(records[producer]['last_block_produced_time'], ship_monitor.block_time(last['block']['slot']))
+
+    def test_prodlog(self):
+        reader = prodlog.ProdLogReader(self.log_path)
+        entries = [reader.entries[i] for i in range(len(reader.entries))]
+        self.assertEqual(len(entries), BLOCKS + 1)
+        self.assertEqual([e[1] for e in entries if e[1]], [r['this_block']['block_num'] for r in self.results])
+
+        missed_slot = self.results[MISSED]['block']['slot'] - 1
+        scheduled = PRODUCERS[producer_schedule.scheduled_position(missed_slot, len(PRODUCERS))]
+        self.assertEqual([e for e in entries if not e[1]], [(missed_slot, 0, reader.names.index(scheduled))])
+
+        end = reader.last_slot + 1
+        for producer in PRODUCERS:
+            produced, missed = reader.stats(producer, entries[0][0], end)
+            self.assertEqual(produced, len([r for r in self.results if r['block']['producer'] == producer]))
+            self.assertEqual(missed, 1 if producer == scheduled else 0)
+
+if __name__ == '__main__':
+    unittest.main()
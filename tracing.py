@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+
+# Nested timed spans for finding where the time of a run went. Off by default:
+# span() then returns a shared no-op context manager, so the calls can stay in
+# every hot path. Enabled with --trace, spans are written when they end, to
+# stderr as an indented tree or to a json lines file, one object per span:
+#
+#   {"trace": "3f2a..", "id": 4, "parent": 1, "name": "http", "start": 1700000000.123,
+#    "duration": 0.0123, "thread": "MainThread", "url": "..."}
+#
+# --trace_sample enables tracing for a fraction of the runs only, so it can be
+# left configured in production. --profile also runs cProfile and dumps the
+# stats to a file readable with pstats or snakeviz.
+#
+# Only os, sys and time are imported until tracing is enabled, checks that
+# avoid the cost of imports do not pay for this module.
+
+ENABLED = False
+
+class NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+NOOP = NoopSpan()
+
+class Tracer:
+    def __init__(self, target):
+        import threading
+        self.trace_id = os.urandom(8).hex()
+        self.target = target
+        self.file = sys.stderr if target == '-' else open(target, 'a')
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.next_id = 0
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def emit(self, span):
+        import json
+        import threading
+        if self.target == '-':
+            attrs = ' '.join('{}={}'.format(k, v) for k, v in span.attrs.items())
+            line = '{}{} {:.3f}ms {}'.format('  ' * span.depth, span.name, span.duration * 1000, attrs).rstrip()
+        else:
+            record = {'trace': self.trace_id, 'id': span.id, 'parent': span.parent, 'name': span.name, 'start': span.start,
+                      'duration': round(span.duration, 6), 'thread': threading.current_thread().name}
+            record.update(span.attrs)
+            line = json.dumps(record, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+class Span:
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        self.id = self.tracer.new_id()
+        self.parent = stack[-1].id if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        self.start = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.started
+        if exc_type != None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer.stack().pop()
+        self.tracer.emit(self)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+TRACER = None
+PROFILER = None
+
+def span(name, **attrs):
+    if not ENABLED:
+        return NOOP
+    return Span(TRACER, name, attrs)
+
+def phases(timings):
+    # Adds already measured phases, e.g. the eoshttp timings of a request, as
+    # consecutive child spans of the current span
+    if not ENABLED:
+        return
+    stack = TRACER.stack()
+    now = time.time()
+    total = sum(timings.values())
+    offset = 0.0
+    for name, duration in timings.items():
+        child = Span(TRACER, name, {})
+        child.id = TRACER.new_id()
+        child.parent = stack[-1].id if stack else None
+        child.depth = len(stack)
+        child.start = now - total + offset
+        child.duration = duration
+        offset += duration
+        TRACER.emit(child)
+
+def configure(target, sample = 1.0, profile = None):
+    global ENABLED, TRACER, PROFILER
+    if not target and not profile:
+        return
+    if int.from_bytes(os.urandom(4), 'little') / 2 ** 32 >= sample:
+        return
+    if target:
+        TRACER = Tracer(target)
+        ENABLED = True
+    if profile:
+        import atexit
+        import cProfile
+        PROFILER = cProfile.Profile()
+        PROFILER.enable()
+        atexit.register(dump_profile, profile)
+
+def dump_profile(path):
+    PROFILER.disable()
+    PROFILER.dump_stats(path)
+
+def add_arguments(parser):
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Write timed spans of every phase to this json lines file, - for stderr')
+    parser.add_argument('--trace_sample', type=float, default=1.0,
+                        help='Fraction of runs traced, e.g. 0.01. default = 1')
+    parser.add_argument('--profile', metavar='FILE', help='Run cProfile and write the stats to this file')
+
+def configure_from(args):
+    configure(args.trace, args.trace_sample, args.profile)